@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+"""
+Benchmark of the contiguity of event ranges assigned by EventRangeQueue
+
+Builds synthetic jobs where the ranges of each input file are delivered in shuffled chunks and some assigned ranges
+are put back in the queue, as happens when an actor ends. Every range is then assigned in fixed-size batches and the
+average number of gaps per batch is reported for the default FIFO assignment and for the contiguous mode. A gap is
+counted each time two consecutive ranges of a batch, sorted by event, are not contiguous.
+
+"""
+
+import argparse
+import random
+import time
+from typing import Dict, List
+
+from raythena.utils.eventservice import EventRange, EventRangeQueue
+
+
+def build_reply(nfiles: int, events_per_file: int, chunk: int, seed: int) -> List[Dict]:
+    rng = random.Random(seed)
+    chunks = list()
+    for f in range(nfiles):
+        for first in range(0, events_per_file, chunk):
+            chunks.append([{
+                'eventRangeID': f"Range-{f:03}-{i:06}",
+                'startEvent': i,
+                'lastEvent': i,
+                'LFN': f"/path/to/EVNT.{f:05}.pool.root.1",
+                'GUID': '0',
+                'scope': '13TeV'
+            } for i in range(first, min(first + chunk, events_per_file))])
+    rng.shuffle(chunks)
+    return [r for c in chunks for r in c]
+
+
+def count_gaps(batch: List[EventRange]) -> int:
+    events = sorted((r.file_basename, r.startEvent, r.lastEvent) for r in batch)
+    return sum(1 for prev, cur in zip(events, events[1:]) if prev[0] != cur[0] or cur[1] != prev[2] + 1)
+
+
+def run(reply: List[Dict], batch_size: int, requeue: float, contiguous: bool, seed: int) -> Dict[str, float]:
+    rng = random.Random(seed)
+    queue = EventRangeQueue(contiguous=contiguous)
+    queue.concat_raw(reply)
+    gaps = list()
+    start = time.perf_counter()
+    while queue.nranges_available():
+        batch = queue.get_next_ranges(batch_size)
+        gaps.append(count_gaps(batch))
+        # simulate actors ending before processing part of their ranges
+        if rng.random() < requeue:
+            requeued = [r.eventRangeID for r in batch[:batch_size // 2]]
+            queue.update_ranges_states(requeued, [EventRange.READY] * len(requeued))
+        else:
+            queue.update_ranges_states([r.eventRangeID for r in batch], [EventRange.DONE] * len(batch))
+    elapsed = time.perf_counter() - start
+    return {"batches": len(gaps), "gaps": sum(gaps) / len(gaps), "us_per_batch": elapsed / len(gaps) * 1e6}
+
+
+def main(nfiles: int, events_per_file: int, chunk: int, batch_size: int, requeue: float, seed: int) -> None:
+    reply = build_reply(nfiles, events_per_file, chunk, seed)
+    print(f"{'mode':>12} {'batches':>8} {'gaps/batch':>11} {'us/batch':>9}")
+    for contiguous in (False, True):
+        res = run(reply, batch_size, requeue, contiguous, seed)
+        mode = "contiguous" if contiguous else "fifo"
+        print(f"{mode:>12} {res['batches']:>8} {res['gaps']:>11.2f} {res['us_per_batch']:>9.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark contiguity of EventRangeQueue assignments")
+    parser.add_argument("--nfiles", type=int, default=20, help="Number of input files")
+    parser.add_argument("--events-per-file", type=int, default=5000, help="Number of single-event ranges per file")
+    parser.add_argument("--chunk", type=int, default=50, help="Number of contiguous ranges per delivered chunk")
+    parser.add_argument("--batch", type=int, default=64, help="Number of ranges per request")
+    parser.add_argument("--requeue", type=float, default=0.05, help="Fraction of batches partially put back in the queue")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed")
+    args = parser.parse_args()
+    main(args.nfiles, args.events_per_file, args.chunk, args.batch, args.requeue, args.seed)
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+"""
+Benchmark of the JSON codec backends on event service payloads
+
+Encodes and decodes the payloads exchanged on the hot paths with each installed backend of JSONCodec: a harvester
+reply holding event ranges, the list of EventRange sent to the pilot, which goes through the default hook, and a
+pilot range update. Throughput is reported in MB/s of JSON and in ranges per second.
+
+"""
+
+import argparse
+import time
+from typing import Any, Callable, Dict, List
+
+from raythena.utils.eventservice import EventRange, es_json_default
+from raythena.utils.jsoncodec import JSONCodec
+
+
+def build_payloads(nranges: int) -> Dict[str, Any]:
+    reply = [{
+        'eventRangeID': f"32186215-5011406537-22637217690-{i + 1}-1",
+        'startEvent': i * 10 + 1,
+        'lastEvent': i * 10 + 10,
+        'LFN': f"/lustre/atlas/proj-shared/csc108/EVNT.23897465._{i // 1000:06}.pool.root.1",
+        'GUID': "7F1E5E6C-7E5B-7C4D-B6A2-8B61B4C4E5F1",
+        'scope': "mc16_13TeV"
+    } for i in range(nranges)]
+    update = [{
+        'eventRangeID': r['eventRangeID'],
+        'eventStatus': "finished",
+        'pfn': f"/tmp/worker/HITS.pool.root.{r['eventRangeID']}",
+        'fsize': 1345873,
+        'adler32': "36503831",
+        'type': "es_output"
+    } for r in reply]
+    return {
+        "reply": {"5011406537": reply},
+        "ranges": [EventRange.build_from_dict(r) for r in reply],
+        "update": update
+    }
+
+
+def measure(func: Callable[[], Any], repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def run(codec: JSONCodec, payloads: Dict[str, Any], nranges: int, repeat: int) -> List[str]:
+    lines = list()
+    for name, payload in payloads.items():
+        default = es_json_default if name == "ranges" else None
+        encoded = codec.dumps(payload, default)
+        size = len(encoded.encode()) / 1e6
+        encode_time = measure(lambda: codec.dumps(payload, default), repeat)
+        decode_time = measure(lambda: codec.loads(encoded), repeat)
+        lines.append(f"{codec.backend:>8} {name:>7} {size / encode_time:>10.1f} {nranges / encode_time:>12.0f} "
+                     f"{size / decode_time:>10.1f} {nranges / decode_time:>12.0f}")
+    return lines
+
+
+def main(nranges: int, repeat: int) -> None:
+    payloads = build_payloads(nranges)
+    print(f"{'backend':>8} {'payload':>7} {'enc MB/s':>10} {'enc range/s':>12} {'dec MB/s':>10} {'dec range/s':>12}")
+    for backend in JSONCodec.available_backends():
+        for line in run(JSONCodec(backend), payloads, nranges, repeat):
+            print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark JSON codec backends on event service payloads")
+    parser.add_argument("--nranges", type=int, default=10000, help="Number of event ranges per payload")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of repetitions, the best time is reported")
+    args = parser.parse_args()
+    main(args.nranges, args.repeat)
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+"""
+Benchmark of the wire format used to send event ranges to actors
+
+Compares a list of EventRange, as previously sent by the driver, with an EventRangeBatch. Both are serialized with
+pickle like ray does for task arguments. The size of the serialized payload and the time of a round-trip are
+reported, the round-trip including building the batch on the driver and reading every range on the actor.
+
+"""
+
+import argparse
+import pickle
+import time
+from typing import Any, Callable, List
+
+from raythena.utils.eventservice import EventRange, EventRangeBatch
+
+
+def build_ranges(nranges: int, ranges_per_file: int) -> List[EventRange]:
+    return [EventRange(f"32186215-5011406537-22637217690-{i + 1}-1", i * 10 + 1, i * 10 + 10,
+                       f"/lustre/atlas/proj-shared/csc108/EVNT.23897465._{i // ranges_per_file:06}.pool.root.1",
+                       "7F1E5E6C-7E5B-7C4D-B6A2-8B61B4C4E5F1", "mc16_13TeV") for i in range(nranges)]
+
+
+def measure(func: Callable[[], Any], repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def roundtrip_list(ranges: List[EventRange]) -> None:
+    for r in pickle.loads(pickle.dumps(ranges, protocol=pickle.HIGHEST_PROTOCOL)):
+        r.PFN
+
+
+def roundtrip_batch(ranges: List[EventRange]) -> None:
+    for r in pickle.loads(pickle.dumps(EventRangeBatch(ranges), protocol=pickle.HIGHEST_PROTOCOL)):
+        r.PFN
+
+
+def main(sizes: List[int], ranges_per_file: int, repeat: int) -> None:
+    print(f"{'ranges':>7} {'list B':>9} {'batch B':>9} {'ratio':>6} {'list ms':>8} {'batch ms':>9} {'speedup':>8}")
+    for nranges in sizes:
+        ranges = build_ranges(nranges, ranges_per_file)
+        list_size = len(pickle.dumps(ranges, protocol=pickle.HIGHEST_PROTOCOL))
+        batch_size = len(pickle.dumps(EventRangeBatch(ranges), protocol=pickle.HIGHEST_PROTOCOL))
+        list_time = measure(lambda: roundtrip_list(ranges), repeat)
+        batch_time = measure(lambda: roundtrip_batch(ranges), repeat)
+        print(f"{nranges:>7} {list_size:>9} {batch_size:>9} {list_size / batch_size:>6.1f} {list_time * 1e3:>8.2f} "
+              f"{batch_time * 1e3:>9.2f} {list_time / batch_time:>8.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the wire format of event ranges sent to actors")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[32, 128, 512, 1024, 4096],
+                        help="Number of event ranges per batch")
+    parser.add_argument("--ranges-per-file", type=int, default=1000, help="Number of event ranges per input file")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of repetitions, the best time is reported")
+    args = parser.parse_args()
+    main(args.sizes, args.ranges_per_file, args.repeat)
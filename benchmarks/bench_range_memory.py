@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+"""
+Benchmark of the memory used by EventRange objects
+
+Builds event ranges from a harvester reply decoded from JSON, where each field is a distinct string object, and reports
+the memory referenced by each range with tracemalloc. EventRange, which uses __slots__ and interns the strings shared
+by ranges of the same file, is compared to a reference layout storing the same fields in the instance __dict__.
+
+"""
+
+import argparse
+import json
+import tracemalloc
+from typing import Any, Callable, Dict
+
+from raythena.utils.eventservice import EventRange
+
+
+class DictEventRange(object):
+    """
+    EventRange layout without __slots__ nor interning, used as a reference
+    """
+
+    def __init__(self, r_dict: Dict[str, Any]) -> None:
+        self.lastEvent = r_dict['lastEvent']
+        self.eventRangeID = r_dict['eventRangeID']
+        self.startEvent = r_dict['startEvent']
+        self.PFN = r_dict['LFN']
+        self.GUID = r_dict['GUID']
+        self.scope = r_dict['scope']
+        self.status = EventRange.READY
+        self.retry = 0
+
+
+def build_reply(nranges: int, nfiles: int) -> str:
+    return json.dumps([{
+        "eventRangeID": f"Range-{i:08}",
+        "LFN": f"/path/to/EVNT.{i % nfiles:05}.pool.root.1",
+        "lastEvent": i,
+        "startEvent": i,
+        "GUID": f"{i % nfiles:032}",
+        "scope": "mc16_13TeV"
+    } for i in range(nranges)])
+
+
+def bytes_per_range(reply: str, build: Callable[[Dict[str, Any]], Any]) -> float:
+    tracemalloc.start()
+    r_dicts = json.loads(reply)
+    ranges = [build(r) for r in r_dicts]
+    # release the parsed dicts so that only memory referenced by the ranges is counted
+    del r_dicts
+    used = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return used / len(ranges)
+
+
+def main(nranges: int, nfiles: int) -> None:
+    reply = build_reply(nranges, nfiles)
+    reference = bytes_per_range(reply, DictEventRange)
+    compact = bytes_per_range(reply, EventRange.build_from_dict)
+    print(f"{'layout':>30} {'bytes/range':>12}")
+    print(f"{'__dict__':>30} {reference:>12.1f}")
+    print(f"{'__slots__, interned strings':>30} {compact:>12.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the memory used by event ranges")
+    parser.add_argument("--nranges", type=int, default=100000, help="Number of event ranges")
+    parser.add_argument("--nfiles", type=int, default=10, help="Number of input files")
+    args = parser.parse_args()
+    main(args.nranges, args.nfiles)
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+"""
+Benchmark of event range state transitions in EventRangeQueue
+
+Builds queues of increasing size, assigns every range then measures the time needed to apply
+a fixed-size range update. The cost per update should stay flat as the number of ranges grows.
+
+"""
+
+import argparse
+import time
+
+from raythena.utils.eventservice import EventRange, EventRangeQueue
+
+
+def build_queue(nranges: int, nfiles: int) -> EventRangeQueue:
+    queue = EventRangeQueue()
+    for i in range(nranges):
+        queue.append(EventRange(f"Range-{i:08}", i, i, f"/path/to/EVNT.{i % nfiles:05}.pool.root.1", "0", "13TeV"))
+    return queue
+
+
+def bench_update(nranges: int, nfiles: int, batch: int) -> float:
+    queue = build_queue(nranges, nfiles)
+    assigned = queue.get_next_ranges(nranges)
+    step = max(1, len(assigned) // batch)
+    update = [{'eventRangeID': r.eventRangeID, 'eventStatus': EventRange.DONE} for r in assigned[::step][:batch]]
+    start = time.perf_counter()
+    queue.update_ranges(update)
+    return (time.perf_counter() - start) / len(update)
+
+
+def main(sizes: list, nfiles: int, batch: int) -> None:
+    print(f"{'nranges':>10} {'us/update':>10}")
+    for nranges in sizes:
+        per_update = bench_update(nranges, nfiles, batch)
+        print(f"{nranges:>10} {per_update * 1e6:>10.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark EventRangeQueue range updates")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000, 1000000],
+                        help="Number of ranges in the queue")
+    parser.add_argument("--nfiles", type=int, default=100, help="Number of input files")
+    parser.add_argument("--batch", type=int, default=1000, help="Number of ranges per update")
+    args = parser.parse_args()
+    main(args.sizes, args.nfiles, args.batch)
@@ -1,4 +1,3 @@
-import json
 import os
 import re
 import shutil
@@ -9,7 +8,8 @@ import ray
 
 from raythena.actors.loggingActor import LoggingActor
 from raythena.utils.config import Config
-from raythena.utils.eventservice import EventRangeRequest, Messages, EventRangeUpdate, PandaJob, EventRange
+from raythena.utils.eventservice import (EventRangeRequest, Messages, EventRangeUpdate, PandaJob, EventRange,
+                                         EventRangeBatch)
 from raythena.utils.exception import IllegalWorkerState, StageInFailed, StageOutFailed
 from raythena.utils.plugins import PluginsRegistry
 from raythena.utils.ray import get_node_ip
@@ -159,7 +159,9 @@ class ESWorker(object):
         self.payload_actor_process_dir = os.path.join(self.payload_job_dir, subdir)
         self.payload_actor_output_dir = os.path.join(self.payload_job_dir, subdir, "esOutput")
         try:
-            os.mkdir(self.payload_actor_process_dir)
+            # the directory already exists when restarting in the workdir of a previous run
+            if not os.path.isdir(self.payload_actor_process_dir):
+                os.mkdir(self.payload_actor_process_dir)
             os.chdir(self.payload_actor_process_dir)
         except Exception:
             raise StageInFailed(self.id)
@@ -281,14 +283,14 @@ class ESWorker(object):
 
     def receive_event_ranges(
             self, reply: int,
-            event_ranges: List[EventRange]) -> Tuple[str, int, object]:
+            event_ranges: Union[List[EventRange], EventRangeBatch]) -> Tuple[str, int, object]:
         """
         Sends event ranges to the worker. Update the PFN of event ranges to an absolute path if
         it is an relative path
 
         Args:
             reply: status code indicating whether the event ranges request was correctly processed
-            event_ranges: list of event ranges to process
+            event_ranges: list or batch of event ranges to process
 
         Returns:
             tuple with status code indicating that the event ranges were correctly received
@@ -298,6 +300,7 @@ class ESWorker(object):
             self.transition_state(ESWorker.FINISHING_LOCAL_RANGES)
             self.payload.submit_new_ranges(None)
             return self.return_message(Messages.REPLY_OK)
+        event_ranges = list(event_ranges)
         for crange in event_ranges:
             if not os.path.isabs(crange.PFN):
                 crange.PFN = os.path.join(
@@ -376,22 +379,20 @@ class ESWorker(object):
 
     def stageout_event_service_files(
             self,
-            ranges_update: Dict[str, str]) -> Union[EventRangeUpdate, None]:
+            ranges: EventRangeUpdate) -> EventRangeUpdate:
         """
         Move the event ranges files reported in the event ranges update to the harvester endpoint common to
         all workers for stage-out
 
         Args:
-            ranges_update: event ranges updated received by the payload
+            ranges: event ranges update received by the payload, in harvester format
 
         Returns:
             event ranges update referencing moved output files
         """
         harvester_endpoint = os.path.expandvars(self.config.harvester.get("endpoint", ""))
         if not os.path.isdir(harvester_endpoint):
-            return
-        ranges = json.loads(ranges_update['eventRanges'][0])
-        ranges = EventRangeUpdate.build_from_dict(self.job.get_id(), ranges)
+            return ranges
         self.logging_actor.info.remote(self.id, f"stageout_event_service_files: {ranges[self.job.get_id()]}", time.asctime())
         # stage-out finished event ranges
         for range_update in ranges[self.job.get_id()]:
@@ -456,9 +457,17 @@ class ESWorker(object):
                     self.logging_actor.debug.remote(self.id,
                                                     f"First event range request. Requesting {n_events} event ranges.", time.asctime())
                     self.first_event_range_request = False
-                req.add_event_request(self.job['PandaID'],
-                                      n_events,
-                                      self.job['taskID'], self.job['jobsetID'])
+                events_per_core = self.config.resources.get('eventspercore')
+                if events_per_core:
+                    # request sized in events, the driver fills it up to n_events whatever the size of the ranges
+                    n_events *= events_per_core
+                    req.add_event_request(self.job['PandaID'],
+                                          n_events,
+                                          self.job['taskID'], self.job['jobsetID'], n_events)
+                else:
+                    req.add_event_request(self.job['PandaID'],
+                                          n_events,
+                                          self.job['taskID'], self.job['jobsetID'])
                 self.transition_state(ESWorker.EVENT_RANGES_REQUESTED)
                 self.logging_actor.debug.remote(
                     self.id, "Sending event ranges request to the driver", time.asctime())
@@ -1,10 +1,10 @@
 from abc import abstractmethod
-from typing import Union, Dict, List
+from typing import Union, List
 
 from raythena.actors.loggingActor import LoggingActor
 from raythena.actors.payloads.basePayload import BasePayload
 from raythena.utils.config import Config
-from raythena.utils.eventservice import EventRange
+from raythena.utils.eventservice import EventRange, EventRangeUpdate
 
 
 class ESPayload(BasePayload):
@@ -37,12 +37,12 @@ class ESPayload(BasePayload):
         raise NotImplementedError("Base method not implemented")
 
     @abstractmethod
-    def fetch_ranges_update(self) -> Union[None, Dict[str, str]]:
+    def fetch_ranges_update(self) -> Union[None, EventRangeUpdate]:
         """
         Checks if event ranges update are available
 
         Returns:
-            Dict holding event range update of processed events, None if no update is available
+            Event range update of processed events in harvester format, None if no update is available
         """
         raise NotImplementedError("Base method not implemented")
 
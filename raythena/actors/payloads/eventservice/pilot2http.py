@@ -1,6 +1,5 @@
 import asyncio
 import functools
-import json
 import os
 import time
 import shlex
@@ -16,8 +15,9 @@ from aiohttp import web
 from raythena.actors.loggingActor import LoggingActor
 from raythena.actors.payloads.eventservice.esPayload import ESPayload
 from raythena.utils.config import Config
-from raythena.utils.eventservice import ESEncoder
-from raythena.utils.eventservice import PandaJob, EventRange
+from raythena.utils import jsoncodec
+from raythena.utils.eventservice import es_json_default
+from raythena.utils.eventservice import PandaJob, EventRange, EventRangeUpdate
 from raythena.utils.exception import FailedPayload, ExThread
 
 
@@ -99,7 +99,7 @@ class Pilot2HttpPayload(ESPayload):
         super().__init__(worker_id, logging_actor, config)
         self.host = '127.0.0.1'
         self.port = 8080
-        self.json_encoder = functools.partial(json.dumps, cls=ESEncoder)
+        self.json_encoder = functools.partial(jsoncodec.dumps, default=es_json_default)
         self.server_thread = None
         self.pilot_process = None
         self.site = None
@@ -410,12 +410,12 @@ class Pilot2HttpPayload(ESPayload):
         except QueueEmpty:
             return None
 
-    def fetch_ranges_update(self) -> Union[None, Dict[str, str]]:
+    def fetch_ranges_update(self) -> Union[None, EventRangeUpdate]:
         """
         Checks if event ranges update are available by polling the event ranges update queue
 
         Returns:
-            Dict holding event range update of processed events, None if no update is available
+            Event range update of processed events in harvester format, None if no update is available
         """
         try:
             return self.ranges_update.get_nowait()
@@ -541,16 +541,29 @@ class Pilot2HttpPayload(ESPayload):
     async def handle_update_event_ranges(
             self, request: web.BaseRequest) -> web.Response:
         """
-         Handler for updateEventRanges call, adds the event ranges update to a queue to be retrieved by the worker
+         Handler for updateEventRanges call, parses the event ranges update to the harvester format and adds it to a
+         queue to be retrieved by the worker
 
         Args:
             request: http request received by the server
 
         Returns:
-            status code
+            status code, -1 if the update is malformed or if none of its ranges are valid
         """
-        body = await Pilot2HttpPayload.parse_qs_body(request)
-        await self.ranges_update.put(body)
+        body = await request.text() if request.can_read_body else ""
+        # malformed ranges are skipped so that the valid ranges of the same update are not lost
+        rejected = list()
+        try:
+            ranges_update = EventRangeUpdate.parse_pilot_update(self.current_job.get_id(), body, rejected)
+        except Exception as e:
+            self.logging_actor.error.remote(self.worker_id, f"Rejected event ranges update: {e}", time.asctime())
+            return web.json_response({"StatusCode": -1}, dumps=self.json_encoder)
+        for message in rejected:
+            self.logging_actor.error.remote(self.worker_id, f"Rejected event range: {message}", time.asctime())
+        if ranges_update[self.current_job.get_id()]:
+            await self.ranges_update.put(ranges_update)
+        elif rejected:
+            return web.json_response({"StatusCode": -1}, dumps=self.json_encoder)
         res = {"StatusCode": 0}
         self.logging_actor.debug.remote(
             self.worker_id, f"Finished handling {request.method} {request.path}", time.asctime())
@@ -1,11 +1,11 @@
 import configparser
-import json
 import os
 import shutil
 import time
 from queue import Queue
 
 from raythena.drivers.communicators.baseCommunicator import BaseCommunicator
+from raythena.utils import jsoncodec
 from raythena.utils.config import Config
 from raythena.utils.eventservice import EventRangeRequest, PandaJobRequest, PandaJobUpdate, EventRangeUpdate, JobReport
 from raythena.utils.exception import ExThread
@@ -92,14 +92,14 @@ class HarvesterFileCommunicator(BaseCommunicator):
         # Checks if a job file already exists
         if os.path.isfile(self.jobspecfile):
             with open(self.jobspecfile) as f:
-                job = json.load(f)
+                job = jsoncodec.load(f)
                 self.job_queue.put(job)
         else:
             # create request file if necessary
             if not os.path.isfile(self.jobrequestfile):
                 request_tmp = f"{self.jobrequestfile}.tmp"
                 with open(request_tmp, 'w') as f:
-                    json.dump(request.to_dict(), f)
+                    jsoncodec.dump(request.to_dict(), f)
                 shutil.move(request_tmp, self.jobrequestfile)
 
             # wait on job file creation
@@ -108,7 +108,7 @@ class HarvesterFileCommunicator(BaseCommunicator):
 
             # load job and remove request file
             with open(self.jobspecfile) as f:
-                job = json.load(f)
+                job = jsoncodec.load(f)
 
         try:
             os.remove(self.jobrequestfile)
@@ -137,7 +137,7 @@ class HarvesterFileCommunicator(BaseCommunicator):
                 self.eventrequestfile):
             event_request_file_tmp = f"{self.eventrequestfile}.tmp"
             with open(event_request_file_tmp, 'w') as f:
-                json.dump(request.request, f)
+                jsoncodec.dump(request.request, f)
             shutil.move(event_request_file_tmp, self.eventrequestfile)
             print(f"request_event_ranges: created new {self.eventrequestfile} file")
 
@@ -148,7 +148,7 @@ class HarvesterFileCommunicator(BaseCommunicator):
         while os.path.isfile(self.eventrangesfile):
             try:
                 with open(self.eventrangesfile, 'r') as f:
-                    ranges = json.load(f)
+                    ranges = jsoncodec.load(f)
                 if os.path.isfile(self.eventrangesfile):
                     shutil.move(
                         self.eventrangesfile,
@@ -196,7 +196,7 @@ class HarvesterFileCommunicator(BaseCommunicator):
             try:
                 shutil.move(self.eventstatusdumpjsonfile, tmp_status_dump_file)
                 with open(tmp_status_dump_file) as f:
-                    current_update = json.load(f)
+                    current_update = jsoncodec.load(f)
             except Exception:
                 pass
             else:
@@ -208,7 +208,7 @@ class HarvesterFileCommunicator(BaseCommunicator):
                         request[panda_id] = current_update[panda_id]
 
         with open(tmp_status_dump_file, 'w') as f:
-            json.dump(request.range_update, f)
+            jsoncodec.dump(request.range_update, f)
 
         # eventstatusdumpjsonfile should not exist as it just got removed before
         while os.path.isfile(self.eventstatusdumpjsonfile):
@@ -229,7 +229,7 @@ class HarvesterFileCommunicator(BaseCommunicator):
         job_report_file = f"{self.jobreportfile}"
 
         with open(job_report_file, 'w') as f:
-            json.dump(request.to_dict(), f)
+            jsoncodec.dump(request.to_dict(), f)
 
     def run(self) -> None:
         """
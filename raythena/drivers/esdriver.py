@@ -1,7 +1,12 @@
+import functools
+import glob
+import math
 import os
 import time
+from bisect import bisect_left, insort
+from itertools import chain
 from queue import Queue, Empty
-from typing import List, Dict, Union, Any
+from typing import List, Dict, Set, Tuple, Union, Any
 import concurrent.futures
 import tarfile
 import shutil
@@ -17,10 +22,12 @@ from raythena.drivers.communicators.baseCommunicator import BaseCommunicator
 from raythena.utils.config import Config
 from raythena.utils.eventservice import (EventRangeRequest, PandaJobRequest,
                                          EventRangeUpdate, Messages, PandaJobQueue,
-                                         EventRange, PandaJob, JobReport)
+                                         EventRange, EventRangeQueue, PandaJob, JobReport, RangeIDSet,
+                                         EventRangeBatch)
+from raythena.utils import jsoncodec
 from raythena.utils.plugins import PluginsRegistry
 from raythena.utils.ray import (build_nodes_resource_list, get_node_ip)
-from raythena.utils.timing import CPUMonitor
+from raythena.utils.timing import CPUMonitor, ThroughputEstimator
 
 EventRangeTypeHint = Dict[str, str]
 PandaJobTypeHint = Dict[str, str]
@@ -32,12 +39,46 @@ class BookKeeper(object):
     """
 
     def __init__(self, logging_actor: LoggingActor, config: Config) -> None:
-        self.jobs = PandaJobQueue()
         self.logging_actor = logging_actor
         self.config = config
+        # columnar range storage and collapsing of final ranges reduce the driver memory footprint of jumbo jobs.
+        # collapsefinished and collapsefailed (both off by default) only keep the ids of DONE, resp. FAILED ranges:
+        # they are removed from event_ranges_by_id and can no longer be looked up by id
+        collapsed_states = list()
+        if self.config.ray.get('collapsefinished', False):
+            collapsed_states.append(EventRange.DONE)
+        if self.config.ray.get('collapsefailed', False):
+            collapsed_states.append(EventRange.FAILED)
+        ranges_queue_factory = functools.partial(EventRangeQueue,
+                                                 columnar=self.config.ray.get('columnarranges', False),
+                                                 file_policy=self.config.ray.get('filepolicy', EventRangeQueue.BEST_FIT),
+                                                 collapsed_states=collapsed_states,
+                                                 spill_dir=self.config.ray.get('workdir'),
+                                                 memory_budget=self.config.ray.get('rangesmemorybudget', 0),
+                                                 contiguous=self.config.ray.get('contiguousranges', False))
+        self.jobs = PandaJobQueue(ranges_queue_factory=ranges_queue_factory)
+        # number of ranges and events of all jobs in each state other than READY, kept up to date from the state
+        # transitions of ranges so that the driver loop doesn't need to go through every job
+        self.nranges_by_state: Dict[str, int] = {state: 0 for state in EventRange.STATES if state != EventRange.READY}
+        self.nevents_by_state: Dict[str, int] = dict(self.nranges_by_state)
+        self.jobs.subscribe(self._on_range_transition)
         self.actors: Dict[str, Union[str, None]] = dict()
-        self.rangesID_by_actor: Dict[str, List[str]] = dict()
-        self.finished_range_by_input_file: Dict[str, List[Dict]] = dict()
+        # ranges assigned to each actor, kept in assignment order, and actor to which each range is assigned
+        self.rangesID_by_actor: Dict[str, Dict[str, None]] = dict()
+        self.actor_by_rangeID: Dict[str, str] = dict()
+        # input files read by each actor, actors run one per node so this is also the files read by each node
+        self.file_affinity = self.config.ray.get('fileaffinity', False)
+        self.files_by_actor: Dict[str, Dict[str, None]] = dict()
+        self.actors_by_file: Dict[str, Dict[str, None]] = dict()
+        self.finished_range_by_input_file: Dict[str, RangeIDSet] = dict()
+        # retry policy: failed ranges are requeued up to maxretries times, waiting retrybackoff seconds doubled at each
+        # retry, and ranges left behind by maxcrashes crashed actors are quarantined. Both are disabled by default
+        self.max_retries = self.config.ray.get('maxretries', 0)
+        self.retry_backoff = self.config.ray.get('retrybackoff', 60)
+        self.max_crashes = self.config.ray.get('maxcrashes', 0)
+        self.retry_ranges: Dict[str, Dict[str, float]] = dict()
+        self.failed_actors_by_range: Dict[str, Set[str]] = dict()
+        self.crashes_by_range: Dict[str, int] = dict()
         self.ranges_to_tar_by_input_file: Dict[str, List[Dict]] = dict()
         self.ranges_to_tar: List[List[Dict]] = list()
         self.ranges_tarred_up: List[List[Dict]] = list()
@@ -46,7 +87,14 @@ class BookKeeper(object):
         self.finished_by_time = []
         self.finished_by_time.append((time.time(), 0))
         self.monitortime = self.config.ray['monitortime']
+        # throughput of the cluster, of each job and of each actor, sampled when finished_by_time is updated
+        self.throughput_halflife = self.config.ray.get('throughputhalflife', 3 * self.monitortime)
+        self.walltime = self.config.ray.get('walltime', None)
+        self.throughput = ThroughputEstimator(self.throughput_halflife, self.start_time)
+        self.throughput_by_job: Dict[str, ThroughputEstimator] = dict()
+        self.throughput_by_actor: Dict[str, ThroughputEstimator] = dict()
         self.tarmaxfilesize = self.config.ray['tarmaxfilesize']
+        self.tarminfillratio = self.config.ray.get('tarminfillratio', 0.)
         self.logging_actor.debug.remote("BookKeeper", f"Num_finished: start_time {self.start_time}", time.asctime())
 
     def get_ranges_to_tar(self) -> List[List[Dict]]:
@@ -73,6 +121,52 @@ class BookKeeper(object):
         """
         return self.ranges_to_tar_by_input_file
 
+    def pack_ranges(self, ranges: List[Dict]) -> List[List[Dict]]:
+        """
+        Distribute event ranges outputs to tar files of at most tarmaxfilesize bytes using best-fit decreasing bin
+        packing: outputs are taken from the largest to the smallest and put in the tar file with the least space left
+        that can still hold them. An output larger than tarmaxfilesize is put alone in its tar file.
+
+        Args:
+            ranges: event ranges outputs to pack, with their 'fsize'
+
+        Returns:
+            List of tar files content, fullest first
+        """
+        bins: List[List[Dict]] = list()
+        bins_size: List[int] = list()
+        # (space left, bin index) of the bins which can hold more outputs, sorted by space left
+        free_space: List[Tuple[int, int]] = list()
+        for event_range in sorted(ranges, key=lambda r: r['fsize'], reverse=True):
+            fsize = event_range['fsize']
+            i = bisect_left(free_space, (fsize, -1))
+            if i < len(free_space):
+                space_left, bin_index = free_space.pop(i)
+                bins[bin_index].append(event_range)
+                bins_size[bin_index] += fsize
+                if space_left > fsize:
+                    insort(free_space, (space_left - fsize, bin_index))
+            else:
+                bins.append([event_range])
+                bins_size.append(fsize)
+                if fsize < self.tarmaxfilesize:
+                    insort(free_space, (self.tarmaxfilesize - fsize, len(bins) - 1))
+        return [bins[i] for i in sorted(range(len(bins)), key=lambda i: bins_size[i], reverse=True)]
+
+    def is_draining(self, panda_id: str) -> bool:
+        """
+        Checks if a job is draining: harvester has no more event ranges for this job and all of its ranges have been
+        assigned to actors
+
+        Args:
+            panda_id: job worker_id to check
+
+        Returns:
+            True if the job is draining
+        """
+        job_ranges = self.jobs.get_event_ranges(panda_id)
+        return not job_ranges.nranges_available() and self.is_flagged_no_more_events(panda_id)
+
     def create_ranges_to_tar(self) -> bool:
         """
         using the event ranges organized by input file in ranges_to_tar_by_input_file
@@ -80,6 +174,9 @@ class BookKeeper(object):
         update the dictionary of event Ranges to be written to tar files organized by input files
         removing the event ranges event Range lists organized by input files
 
+        Outputs of each input file are packed with pack_ranges(). Tar files filled below ray.tarminfillratio of
+        tarmaxfilesize are not created, their ranges being kept for the next call, unless the job is draining.
+
         Args:
              None:
 
@@ -89,26 +186,23 @@ class BookKeeper(object):
         return_val = False
         self.logging_actor.debug.remote("BookKeeper", f"Enter create_ranges_to_tar self.tarmaxfilesize: {self.tarmaxfilesize}", time.asctime())
         self.logging_actor.debug.remote("BookKeeper", f" self.ranges_to_tar_by_input_file: {repr(self.ranges_to_tar_by_input_file)}", time.asctime())
+        min_tar_size = self.tarminfillratio * self.tarmaxfilesize
         # loop over input file names and process the list
         try:
             self.ranges_to_tar = []
-            for input_file in self.ranges_to_tar_by_input_file:
-                total_file_size = 0
-                file_list = []
+            for input_file, ranges in self.ranges_to_tar_by_input_file.items():
+                if not ranges:
+                    continue
                 self.logging_actor.debug.remote("BookKeeper",
-                                                f"input file value : {input_file} {len(self.ranges_to_tar_by_input_file[input_file])}", time.asctime())
-                while self.ranges_to_tar_by_input_file[input_file]:
-                    event_range = self.ranges_to_tar_by_input_file[input_file].pop()
-                    if total_file_size + event_range['fsize'] > self.tarmaxfilesize:
-                        # reached the size limit
-                        self.ranges_to_tar_by_input_file[input_file].append(event_range)
+                                                f"input file value : {input_file} {len(ranges)}", time.asctime())
+                flush = self.is_draining(ranges[0]['PanDAID'])
+                held_back = list()
+                for file_list in self.pack_ranges(ranges):
+                    if flush or sum(r['fsize'] for r in file_list) >= min_tar_size:
                         self.ranges_to_tar.append(file_list)
-                        total_file_size = 0
-                        file_list = []
                     else:
-                        total_file_size = total_file_size + event_range['fsize']
-                        file_list.append(event_range)
-                self.ranges_to_tar.append(file_list)
+                        held_back.extend(file_list)
+                self.ranges_to_tar_by_input_file[input_file] = held_back
             if len(self.ranges_to_tar) > 0:
                 return_val = True
             self.logging_actor.debug.remote("BookKeeper", f"create_ranges_to_tar :# {len(self.ranges_to_tar)} {repr(self.ranges_to_tar)}", time.asctime())
@@ -141,23 +235,157 @@ class BookKeeper(object):
         Returns:
             None
         """
-        self.jobs.process_event_ranges_reply(event_ranges)
+        self._log_ingest(event_ranges, self.jobs.process_event_ranges_reply(event_ranges))
 
-    def add_finished_event_ranges(self) -> None:
+    def ingest_event_ranges(self, event_ranges: Dict[str, List[EventRangeTypeHint]]) -> None:
         """
-        Add Number of finished event ranges to finished_by_time list.
-        Each entry is the list (time stamp (time.time()), job_ranges.nranges_done()
+        Add event ranges to the ranges queue of their job without updating the state of jobs, so that ranges can be
+        added from the communicator thread while the driver thread uses the BookKeeper. Jobs for which harvester has
+        no more ranges should then be flagged from the driver thread with add_event_ranges().
+
+        Args:
+            event_ranges: event ranges dict as returned by harvester
+
+        Returns:
+            None
+        """
+        self._log_ingest(event_ranges, self.jobs.concat_event_ranges(event_ranges))
+
+    def _log_ingest(self, event_ranges: Dict[str, List[EventRangeTypeHint]], duplicates: Dict[str, int]) -> None:
+        """
+        Log re-delivered ranges and spill statistics after event ranges were added to jobs
+
+        Args:
+            event_ranges: event ranges dict as returned by harvester
+            duplicates: number of re-delivered ranges by job
+
+        Returns:
+            None
+        """
+        for panda_id, nduplicates in duplicates.items():
+            self.logging_actor.warn.remote(
+                "BookKeeper",
+                f"{nduplicates} re-delivered ranges for job {panda_id}, total: {self.jobs.get_event_ranges(panda_id).ingest_stats}",
+                time.asctime())
+        for panda_id in event_ranges:
+            job_ranges = self.jobs.get_event_ranges(panda_id)
+            if job_ranges is not None and job_ranges.spill_stats.spilled:
+                self.logging_actor.debug.remote("BookKeeper", f"Spill stats for job {panda_id}: {job_ranges.spill_stats}", time.asctime())
+
+    def recover_finished_ranges(self, outputs: Dict[str, str]) -> Dict[str, Dict[str, str]]:
+        """
+        Mark ranges which were not assigned yet but have an output left by a previous run as finished. Outputs which
+        are not in a zip file yet are queued to be tarred like outputs of ranges finished by actors. Recovered ranges
+        are removed from outputs, outputs of ranges unknown to every job are kept for later replies.
 
         Args:
+            outputs: path of the output file or of the zip file holding the output of each range id
+
+        Returns:
+            dict of path of the output of each recovered range id, by job
+        """
+        recovered = dict()
+        for panda_id in self.jobs:
+            job_ranges = self.jobs.get_event_ranges(panda_id)
+            if job_ranges is None:
+                continue
+            range_ids = [range_id for range_id in outputs if job_ranges.get_range_state(range_id) == EventRange.READY]
+            if not range_ids:
+                continue
+            # finished ranges may be collapsed by the update, look up their input file beforehand
+            input_files = {range_id: job_ranges[range_id].file_basename for range_id in range_ids}
+            job_ranges.update_ranges_states(range_ids, [EventRange.DONE] * len(range_ids))
+            recovered[panda_id] = dict()
+            for range_id in range_ids:
+                path = outputs.pop(range_id)
+                recovered[panda_id][range_id] = path
+                file_basename = input_files[range_id]
+                if file_basename not in self.finished_range_by_input_file:
+                    self.finished_range_by_input_file[file_basename] = RangeIDSet()
+                self.finished_range_by_input_file[file_basename].add(range_id)
+                if not path.endswith(".zip"):
+                    self.ranges_to_tar_by_input_file.setdefault(file_basename, list()).append({
+                        'eventRangeID': range_id,
+                        'eventStatus': EventRange.DONE,
+                        'path': path,
+                        'fsize': os.path.getsize(path),
+                        'PanDAID': panda_id
+                    })
+            self.logging_actor.info.remote(
+                "BookKeeper", f"Recovered {len(range_ids)} ranges of job {panda_id} from a previous run", time.asctime())
+        return recovered
+
+    def close(self) -> None:
+        """
+        Release on-disk resources held by the jobs event ranges queues
+
+        Returns:
             None
+        """
+        for panda_id in self.jobs:
+            job_ranges = self.jobs.get_event_ranges(panda_id)
+            if job_ranges is not None:
+                job_ranges.close()
+
+    def _on_range_transition(self, event_range: EventRange, old_state: str, new_state: str, timestamp: float) -> None:
+        """
+        Update the number of ranges and events in each state after an event range changed state
+
+        Args:
+            event_range: range which changed state
+            old_state: previous state of the range
+            new_state: new state of the range
+            timestamp: time of the transition
 
         Returns:
             None
         """
-        nfinished = 0
-        for pandaID in self.jobs:
-            job_ranges = self.jobs.get_event_ranges(pandaID)
-            nfinished = nfinished + job_ranges.nranges_done()
+        nevents = event_range.nevents()
+        if old_state in self.nranges_by_state:
+            self.nranges_by_state[old_state] -= 1
+            self.nevents_by_state[old_state] -= nevents
+        if new_state in self.nranges_by_state:
+            self.nranges_by_state[new_state] += 1
+            self.nevents_by_state[new_state] += nevents
+        # ranges which were not processed by an actor, e.g. recovered from a previous run, don't count in throughput
+        actor_id = self.actor_by_rangeID.get(event_range.eventRangeID)
+        if new_state == EventRange.DONE and actor_id is not None:
+            for estimator in (self.throughput, self.throughput_by_job.get(self.actors.get(actor_id)),
+                              self.throughput_by_actor.get(actor_id)):
+                if estimator is not None:
+                    estimator.add(1, nevents)
+
+    def nranges_done(self) -> int:
+        """
+        Number of event ranges of all jobs which finished successfully
+
+        Returns:
+            Number of finished event ranges
+        """
+        return self.nranges_by_state[EventRange.DONE]
+
+    def nevents_done(self) -> int:
+        """
+        Number of events in the event ranges of all jobs which finished successfully
+
+        Returns:
+            Number of finished events
+        """
+        return self.nevents_by_state[EventRange.DONE]
+
+    def add_finished_event_ranges(self) -> bool:
+        """
+        Add Number of finished event ranges to finished_by_time list.
+        Each entry is the list (time stamp (time.time()), nranges_done()
+        Throughput estimates are updated each time an entry is added.
+
+        Args:
+            None
+
+        Returns:
+            True if an entry was added, False otherwise
+        """
+        nfinished = self.nranges_done()
         # get the previous time stamp
         time_tuple = self.finished_by_time[-1]
         time_stamp = time_tuple[0]
@@ -170,6 +398,69 @@ class BookKeeper(object):
             self.logging_actor.debug.remote("BookKeeper",
                                             f"add to finished_by_time {len(self.finished_by_time)} time_tuple:  {time_tuple} ",
                                             time.asctime())
+            self.throughput.sample(now)
+            for estimator in chain(self.throughput_by_job.values(), self.throughput_by_actor.values()):
+                estimator.sample(now)
+            return True
+        return False
+
+    def get_job_throughput(self, panda_id: str) -> Union[ThroughputEstimator, None]:
+        """
+        Retrieve the throughput estimator of a job
+
+        Args:
+            panda_id: job worker_id
+
+        Returns:
+            the throughput estimator, None if no range of the job has been assigned to an actor yet
+        """
+        return self.throughput_by_job.get(panda_id)
+
+    def get_throughput_status(self) -> Dict[str, Any]:
+        """
+        Build a summary of the estimated throughput of the cluster, of each job and of each actor, with the projected
+        number of seconds needed to process the events of READY ranges. With ray.walltime set, also checks whether
+        the events of READY ranges can be processed before the end of the allocation.
+
+        Returns:
+            dict with the throughput summary
+        """
+        now = time.time()
+        jobs = dict()
+        nevents_ready = 0
+        for panda_id, estimator in self.throughput_by_job.items():
+            job_ranges = self.jobs.get_event_ranges(panda_id)
+            job_nevents_ready = job_ranges.nevents_available()
+            nevents_ready += job_nevents_ready
+            jobs[panda_id] = {
+                **estimator.to_dict(),
+                "ranges_ready": job_ranges.nranges_available(),
+                "events_ready": job_nevents_ready,
+                "ranges_done": job_ranges.nranges_done(),
+                "no_more_events": self.is_flagged_no_more_events(panda_id),
+                "time_to_complete": estimator.time_to_complete(job_nevents_ready)
+            }
+        actors = {actor_id: {**estimator.to_dict(), "job": self.actors.get(actor_id)}
+                  for actor_id, estimator in self.throughput_by_actor.items()}
+        time_to_complete = self.throughput.time_to_complete(nevents_ready)
+        status = {
+            "time": now,
+            "elapsed": now - self.start_time,
+            "cluster": {
+                **self.throughput.to_dict(),
+                "ranges_done": self.nranges_done(),
+                "events_done": self.nevents_done(),
+                "events_ready": nevents_ready,
+                "time_to_complete": time_to_complete
+            },
+            "jobs": jobs,
+            "actors": actors
+        }
+        if self.walltime:
+            walltime_left = self.start_time + self.walltime - now
+            status["walltime_left"] = walltime_left
+            status["drains_before_walltime"] = None if time_to_complete is None else time_to_complete <= walltime_left
+        return status
 
     def have_finished_events(self) -> bool:
         """
@@ -181,11 +472,7 @@ class BookKeeper(object):
         Returns:
             True if any event ranges requests have finished, False otherwise
         """
-        nfinished = 0
-        for pandaID in self.jobs:
-            job_ranges = self.jobs.get_event_ranges(pandaID)
-            nfinished = nfinished + job_ranges.nranges_done()
-        return nfinished > 0
+        return self.nranges_done() > 0
 
     def has_jobs_ready(self) -> bool:
         """
@@ -195,7 +482,20 @@ class BookKeeper(object):
             True if a job is ready to be processed by a worker
         """
         job_id, _ = self.jobs.next_job_id_to_process()
-        return job_id is not None
+        return job_id is not None or self._next_job_id_to_retry() is not None
+
+    def _next_job_id_to_retry(self) -> Union[str, None]:
+        """
+        Retrieve a job holding requeued event ranges. Requeued ranges are not counted as available by the job queue,
+        this makes sure they are processed even if no actor is assigned to their job anymore.
+
+        Returns:
+            job worker_id, None if no job has requeued ranges
+        """
+        for panda_id, retry_ranges in self.retry_ranges.items():
+            if retry_ranges:
+                return panda_id
+        return None
 
     def assign_job_to_actor(self, actor_id: str) -> Union[PandaJob, None]:
         """
@@ -208,33 +508,219 @@ class BookKeeper(object):
             job worker_id of assigned job, None if no job is available
         """
         job_id, nranges = self.jobs.next_job_id_to_process()
+        if not job_id:
+            job_id = self._next_job_id_to_retry()
         if job_id:
             self.actors[actor_id] = job_id
         return self.jobs[job_id] if job_id else None
 
-    def fetch_event_ranges(self, actor_id: str, n: int) -> List[EventRange]:
+    def fetch_event_ranges(self, actor_id: str, n: int, nevents: int = None,
+                           at_least_one: bool = True) -> List[EventRange]:
         """
         Retrieve event ranges for an actor. The specified actor should have a job assigned from assign_job_to_actor().
         If the job assigned to the actor doesn't have enough range currently available, it will assign all of its ranges
         to the worker without trying to get new ranges from harvester.
 
+        With file affinity enabled, ranges are taken from input files already read by the actor first, then from files
+        not read by any other actor, and only then from files already read by other actors.
+
         Args:
             actor_id: actor requesting event ranges
             n: number of event ranges to assign to the actor
+            nevents: maximum number of events to assign to the actor, see EventRangeQueue.get_next_ranges()
+            at_least_one: assign one range even if it has more than nevents events
 
         Returns:
             A list of event ranges to be processed by the actor
         """
         if actor_id not in self.actors or not self.actors[actor_id]:
             return list()
-        if actor_id not in self.rangesID_by_actor:
-            self.rangesID_by_actor[actor_id] = list()
-        ranges = self.jobs.get_event_ranges(
-            self.actors[actor_id]).get_next_ranges(n)
+        job_ranges = self.jobs.get_event_ranges(self.actors[actor_id])
+        # requeued ranges are assigned first
+        ranges = self._fetch_retry_ranges(actor_id, n, nevents, at_least_one)
+        n -= len(ranges)
+        if nevents is not None and ranges:
+            nevents -= sum(r.nevents() for r in ranges)
+        at_least_one = at_least_one and not ranges
+        if n > 0 and (nevents is None or nevents > 0):
+            if not self.file_affinity:
+                ranges += job_ranges.get_next_ranges(n, nevents=nevents, at_least_one=at_least_one)
+            else:
+                actor_files = self.files_by_actor.setdefault(actor_id, dict())
+                ranges += job_ranges.get_next_ranges(n, preferred_files=list(actor_files),
+                                                     avoided_files=self.actors_by_file, nevents=nevents,
+                                                     at_least_one=at_least_one)
+                for r in ranges:
+                    if r.file_basename not in actor_files:
+                        actor_files[r.file_basename] = None
+                        self.actors_by_file.setdefault(r.file_basename, dict())[actor_id] = None
+        if ranges and actor_id not in self.throughput_by_actor:
+            self.throughput_by_actor[actor_id] = ThroughputEstimator(self.throughput_halflife)
+        if ranges and self.actors[actor_id] not in self.throughput_by_job:
+            self.throughput_by_job[self.actors[actor_id]] = ThroughputEstimator(self.throughput_halflife)
+        actor_ranges = self.rangesID_by_actor.setdefault(actor_id, dict())
         for r in ranges:
-            self.rangesID_by_actor[actor_id].append(r.eventRangeID)
+            actor_ranges[r.eventRangeID] = None
+            self.actor_by_rangeID[r.eventRangeID] = actor_id
         return ranges
 
+    def _release_range(self, actor_id: str, range_id: str) -> None:
+        """
+        Remove an event range from the ranges assigned to an actor
+
+        Args:
+            actor_id: actor to which the range is assigned
+            range_id: range to remove
+
+        Returns:
+            None
+        """
+        self.rangesID_by_actor[actor_id].pop(range_id, None)
+        if self.actor_by_rangeID.get(range_id) == actor_id:
+            del self.actor_by_rangeID[range_id]
+
+    def get_actor_of_range(self, range_id: str) -> Union[str, None]:
+        """
+        Retrieve the actor processing an event range
+
+        Args:
+            range_id: event range id
+
+        Returns:
+            worker_id of the actor to which the range is assigned, None if the range is not assigned to an actor
+        """
+        return self.actor_by_rangeID.get(range_id)
+
+    def _fetch_retry_ranges(self, actor_id: str, n: int, nevents: int = None,
+                            at_least_one: bool = True) -> List[EventRange]:
+        """
+        Retrieve requeued event ranges of the job assigned to an actor whose retry delay expired. Ranges are not given
+        back to an actor which already failed them unless every actor processing the job did. The retry delay is
+        ignored once the job has no other range to process.
+
+        Args:
+            actor_id: actor requesting event ranges
+            n: maximum number of event ranges to assign to the actor
+            nevents: maximum number of events to assign to the actor
+            at_least_one: assign one range even if it has more than nevents events
+
+        Returns:
+            A list of requeued event ranges, already in the ASSIGNED state
+        """
+        panda_id = self.actors[actor_id]
+        retry_ranges = self.retry_ranges.get(panda_id)
+        if not retry_ranges:
+            return list()
+        job_ranges = self.jobs.get_event_ranges(panda_id)
+        draining = self.is_draining(panda_id)
+        job_actors = {a for a, p in self.actors.items() if p == panda_id}
+        now = time.time()
+        ranges = list()
+        n_events = 0
+        for range_id, not_before in list(retry_ranges.items()):
+            if len(ranges) >= n:
+                break
+            if not_before > now and not draining:
+                continue
+            failed_actors = self.failed_actors_by_range.get(range_id, ())
+            if actor_id in failed_actors and not job_actors.issubset(failed_actors):
+                continue
+            event_range = job_ranges[range_id]
+            if nevents is not None and (ranges or not at_least_one) and n_events + event_range.nevents() > nevents:
+                break
+            n_events += event_range.nevents()
+            del retry_ranges[range_id]
+            ranges.append(event_range)
+        if ranges:
+            self.logging_actor.info.remote(
+                "BookKeeper", f"Assigning {len(ranges)} requeued ranges to {actor_id}", time.asctime())
+        return ranges
+
+    def _requeue_range(self, panda_id: str, range_id: str, actor_id: str, delay: float) -> None:
+        """
+        Take back an event range from an actor and hold it until it can be assigned to another actor. The range
+        stays in the ASSIGNED state while it is held.
+
+        Args:
+            panda_id: job the range belongs to
+            range_id: range to requeue
+            actor_id: actor that failed to process the range
+            delay: minimum number of seconds before the range can be assigned again
+
+        Returns:
+            None
+        """
+        self.failed_actors_by_range.setdefault(range_id, set()).add(actor_id)
+        self.retry_ranges.setdefault(panda_id, dict())[range_id] = time.time() + delay
+
+    def _requeue_failed_ranges(self, actor_id: str, panda_id: str, event_ranges_update: EventRangeUpdate) -> None:
+        """
+        Apply the retry policy to the ranges reported as failed by an actor. Ranges which can still be retried are
+        requeued and removed from the update, they stay assigned until they are given to another actor.
+
+        Args:
+            actor_id: actor worker_id that sent the update
+            panda_id: job of the actor
+            event_ranges_update: range update sent by the payload
+
+        Returns:
+            None
+        """
+        if not self.max_retries:
+            return
+        job_ranges = self.jobs.get_event_ranges(panda_id)
+        retried = set()
+        for r in event_ranges_update[panda_id]:
+            range_id = r.get('eventRangeID')
+            if (r.get('eventStatus') != EventRange.FAILED or self.actor_by_rangeID.get(range_id) != actor_id or
+                    job_ranges.get_range_state(range_id) != EventRange.ASSIGNED):
+                continue
+            retry = job_ranges[range_id].retry
+            if retry < self.max_retries:
+                job_ranges.increment_retry(range_id)
+                self._requeue_range(panda_id, range_id, actor_id, self.retry_backoff * 2 ** retry)
+                self._release_range(actor_id, range_id)
+                retried.add(range_id)
+        if retried:
+            event_ranges_update[panda_id] = [r for r in event_ranges_update[panda_id]
+                                             if r.get('eventRangeID') not in retried]
+            self.logging_actor.warn.remote(
+                "BookKeeper", f"Requeued failed ranges {sorted(retried)} of job {panda_id}", time.asctime())
+
+    def _release_updated_ranges(self, actor_id: str, panda_id: str, event_ranges_update: EventRangeUpdate,
+                                finished_files: Dict[str, str]) -> None:
+        """
+        Release the ranges of an actor which reached a final state after an update. Finished ranges are queued to be
+        tarred by input file.
+
+        Args:
+            actor_id: actor worker_id that sent the update
+            panda_id: job of the actor
+            event_ranges_update: range update applied to the job
+            finished_files: input file of each range reported as finished by the actor
+
+        Returns:
+            None
+        """
+        job_ranges = self.jobs.get_event_ranges(panda_id)
+        for r in event_ranges_update[panda_id]:
+            range_id = r.get('eventRangeID')
+            if range_id in finished_files and job_ranges.get_range_state(range_id) == EventRange.DONE:
+                file_basename = finished_files.pop(range_id)
+                self._release_range(actor_id, range_id)
+                if file_basename not in self.finished_range_by_input_file:
+                    self.finished_range_by_input_file[file_basename] = RangeIDSet()
+                if file_basename not in self.ranges_to_tar_by_input_file:
+                    self.ranges_to_tar_by_input_file[file_basename] = list()
+                self.finished_range_by_input_file[file_basename].add(range_id)
+                r['PanDAID'] = panda_id
+                self.ranges_to_tar_by_input_file[file_basename].append(r)
+            elif (r.get('eventStatus') in (EventRange.FAILED, EventRange.FATAL) and
+                  self.actor_by_rangeID.get(range_id) == actor_id and
+                  job_ranges.get_range_state(range_id) == r.get('eventStatus')):
+                # failed ranges are not given back to another actor when this actor ends
+                self._release_range(actor_id, range_id)
+
     def process_event_ranges_update(
         self, actor_id: str, event_ranges_update: Union[dict, EventRangeUpdate]
     ) -> Union[EventRangeUpdate, None]:
@@ -258,23 +744,21 @@ class BookKeeper(object):
                 panda_id, event_ranges_update)
         self.logging_actor.debug.remote(
             "BookKeeper", f"Built rangeUpdate: {event_ranges_update}", time.asctime())
-        self.jobs.process_event_ranges_update(event_ranges_update)
         job_ranges = self.jobs.get_event_ranges(panda_id)
-
+        # finished ranges may be collapsed by the update, look up their input file beforehand
+        finished_files = dict()
         for r in event_ranges_update[panda_id]:
-            if 'eventRangeID' in r and r['eventRangeID'] in self.rangesID_by_actor[actor_id]:
-                range_id = r['eventRangeID']
-                if r['eventStatus'] == EventRange.DONE:
-                    self.rangesID_by_actor[actor_id].remove(range_id)
-                    event_range = job_ranges[range_id]
-                    file_basename = os.path.basename(event_range.PFN)
-                    if file_basename not in self.finished_range_by_input_file:
-                        self.finished_range_by_input_file[file_basename] = list()
-                    if file_basename not in self.ranges_to_tar_by_input_file:
-                        self.ranges_to_tar_by_input_file[file_basename] = list()
-                    self.finished_range_by_input_file[file_basename].append(r)
-                    r['PanDAID'] = panda_id
-                    self.ranges_to_tar_by_input_file[file_basename].append(r)
+            range_id = r.get('eventRangeID')
+            if (r.get('eventStatus') == EventRange.DONE and self.actor_by_rangeID.get(range_id) == actor_id and
+                    range_id in job_ranges.event_ranges_by_id):
+                finished_files[range_id] = job_ranges[range_id].file_basename
+        self._requeue_failed_ranges(actor_id, panda_id, event_ranges_update)
+        summaries = self.jobs.process_event_ranges_update(event_ranges_update)
+        for job_id, summary in summaries.items():
+            if summary.rejected:
+                self.logging_actor.warn.remote(
+                    "BookKeeper", f"Rejected invalid update for ranges {summary.rejected} of job {job_id}", time.asctime())
+        self._release_updated_ranges(actor_id, panda_id, event_ranges_update, finished_files)
 
         log_message = "ranges_to_tar_by_input_file : "
         for input_file, ranges in self.ranges_to_tar_by_input_file.items():
@@ -298,21 +782,29 @@ class BookKeeper(object):
 
         return event_ranges_update
 
-    def process_actor_end(self, actor_id: str) -> None:
+    def process_actor_end(self, actor_id: str, crashed: bool = False) -> Union[EventRangeUpdate, None]:
         """
         Performs clean-up of event ranges when an actor ends. Event ranges still assigned to this actor
-        that did not receive an update are marked as available again
+        that did not receive an update are marked as available again. If the actor crashed, they are requeued to be
+        processed by another actor when the retry policy is enabled, and ranges left behind by maxcrashes crashed
+        actors are quarantined in the FATAL state.
 
         Args:
             actor_id: worker_id of actor that ended
+            crashed: True if the actor ended abnormally
 
         Returns:
-            None
+            update reporting quarantined ranges as fatal to harvester, None if no range was quarantined
         """
+        for file_name in self.files_by_actor.pop(actor_id, ()):
+            actors = self.actors_by_file[file_name]
+            del actors[actor_id]
+            if not actors:
+                del self.actors_by_file[file_name]
         panda_id = self.actors.get(actor_id, None)
         if not panda_id:
             return
-        actor_ranges = self.rangesID_by_actor.get(actor_id, None)
+        actor_ranges = list(self.rangesID_by_actor.pop(actor_id, ()))
         if not actor_ranges:
             return
         self.logging_actor.warn.remote(
@@ -323,10 +815,33 @@ class BookKeeper(object):
             self.logging_actor.warn.remote(
                 "BookKeeper",
                 f"{actor_id} finished without processing range {rangeID}", time.asctime())
-            self.jobs.get_event_ranges(panda_id).update_range_state(
-                rangeID, EventRange.READY)
-        actor_ranges.clear()
+        job_ranges = self.jobs.get_event_ranges(panda_id)
+        ready = list()
+        quarantined = list()
+        for range_id in actor_ranges:
+            if self.actor_by_rangeID.get(range_id) == actor_id:
+                del self.actor_by_rangeID[range_id]
+            if not crashed:
+                ready.append(range_id)
+                continue
+            crashes = self.crashes_by_range.get(range_id, 0) + 1
+            self.crashes_by_range[range_id] = crashes
+            if self.max_crashes and crashes >= self.max_crashes:
+                quarantined.append(range_id)
+            elif self.max_retries:
+                self._requeue_range(panda_id, range_id, actor_id, 0)
+            else:
+                ready.append(range_id)
+        job_ranges.update_ranges_states(ready, [EventRange.READY] * len(ready))
         self.actors[actor_id] = None
+        if not quarantined:
+            return None
+        job_ranges.update_ranges_states(quarantined, [EventRange.FATAL] * len(quarantined))
+        self.logging_actor.error.remote(
+            "BookKeeper",
+            f"Quarantined ranges {quarantined} of job {panda_id} after {self.max_crashes} crashes", time.asctime())
+        return EventRangeUpdate({panda_id: [{'eventRangeID': range_id, 'eventStatus': EventRange.FATAL}
+                                            for range_id in quarantined]})
 
     def n_ready(self, panda_id: str) -> int:
         """
@@ -340,6 +855,18 @@ class BookKeeper(object):
         """
         return self.jobs.get_event_ranges(panda_id).nranges_available()
 
+    def n_ready_events(self, panda_id: str) -> int:
+        """
+        Checks how many events in ranges that can be assigned to workers are available for a given job.
+
+        Args:
+            panda_id: job worker_id to check
+
+        Returns:
+            Number of events in ranges that can be assigned to a worker
+        """
+        return self.jobs.get_event_ranges(panda_id).nevents_available()
+
     def is_flagged_no_more_events(self, panda_id: str) -> bool:
         """
         Checks if a job could potentially receive more event ranges from harvester
@@ -353,6 +880,28 @@ class BookKeeper(object):
         return self.jobs[panda_id].no_more_ranges
 
 
+class RangesIngestQueue(Queue):
+    """
+    Queue passed to the communicator in place of the event ranges queue to ingest harvester replies directly from the
+    communicator thread. Ranges are added to the ranges queues of the jobs when a reply is put in the queue, the driver
+    thread then only gets the number of ranges received for each job and updates the jobs state.
+    """
+
+    def __init__(self, bookkeeper: BookKeeper) -> None:
+        """
+        Init the queue
+
+        Args:
+            bookkeeper: bookkeeper to which event ranges are added
+        """
+        super().__init__()
+        self.bookkeeper = bookkeeper
+
+    def put(self, item: Dict[str, List[EventRangeTypeHint]], block: bool = True, timeout: float = None) -> None:
+        self.bookkeeper.ingest_event_ranges(item)
+        super().put({panda_id: len(ranges) for panda_id, ranges in item.items()}, block, timeout)
+
+
 class ESDriver(BaseDriver):
     """
     The driver is managing all the ray workers and handling the communication with Harvester. It keeps tracks of
@@ -380,7 +929,6 @@ class ESDriver(BaseDriver):
 
         self.requests_queue = Queue()
         self.jobs_queue = Queue()
-        self.event_ranges_queue = Queue()
 
         self.logging_actor.debug.remote(self.id,
                                         f"Driver initialized, running Ray {ray.__version__}", time.asctime())
@@ -398,6 +946,11 @@ class ESDriver(BaseDriver):
         self.cpu_monitor = CPUMonitor(os.path.join(workdir, "cpu_monitor_driver.json"))
         self.cpu_monitor.start()
 
+        self.bookKeeper = BookKeeper(self.logging_actor, config)
+        # ingest harvester replies from the communicator thread, the driver thread only receives ranges counts
+        self.concurrent_ingest = self.config.ray.get('concurrentingest', False)
+        self.event_ranges_queue = RangesIngestQueue(self.bookKeeper) if self.concurrent_ingest else Queue()
+
         registry = PluginsRegistry()
         self.communicator_class = registry.get_plugin(self.config.harvester['communicator'])
 
@@ -411,7 +964,8 @@ class ESDriver(BaseDriver):
                                         "Sent job request to harvester", time.asctime())
         self.actors = dict()
         self.actors_message_queue = list()
-        self.bookKeeper = BookKeeper(self.logging_actor, config)
+        # actor which will send each pending message, used to identify actors that failed
+        self.actor_by_message: Dict[ray.ObjectRef, str] = dict()
         self.terminated = list()
         self.running = True
         self.n_eventsrequest = 0
@@ -429,6 +983,14 @@ class ESDriver(BaseDriver):
         self.finished_tar_tasks = set()
         self.tarcheck_timestamp = time.time()
         self.tarcheckinterval = self.config.ray['tarcheckinterval']
+        # outputs left in the workdir by a previous run, by range id
+        self.reconcile = self.config.ray.get('reconcileoutputs', True)
+        self.recovered_outputs: Dict[str, str] = dict()
+        # event ranges requests are sized to keep actors busy for this number of seconds at the measured throughput
+        self.ranges_lookahead = self.config.ray.get('rangeslookahead', self.config.ray['monitortime'])
+        # throughput and projected time to completion, updated every monitortime seconds
+        self.status_file = os.path.expandvars(self.config.ray.get('statusfile',
+                                                                  os.path.join(self.workdir, "status.json")))
 
         self.tar_executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.tarmaxprocesses)
 
@@ -488,8 +1050,22 @@ class ESDriver(BaseDriver):
         Returns:
             None
         """
-        for actor in self.actors.values():
-            self.actors_message_queue.append(actor.get_message.remote())
+        for actor_id, actor in self.actors.items():
+            self.queue_actor_message(actor_id, actor.get_message.remote())
+
+    def queue_actor_message(self, actor_id: str, message: ray.ObjectRef) -> None:
+        """
+        Wait on the next message sent by an actor
+
+        Args:
+            actor_id: actor sending the message
+            message: reference to the result of the actor task returning the message
+
+        Returns:
+            None
+        """
+        self.actor_by_message[message] = actor_id
+        self.actors_message_queue.append(message)
 
     def create_actors(self) -> None:
         """
@@ -528,14 +1104,14 @@ class ESDriver(BaseDriver):
             self.logging_actor.debug.remote(
                 self.id, f"Start handling messages batch of {len(new_messages)} actors", time.asctime())
             for ray_message_id in new_messages:
+                sender_id = self.actor_by_message.pop(ray_message_id, None)
                 try:
                     actor_id, message, data = ray.get(ray_message_id)
                 except Exception as e:
-                    self.handle_actor_exception(e)
+                    self.handle_actor_exception(sender_id, e)
                 else:
                     if message == Messages.IDLE or message == Messages.REPLY_OK:
-                        self.actors_message_queue.append(
-                            self[actor_id].get_message.remote())
+                        self.queue_actor_message(actor_id, self[actor_id].get_message.remote())
                     elif message == Messages.REQUEST_NEW_JOB:
                         self.handle_job_request(actor_id)
                     elif message == Messages.REQUEST_EVENT_RANGES:
@@ -584,12 +1160,12 @@ class ESDriver(BaseDriver):
         if has_jobs:
             self.logging_actor.info.remote(
                 self.id, f"More jobs to be processed by {actor_id}", time.asctime())
-            self.actors_message_queue.append(self[actor_id].mark_new_job.remote())
+            self.queue_actor_message(actor_id, self[actor_id].mark_new_job.remote())
         else:
             self.logging_actor.info.remote(
                 self.id, f" no more job for {actor_id}", time.asctime())
             self.terminated.append(actor_id)
-            self.bookKeeper.process_actor_end(actor_id)
+            self.end_actor(actor_id)
             # do not get new messages from this actor
         return has_jobs
 
@@ -612,7 +1188,7 @@ class ESDriver(BaseDriver):
         # self.logging_actor.debug.remote(self.id, f"handle_update_event_ranges: eventranges_update - {len(eventranges_update)}", time.asctime())
         # self.logging_actor.debug.remote(self.id, f"handle_update_event_ranges: eventranges_update - {str(eventranges_update)}", time.asctime())
         # self.requests_queue.put(eventranges_update)
-        self.actors_message_queue.append(self[actor_id].get_message.remote())
+        self.queue_actor_message(actor_id, self[actor_id].get_message.remote())
 
     def handle_update_job(self, actor_id: str, data: Any) -> None:
         """
@@ -627,8 +1203,7 @@ class ESDriver(BaseDriver):
         """
         self.logging_actor.info.remote(
             self.id, f"{actor_id} sent a job update", time.asctime())
-        self.actors_message_queue.append(
-            self[actor_id].get_message.remote())
+        self.queue_actor_message(actor_id, self[actor_id].get_message.remote())
 
     def handle_request_event_ranges(self, actor_id: str, data: Any, total_sent: int) -> int:
         """
@@ -643,10 +1218,15 @@ class ESDriver(BaseDriver):
         """
         panda_id = self.bookKeeper.actors[actor_id]
         n_ranges = data[panda_id]['nRanges']
+        # requests sized in events are filled up to nEvents, nRanges only caps the number of ranges
+        n_events = data[panda_id].get('nEvents')
         evt_range = self.bookKeeper.fetch_event_ranges(
-            actor_id, n_ranges)
-        # did not fetch enough event and harvester might have more, needs to get more events now
+            actor_id, n_ranges, n_events)
+        # did not fetch enough event and harvester might have more, needs to get more events now. nRanges caps the
+        # number of ranges in both modes. Ranges left READY did not fit in the nEvents left to assign
         while (len(evt_range) < n_ranges and
+               (n_events is None or sum(r.nevents() for r in evt_range) < n_events) and
+               not self.bookKeeper.n_ready(panda_id) and
                not self.bookKeeper.is_flagged_no_more_events(
                    panda_id)):
             self.logging_actor.debug.remote(
@@ -655,7 +1235,9 @@ class ESDriver(BaseDriver):
             )
             self.request_event_ranges(block=True)
             evt_range += self.bookKeeper.fetch_event_ranges(
-                actor_id, n_ranges - len(evt_range))
+                actor_id, n_ranges - len(evt_range),
+                None if n_events is None else n_events - sum(r.nevents() for r in evt_range),
+                at_least_one=not evt_range)
         if evt_range:
             total_sent += len(evt_range)
             self.logging_actor.info.remote(
@@ -665,9 +1247,9 @@ class ESDriver(BaseDriver):
         else:
             self.logging_actor.info.remote(
                 self.id, f"No more ranges to send to {actor_id}", time.asctime())
-        self.actors_message_queue.append(self[actor_id].receive_event_ranges.remote(
+        self.queue_actor_message(actor_id, self[actor_id].receive_event_ranges.remote(
             Messages.REPLY_OK if evt_range else
-            Messages.REPLY_NO_MORE_EVENT_RANGES, evt_range))
+            Messages.REPLY_NO_MORE_EVENT_RANGES, EventRangeBatch(evt_range)))
         return total_sent
 
     def handle_job_request(self, actor_id: str) -> None:
@@ -689,10 +1271,54 @@ class ESDriver(BaseDriver):
                 self.id, f"Sending job {job.get_id()} to {actor_id}", time.asctime())
         else:
             self.logging_actor.info.remote(self.id, f"No jobs available for {actor_id}", time.asctime())
-        self.actors_message_queue.append(self[actor_id].receive_job.remote(
+        self.queue_actor_message(actor_id, self[actor_id].receive_job.remote(
             Messages.REPLY_OK
             if job else Messages.REPLY_NO_MORE_JOBS, job))
 
+    def add_job_event_request(self, event_request: EventRangeRequest, pandaID: str) -> int:
+        """
+        Adds a request for more event ranges of a job to the harvester request if the job doesn't have enough ranges
+        available. The job should keep enough ranges to feed every core of the nodes and to sustain its measured
+        throughput for ranges_lookahead seconds.
+
+        Args:
+            event_request: request sent to harvester
+            pandaID: job to request event ranges for
+
+        Returns:
+            number of event ranges targeted for the job based on its core count
+        """
+        n_available_ranges = self.bookKeeper.n_ready(pandaID)
+        job = self.bookKeeper.jobs[pandaID]
+        # each pilot will request for 'coreCount * 2' event ranges
+        # and we use an additional safety factor of 2
+        n_events = int(job['coreCount']) * len(self.nodes) * 2 * 2
+        self.logging_actor.debug.remote(
+            self.id, f"Calculate num event ranges - {n_events} = {int(job['coreCount'])} * {len(self.nodes)} * 2 * 2 ", time.asctime())
+        throughput = self.bookKeeper.get_job_throughput(pandaID)
+        events_per_core = self.config.resources.get('eventspercore')
+        if events_per_core:
+            # target expressed in events, converted to ranges using the average size of the available ranges
+            n_target_events = n_events * events_per_core
+            if throughput is not None and throughput.events_rate:
+                n_target_events = max(n_target_events, math.ceil(throughput.events_rate * self.ranges_lookahead))
+            n_available_events = self.bookKeeper.n_ready_events(pandaID)
+            if n_available_events < n_target_events:
+                events_per_range = n_available_events / n_available_ranges if n_available_ranges else 1
+                event_request.add_event_request(pandaID,
+                                                max(1, math.ceil(n_target_events / events_per_range)),
+                                                job['taskID'],
+                                                job['jobsetID'])
+            return n_events
+        if throughput is not None and throughput.ranges_rate:
+            n_events = max(n_events, math.ceil(throughput.ranges_rate * self.ranges_lookahead))
+        if n_available_ranges < n_events:
+            event_request.add_event_request(pandaID,
+                                            n_events,
+                                            job['taskID'],
+                                            job['jobsetID'])
+        return n_events
+
     def request_event_ranges(self, block: bool = False) -> None:
         """
         If no event range request is ongoing, checks if any jobs needs more ranges, and if so,
@@ -716,18 +1342,8 @@ class ESDriver(BaseDriver):
                         f"Job {pandaID} has no more events. Skipping request...", time.asctime()
                     )
                     continue
-                n_available_ranges = self.bookKeeper.n_ready(pandaID)
                 job = self.bookKeeper.jobs[pandaID]
-                # each pilot will request for 'coreCount * 2' event ranges
-                # and we use an additional safety factor of 2
-                n_events = int(job['coreCount']) * len(self.nodes) * 2 * 2
-                self.logging_actor.debug.remote(
-                    self.id, f"Calculate num event ranges - {n_events} = {int(job['coreCount'])} * {len(self.nodes)} * 2 * 2 ", time.asctime())
-                if n_available_ranges < n_events:
-                    event_request.add_event_request(pandaID,
-                                                    n_events,
-                                                    job['taskID'],
-                                                    job['jobsetID'])
+                n_events = self.add_job_event_request(event_request, pandaID)
 
             if len(event_request) > 0:
                 self.logging_actor.debug.remote(
@@ -742,14 +1358,20 @@ class ESDriver(BaseDriver):
                                                 "received reply from harvester", time.asctime())
                 n_received_events = 0
                 for pandaID, ranges_list in ranges.items():
-                    n_received_events += len(ranges_list)
-                    self.logging_actor.debug.remote(self.id, f"got ranges for pandaID {pandaID}: {len(ranges_list)}", time.asctime())
+                    n_ranges = ranges_list if self.concurrent_ingest else len(ranges_list)
+                    n_received_events += n_ranges
+                    self.logging_actor.debug.remote(self.id, f"got ranges for pandaID {pandaID}: {n_ranges}", time.asctime())
                 if self.first_event_range_request:
                     self.first_event_range_request = False
                     if (n_received_events < int(job['coreCount']) * len(self.nodes)):
                         self.logging_actor.error.remote(self.id, "Got too few events initially. Exiting...", time.asctime())
                         self.stop()
-                self.bookKeeper.add_event_ranges(ranges)
+                if not self.concurrent_ingest:
+                    self.bookKeeper.add_event_ranges(ranges)
+                else:
+                    # ranges were ingested by the communicator thread, only flag jobs without more ranges
+                    self.bookKeeper.add_event_ranges({pandaID: [] for pandaID, n_ranges in ranges.items() if not n_ranges})
+                self.reconcile_outputs()
                 self.n_eventsrequest -= 1
             except Empty:
                 pass
@@ -770,9 +1392,36 @@ class ESDriver(BaseDriver):
             self.get_tar_results(skip_time_check = True)
             self.logging_actor.info.remote(self.id, "no more events available and some workers are already idle. Shutting down...", time.asctime())
             self.stop()
-        self.bookKeeper.add_finished_event_ranges()
+        if self.bookKeeper.add_finished_event_ranges():
+            self.write_status()
         self.request_event_ranges()
 
+    def write_status(self) -> None:
+        """
+        Write the throughput estimates and projected time to completion of the jobs to the status file. The file is
+        replaced atomically so that it can be read at any time.
+
+        Returns:
+            None
+        """
+        status = self.bookKeeper.get_throughput_status()
+        cluster = status["cluster"]
+        self.logging_actor.info.remote(
+            self.id,
+            f"Throughput: {cluster['events_per_sec']} events/s, {cluster['events_ready']} events ready, "
+            f"projected time to completion: {cluster['time_to_complete']}s", time.asctime())
+        if status.get("drains_before_walltime") is False:
+            self.logging_actor.warn.remote(
+                self.id,
+                f"Ready events will not be processed before walltime, {status['walltime_left']}s left", time.asctime())
+        tmp_file = f"{self.status_file}.tmp"
+        try:
+            with open(tmp_file, 'w') as f:
+                jsoncodec.dump(status, f)
+            os.replace(tmp_file, self.status_file)
+        except OSError as e:
+            self.logging_actor.warn.remote(self.id, f"Failed to write status file {self.status_file}: {e}", time.asctime())
+
     def cleanup(self) -> None:
         """
         Notify each worker that it should terminate then wait for actor to acknowledge
@@ -809,6 +1458,9 @@ class ESDriver(BaseDriver):
                                         f"Received reply to the job request:\n{jobs}", time.asctime())
         self.bookKeeper.add_jobs(jobs)
 
+        if self.reconcile:
+            self.index_outputs()
+
         # sends an initial event range request
         self.request_event_ranges(block=True)
         if not self.bookKeeper.has_jobs_ready():
@@ -822,7 +1474,7 @@ class ESDriver(BaseDriver):
         for pandaID in self.bookKeeper.jobs:
             cjob = self.bookKeeper.jobs[pandaID]
             os.makedirs(
-                os.path.join(self.config.ray['workdir'], cjob['PandaID']))
+                os.path.join(self.config.ray['workdir'], cjob['PandaID']), exist_ok=True)
 
         self.create_actors()
 
@@ -838,6 +1490,7 @@ class ESDriver(BaseDriver):
 
         self.communicator.stop()
         self.cpu_monitor.stop()
+        self.bookKeeper.close()
 
         self.logging_actor.debug.remote(
             self.id, "Communicator and cpu_monitor stopped.", time.asctime())
@@ -859,18 +1512,116 @@ class ESDriver(BaseDriver):
         self.running = False
         self.cleanup()
 
-    def handle_actor_exception(self, ex: Exception) -> None:
+    def handle_actor_exception(self, actor_id: Union[str, None], ex: Exception) -> None:
         """
-        Handle exception that occurred in an actor process
+        Handle exception that occurred in an actor process or actor death. The actor is not sent new messages and
+        the event ranges it was processing are released.
 
         Args:
+            actor_id: actor which was expected to send the message, None if unknown
             ex: exception raised in actor process
 
         Returns:
             None
         """
-        self.logging_actor.info.remote(self.id, f"Caught exception in actor {ex}", time.asctime())
-        pass
+        self.logging_actor.info.remote(self.id, f"Caught exception in actor {actor_id}: {ex}", time.asctime())
+        if actor_id in self.bookKeeper.actors:
+            self.end_actor(actor_id, crashed=True)
+
+    def end_actor(self, actor_id: str, crashed: bool = False) -> None:
+        """
+        Release the event ranges held by an actor which ended. Ranges quarantined after crashing too many actors are
+        reported as fatal to harvester.
+
+        Args:
+            actor_id: actor which ended
+            crashed: True if the actor ended abnormally
+
+        Returns:
+            None
+        """
+        event_ranges_update = self.bookKeeper.process_actor_end(actor_id, crashed)
+        if event_ranges_update is not None:
+            self.requests_queue.put(event_ranges_update)
+
+    def index_outputs(self) -> None:
+        """
+        Index the outputs left in the workdir by a previous run so that their ranges are not processed again. Outputs
+        are indexed by the range id ending their file name, see output_range_id(). Outputs in esOutput
+        and merge_es_files directories still need to be tarred, outputs in zip files of merge_es_output only need to be
+        reported to harvester.
+
+        Returns:
+            None
+        """
+        es_files = glob.glob(os.path.join(self.workdir, "*", "*", "esOutput", "*"))
+        es_files.extend(glob.glob(os.path.join(self.tar_merge_es_files_dir, "*")))
+        for path in es_files:
+            range_id = ESDriver.output_range_id(path)
+            if range_id:
+                self.recovered_outputs[range_id] = path
+        # zip files are only renamed once created, es files they hold were moved to merge_es_files
+        zip_files = glob.glob(os.path.join(self.tar_merge_es_output_dir, "*.zip"))
+        for path in zip_files:
+            try:
+                with tarfile.open(path) as tar:
+                    names = tar.getnames()
+            except Exception as ex:
+                self.logging_actor.warn.remote(self.id, f"index_outputs: can not read {path}: {ex}", time.asctime())
+                continue
+            for name in names:
+                range_id = ESDriver.output_range_id(name)
+                if range_id:
+                    self.recovered_outputs[range_id] = path
+        if es_files or zip_files:
+            self.logging_actor.info.remote(
+                self.id, f"index_outputs: found {len(es_files)} outputs and {len(zip_files)} zip files from a previous run",
+                time.asctime())
+
+    @staticmethod
+    def output_range_id(path: str) -> Union[str, None]:
+        """
+        Extract the event range id from the name of an event service output, which ends with the id of the range,
+        e.g. HITS.pool.root.<eventRangeID>
+
+        Args:
+            path: path or name of the output file
+
+        Returns:
+            the range id, None if the file name doesn't end with a range id
+        """
+        range_id = os.path.basename(path).rsplit(".", 1)[-1]
+        # range ids are made of dash-separated components
+        return range_id if "-" in range_id else None
+
+    def reconcile_outputs(self) -> None:
+        """
+        Mark ranges with an output from a previous run as finished before they are assigned to an actor. Ranges whose
+        output is already in a zip file are reported to harvester, the others are tarred with the next batch.
+
+        Returns:
+            None
+        """
+        if not self.recovered_outputs:
+            return
+        recovered = self.bookKeeper.recover_finished_ranges(self.recovered_outputs)
+        for panda_id, outputs in recovered.items():
+            ranges_by_zip = dict()
+            for range_id, path in outputs.items():
+                if path.endswith(".zip"):
+                    ranges_by_zip.setdefault(path, list()).append({'eventRangeID': range_id})
+            for path, range_list in ranges_by_zip.items():
+                result = self.create_harvester_data(panda_id, path, self.calc_adler32(path), os.path.getsize(path),
+                                                    range_list)
+                if self.check_for_duplicates(result):
+                    self.requests_queue.put(EventRangeUpdate(result))
+        # all ranges have been received, remaining outputs don't match any range
+        if all(self.bookKeeper.is_flagged_no_more_events(panda_id) for panda_id in self.bookKeeper.jobs
+               if self.bookKeeper.jobs[panda_id].is_eventservice()):
+            self.logging_actor.info.remote(
+                self.id, f"reconcile_outputs: {len(self.recovered_outputs)} outputs from a previous run left unmatched",
+                time.asctime())
+            self.recovered_outputs.clear()
 
     def create_tar_file(self, range_list: list) -> Dict[str, List[Dict]]:
         """
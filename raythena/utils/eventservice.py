@@ -1,7 +1,23 @@
+import functools
 import json
 import os
+import re
+import sqlite3
+import struct
+import sys
+import tempfile
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from collections import deque
+from heapq import heappush, heappop
+from itertools import chain, islice
+from urllib.parse import parse_qs
 
-from typing import Union, Tuple, Dict, List, Iterator
+from typing import Union, Tuple, Dict, List, Set, Iterator, Callable, Sequence, Collection
+
+from raythena.utils import jsoncodec
 
 
 # Messages sent by ray actor to the driver
@@ -22,6 +38,42 @@ class Messages(object):
     REPLY_NO_MORE_JOBS = 202
 
 
+def es_json_default(o: object) -> Union[dict, list]:
+    """
+    Convert event service data structures to objects that can be encoded to json. Used as the default hook of the
+    json codec.
+
+    Args:
+        o: object to serialize to json
+
+    Returns:
+        o converted to a dict
+
+    Raises:
+        TypeError if the type of the object is unknown
+    """
+    if isinstance(o, EventRange):
+        return o.to_dict()
+    if isinstance(o, PandaJob):
+        return o.job
+    if isinstance(o, PandaJobQueue):
+        return o.jobs
+    if isinstance(o, EventRangeQueue):
+        return dict(o.items())
+
+    if isinstance(o, PandaJobUpdate):
+        return o.to_dict()
+    if isinstance(o, EventRangeUpdate):
+        return o.range_update
+
+    if isinstance(o, PandaJobRequest):
+        return o.to_dict()
+    if isinstance(o, EventRangeRequest):
+        return o.request
+
+    raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+
 class ESEncoder(json.JSONEncoder):
     """
     JSON Encoder supporting serialization of event service data structures.
@@ -36,27 +88,10 @@ class ESEncoder(json.JSONEncoder):
         Returns:
             o encoded to json
         """
-        if isinstance(o, PandaJobQueue):
-            return o.jobs
-        if isinstance(o, EventRangeQueue):
-            return o.event_ranges_by_id
-
-        if isinstance(o, PandaJobUpdate):
-            return o.to_dict()
-        if isinstance(o, EventRangeUpdate):
-            return o.range_update
-
-        if isinstance(o, PandaJobRequest):
-            return o.to_dict()
-        if isinstance(o, EventRangeRequest):
-            return o.request
-
-        if isinstance(o, PandaJob):
-            return o.job
-        if isinstance(o, EventRange):
-            return o.to_dict()
-
-        return super().default(o)
+        try:
+            return es_json_default(o)
+        except TypeError:
+            return super().default(o)
 
 
 class PandaJobQueue(object):
@@ -69,11 +104,32 @@ class PandaJobQueue(object):
     }
 
     See PandaJob doc for the <jobspec> format
+
+    Non event service jobs waiting to be distributed are kept in a FIFO. Event service jobs are kept in a max-heap keyed
+    by their number of available ranges. Each EventRangeQueue notifies the job queue when its number of READY ranges
+    changes, the job is then re-inserted in the heap with its new count the next time a job is selected and
+    outdated heap entries are discarded lazily.
+
+    Observers registered with subscribe() are subscribed to the EventRangeQueue of every event service job, including
+    jobs added later, see EventRangeQueue.subscribe().
     """
 
-    def __init__(self, jobs: dict = None) -> None:
+    def __init__(self, jobs: dict = None, ranges_queue_factory: Callable[[], 'EventRangeQueue'] = None) -> None:
+        """
+        Init the queue
+
+        Args:
+            jobs: jobs dict as returned by harvester
+            ranges_queue_factory: callable used to create the EventRangeQueue of each job. Defaults to EventRangeQueue
+        """
         self.jobs = dict()
-        self.distributed_jobs_ids = list()
+        self.distributed_jobs_ids = set()
+        self.ranges_queue_factory = ranges_queue_factory
+        self._jobs_order: Dict[str, int] = dict()
+        self._pending_jobs_ids = deque()
+        self._ready_heap: List[Tuple[int, int, str]] = list()
+        self._updated_jobs_ids = set()
+        self._observers: List[Callable[['EventRange', str, str, float], None]] = list()
 
         if jobs:
             self.add_jobs(jobs)
@@ -83,7 +139,7 @@ class PandaJobQueue(object):
 
     def __setitem__(self, k: str, v: 'PandaJob') -> None:
         if isinstance(v, PandaJob):
-            self.jobs[k] = v
+            self._register_job(k, v)
         else:
             raise Exception(f"{v} is not of type {PandaJob}")
 
@@ -110,30 +166,87 @@ class PandaJobQueue(object):
             return None
         return self.jobs[job_id]
 
+    def _register_job(self, job_id: str, job: 'PandaJob') -> None:
+        """
+        Add a job to the queue and to the index used for job selection
+
+        Args:
+            job_id: job worker_id
+            job: the job to add
+
+        Returns:
+            None
+        """
+        self.jobs[job_id] = job
+        if job_id not in self._jobs_order:
+            self._jobs_order[job_id] = len(self._jobs_order)
+        if job.is_eventservice():
+            job.event_ranges_queue.ready_count_listener = functools.partial(self._updated_jobs_ids.add, job_id)
+            for observer in self._observers:
+                job.event_ranges_queue.subscribe(observer)
+            self._updated_jobs_ids.add(job_id)
+        elif job_id not in self.distributed_jobs_ids:
+            self._pending_jobs_ids.append(job_id)
+
+    def subscribe(self, observer: Callable[['EventRange', str, str, float], None]) -> None:
+        """
+        Register a callable notified of each state transition of the event ranges of all event service jobs
+
+        Args:
+            observer: called with (event_range, old_state, new_state, timestamp) after each transition
+
+        Returns:
+            None
+        """
+        self._observers.append(observer)
+        for job in self.jobs.values():
+            if job.is_eventservice():
+                job.event_ranges_queue.subscribe(observer)
+
+    def unsubscribe(self, observer: Callable[['EventRange', str, str, float], None]) -> None:
+        """
+        Stop notifying an observer registered with subscribe()
+
+        Args:
+            observer: observer to remove
+
+        Returns:
+            None
+        """
+        self._observers.remove(observer)
+        for job in self.jobs.values():
+            if job.is_eventservice():
+                job.event_ranges_queue.unsubscribe(observer)
+
     def next_job_id_to_process(self) -> Tuple[Union[str, None], int]:
         """
         Retrieve the job worker_id and number of events available for the next job to process.
-        Event service jobs with the most events available are chosen first, followed by non event-service jobs.
+        Non event-service jobs which haven't been distributed yet are chosen first, in FIFO order,
+        followed by event service jobs with the most events available.
 
         Returns:
             Tuple of (job worker_id, nb event ranges) or (None, 0)
         """
-        max_job_id = None
-        max_avail = 0
-
-        if len(self.jobs) == 0:
-            return max_job_id, max_avail
-
-        for jobID, job in self.jobs.items():
-            if (('eventService' not in job or
-                 job['eventService'].lower() == "false") and
-                    jobID not in self.distributed_jobs_ids):
-                self.distributed_jobs_ids.append(jobID)
-                return jobID, 0
-            if job.nranges_available() > max_avail:
-                max_avail = job.nranges_available()
-                max_job_id = jobID
-        return max_job_id, max_avail
+        while self._pending_jobs_ids:
+            job_id = self._pending_jobs_ids.popleft()
+            if job_id in self.jobs and job_id not in self.distributed_jobs_ids and not self.jobs[job_id].is_eventservice():
+                self.distributed_jobs_ids.add(job_id)
+                return job_id, 0
+
+        # ranges queues may add ids from another thread, pop them one by one instead of iterating
+        while self._updated_jobs_ids:
+            job_id = self._updated_jobs_ids.pop()
+            job = self.jobs.get(job_id)
+            if job is not None and job.nranges_available() > 0:
+                heappush(self._ready_heap, (-job.nranges_available(), self._jobs_order[job_id], job_id))
+
+        while self._ready_heap:
+            neg_avail, _, job_id = self._ready_heap[0]
+            job = self.jobs.get(job_id)
+            if job is not None and job.is_eventservice() and job.nranges_available() == -neg_avail:
+                return job_id, -neg_avail
+            heappop(self._ready_heap)
+        return None, 0
 
     def has_job(self, panda_id: str) -> bool:
         """
@@ -158,7 +271,7 @@ class PandaJobQueue(object):
             None
         """
         for jobID, jobDef in jobs.items():
-            self.jobs[jobID] = PandaJob(jobDef)
+            self._register_job(jobID, PandaJob(jobDef, self.ranges_queue_factory))
 
     def get_event_ranges(self, panda_id: str) -> 'EventRangeQueue':
         """
@@ -174,19 +287,27 @@ class PandaJobQueue(object):
             return self[panda_id].event_ranges_queue
 
     def process_event_ranges_update(self,
-                                    ranges_update: 'EventRangeUpdate') -> None:
+                                    ranges_update: 'EventRangeUpdate') -> Dict[str, 'RangeUpdateSummary']:
         """
-        Update the range status
+        Update the range status. Each job update is applied as a single batch, invalid range updates are rejected
+        and reported in the summary.
+
         Args:
             ranges_update: Range update provided by the payload
 
         Returns:
-            None
+            Summary of the update applied to each job
         """
+        summaries = dict()
         for pandaID in ranges_update:
-            self.get_event_ranges(pandaID).update_ranges(ranges_update[pandaID])
+            job_update = ranges_update[pandaID]
+            summaries[pandaID] = self.get_event_ranges(pandaID).update_ranges_states(
+                [r.get('eventRangeID') for r in job_update],
+                [r.get('eventStatus') for r in job_update],
+                EventRange.PAYLOAD_UPDATABLE_STATES)
+        return summaries
 
-    def process_event_ranges_reply(self, reply: Dict[str, List[Dict]]) -> None:
+    def process_event_ranges_reply(self, reply: Dict[str, List[Dict]]) -> Dict[str, int]:
         """
         Process an event ranges reply from harvester by adding ranges to each corresponding job already present in the
         queue. If an empty event list is received for a job, assume that no more events will be provided for this job
@@ -195,18 +316,35 @@ class PandaJobQueue(object):
             reply: new events received by harvester
 
         Returns:
-            None
+            number of re-delivered ranges in the reply by pandaID, for jobs with at least one re-delivered range
         """
         for pandaID, ranges in reply.items():
-            if pandaID not in self.jobs:
-                continue
-            if not ranges:
+            if pandaID in self.jobs and not ranges:
                 self[pandaID].no_more_ranges = True
-            else:
-                ranges_obj = list()
-                for range_dict in ranges:
-                    ranges_obj.append(EventRange.build_from_dict(range_dict))
-                self.get_event_ranges(pandaID).concat(ranges_obj)
+        return self.concat_event_ranges(reply)
+
+    def concat_event_ranges(self, reply: Dict[str, List[Dict]]) -> Dict[str, int]:
+        """
+        Add the ranges of an event ranges reply from harvester to the ranges queue of each job already present in the
+        queue. Unlike process_event_ranges_reply(), jobs are not flagged when no range is received. Only the ranges
+        queues, which are synchronized, are modified so that ranges can be added from another thread.
+
+        Args:
+            reply: new events received by harvester
+
+        Returns:
+            number of re-delivered ranges in the reply by pandaID, for jobs with at least one re-delivered range
+        """
+        duplicates = dict()
+        for pandaID, ranges in reply.items():
+            if pandaID not in self.jobs or not ranges:
+                continue
+            ranges_queue = self.get_event_ranges(pandaID)
+            before = ranges_queue.ingest_stats.duplicates()
+            ranges_queue.concat_raw(ranges)
+            if ranges_queue.ingest_stats.duplicates() != before:
+                duplicates[pandaID] = ranges_queue.ingest_stats.duplicates() - before
+        return duplicates
 
     @staticmethod
     def build_from_dict(jobs_dict: dict) -> 'PandaJobQueue':
@@ -223,6 +361,18 @@ class PandaJobQueue(object):
         return res
 
 
+def _synchronized(method: Callable) -> Callable:
+    """
+    Decorator running an EventRangeQueue method while holding the queue lock
+    """
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
 class EventRangeQueue(object):
     """
     Each PandaJob has an eventRangeQueue that should be filled from a reply to an event ranges request:
@@ -242,36 +392,191 @@ class EventRangeQueue(object):
         ],
         ...
     }
+
+    Range IDs are indexed by input file then by state in rangesID_by_file. Each state bucket is a dict used as an
+    insertion-ordered set (values are unused) so that state transitions are O(1) while preserving FIFO order.
+
+    Ranges are stored in a dict of EventRange objects by default. For jobs with millions of ranges, a columnar
+    EventRangeStore can be used instead, in which case EventRange objects are only built when they are accessed.
+
+    Files are also bucketed by their number of READY ranges in files_by_ready_count so that get_next_ranges can pick
+    a file without scanning all of them. The file selection policy is one of:
+
+    BEST_FIT: file with the fewest READY ranges that can fulfill the whole request, otherwise the most ready files
+    MOST_READY: files with the most READY ranges first
+    LEAST_READY: files with the fewest READY ranges first, draining files as early as possible
+
+    Ranges reaching one of collapsed_states are considered final: they are removed from event_ranges_by_id and only
+    their id and event numbers are kept in per-file RangeIDSet and IntervalSet, which stay small as long as ranges
+    finish in roughly sequential order. Collapsed ranges are still counted and can be looked up with
+    `range_id in queue` and get_range_state(), but they cannot be accessed or updated anymore.
+
+    Ranges added with concat_raw() are kept as compact (startEvent, lastEvent, (PFN, GUID, scope)) records with the
+    file tuple shared by all ranges of a file. They are READY and indexed like any other range, but the EventRange
+    object is only built when the range is accessed, usually when it is assigned by get_next_ranges(). With a
+    columnar store, these records are written directly to the store instead.
+
+    If spill_dir and memory_budget are set, READY ranges added with concat_raw() once memory_budget READY ranges are
+    held in memory are spilled to a SQLite database in spill_dir. Spilled ranges are counted and indexed by file like
+    the other READY ranges and are reloaded in FIFO order when get_next_ranges() needs them or when they are accessed.
+    Finished ranges are expected to be collapsed with collapsed_states and are never spilled.
+
+    Every range id ever added is recorded in a set of truncated id hashes so that re-delivered ranges can be detected
+    at ingest without looking up the spill database or the collapsed sets for each new range. A re-delivered range
+    replaces the existing range if it is still READY and is dropped otherwise, so that ranges which are assigned or
+    finished are never scheduled again. Both cases are counted in ingest_stats.
+
+    In contiguous mode, READY ranges of each file are also kept sorted by startEvent and each request is served from
+    the longest runs of contiguous events of the selected file, so that the payload reads its input sequentially.
+
+    Public methods accessing or modifying the ranges hold the queue lock so that ranges can be ingested from the
+    communicator thread while the driver thread assigns and updates them. Counters can be read without the lock.
+    ready_count_listener is called with the lock held, after the READY count has been updated.
+
+    Observers registered with subscribe() are called with (event_range, old_state, new_state, timestamp) after each
+    state transition of a range, once the queue has been updated and with the lock held. Ranges added to the queue are
+    not reported. Transitions only cost a truth test of the observers tuple when nobody subscribed.
     """
 
-    def __init__(self) -> None:
+    BEST_FIT = "best_fit"
+    MOST_READY = "most_ready"
+    LEAST_READY = "least_ready"
+    FILE_POLICIES = [BEST_FIT, MOST_READY, LEAST_READY]
+
+    def __init__(self, columnar: bool = False, file_policy: str = BEST_FIT, collapsed_states: Collection[str] = (),
+                 spill_dir: str = None, memory_budget: int = 0, contiguous: bool = False) -> None:
         """
         Init the queue
-        """
-        self.event_ranges_by_id: Dict[str, EventRange] = dict()
-        self.rangesID_by_file: Dict[str, Dict[str, List[str]]] = dict()
 
+        Args:
+            columnar: store ranges in an EventRangeStore instead of a dict of EventRange
+            file_policy: policy used to select the file from which ranges are assigned, one of FILE_POLICIES
+            collapsed_states: final states, e.g. DONE, in which ranges are only kept in interval sets
+            spill_dir: directory in which the spill database is created, spilling is disabled if None
+            memory_budget: number of READY ranges kept in memory before new ranges are spilled, 0 disables spilling
+            contiguous: assign the longest runs of contiguous events of a file instead of the first READY ranges
+        """
+        if file_policy not in EventRangeQueue.FILE_POLICIES:
+            raise Exception(f"Unknown file selection policy '{file_policy}'")
+        self.event_ranges_by_id: Union[Dict[str, EventRange], EventRangeStore] = EventRangeStore() if columnar else dict()
+        self.rangesID_by_file: Dict[str, Dict[str, Dict[str, None]]] = dict()
+        self.range_count_by_state: Dict[str, int] = dict.fromkeys(EventRange.STATES, 0)
+        self.file_policy = file_policy
+        self.files_by_ready_count: Dict[int, Dict[str, None]] = dict()
+        self._ready_counts: List[int] = list()
+        # called without arguments whenever the number of READY ranges changes
+        self.ready_count_listener: Union[Callable[[], None], None] = None
+        # replaced instead of modified so that it can be iterated while observers subscribe
+        self._observers: Tuple[Callable[['EventRange', str, str, float], None], ...] = ()
+        self.collapsed_states = frozenset(collapsed_states)
+        self.collapsed_ids_by_state: Dict[str, RangeIDSet] = {state: RangeIDSet() for state in self.collapsed_states}
+        self.collapsed_ids_by_file: Dict[str, Dict[str, RangeIDSet]] = dict()
+        self.collapsed_events_by_file: Dict[str, Dict[str, IntervalSet]] = dict()
+        self._ncollapsed = 0
+        self._raw_ranges: Dict[str, Tuple[int, int, Tuple[str, str, str]]] = dict()
+        self._raw_files: Dict[Tuple[str, str, str], Tuple[Tuple[str, str, str], str]] = dict()
+        self.spill_dir = spill_dir
+        self.memory_budget = memory_budget if spill_dir is not None else 0
+        self.spill_stats = SpillStats()
+        self._spill_path: Union[str, None] = None
+        self._spill_conn: Union[sqlite3.Connection, None] = None
+        self._spilled_by_file: Dict[str, int] = dict()
+        self._nspilled = 0
+        self.ingest_stats = IngestStats()
+        self._id_hashes: Set[int] = set()
+        self.lock = threading.RLock()
+        self.contiguous = contiguous
+        # (startEvent, lastEvent, eventRangeID) of READY ranges sorted by event, only maintained in contiguous mode
+        self._ready_events_by_file: Dict[str, List[Tuple[int, int, str]]] = dict()
+        self._nevents_ready = 0
+
+    @_synchronized
     def __iter__(self) -> Iterator[str]:
-        return iter(self.event_ranges_by_id)
+        # snapshot the ids as accessing raw ranges while iterating moves them to event_ranges_by_id
+        ids = list(chain(self.event_ranges_by_id, self._raw_ranges))
+        if self._nspilled:
+            ids.extend(row[0] for row in self._spill_conn.execute("SELECT id FROM ranges ORDER BY seq"))
+        return iter(ids)
 
     def __len__(self) -> int:
-        return len(self.event_ranges_by_id)
+        return len(self.event_ranges_by_id) + len(self._raw_ranges) + self._nspilled + self._ncollapsed
 
+    @_synchronized
     def __getitem__(self, k: str) -> 'EventRange':
-        return self.event_ranges_by_id[k]
+        event_range = self._get(k)
+        if event_range is None:
+            raise KeyError(k)
+        return event_range
 
     def __setitem__(self, k: str, v: 'EventRange') -> None:
         if not isinstance(v, EventRange):
             raise Exception(f"{v} should be of type {EventRange}")
         if k != v.eventRangeID:
             raise Exception(f"Specified key '{k}' should be equals to the event range id '{v.eventRangeID}' ")
-        if k in self.event_ranges_by_id:
-            self.rangesID_by_file[self._get_file_from_id(k)][v.status].remove(k)
-            self.event_ranges_by_id.pop(k)
         self.append(v)
 
+    @_synchronized
     def __contains__(self, k: str) -> bool:
-        return k in self.event_ranges_by_id
+        # the spill database is only queried if the range is not found in memory
+        return k in self.event_ranges_by_id or k in self._raw_ranges or \
+            any(k in ids for ids in self.collapsed_ids_by_state.values()) or self._is_spilled(k)
+
+    def items(self) -> Iterator[Tuple[str, 'EventRange']]:
+        """
+        Iterate over ranges which are not collapsed without materializing raw ranges in the queue
+
+        Returns:
+            iterator of (eventRangeID, EventRange)
+        """
+        yield from self.event_ranges_by_id.items()
+        for range_id, raw in self._raw_ranges.items():
+            yield range_id, EventRangeQueue._build_raw(range_id, raw)
+        if self._nspilled:
+            rows = self._spill_conn.execute("SELECT id, start, last, pfn, guid, scope FROM ranges ORDER BY seq")
+            for range_id, start_event, last_event, pfn, guid, scope in rows:
+                yield range_id, EventRange(range_id, start_event, last_event, pfn, guid, scope)
+
+    @staticmethod
+    def _build_raw(range_id: str, raw: Tuple[int, int, Tuple[str, str, str]]) -> 'EventRange':
+        start_event, last_event, (pfn, guid, scope) = raw
+        return EventRange(range_id, start_event, last_event, pfn, guid, scope)
+
+    def _get(self, range_id: str) -> Union['EventRange', None]:
+        event_range = self.event_ranges_by_id.get(range_id)
+        if event_range is not None:
+            return event_range
+        raw = self._raw_ranges.pop(range_id, None)
+        if raw is None and self._is_spilled(range_id):
+            self._reload(range_id=range_id)
+            raw = self._raw_ranges.pop(range_id)
+        if raw is None:
+            return None
+        event_range = EventRangeQueue._build_raw(range_id, raw)
+        self.event_ranges_by_id[range_id] = event_range
+        return event_range
+
+    @_synchronized
+    def get_range_state(self, range_id: str) -> Union[str, None]:
+        """
+        Current state of an event range, including collapsed ranges
+
+        Args:
+            range_id: range to look up
+
+        Returns:
+            the state of the range, None if the range is not in the queue
+        """
+        event_range = self.event_ranges_by_id.get(range_id)
+        if event_range is not None:
+            return event_range.status
+        if range_id in self._raw_ranges:
+            return EventRange.READY
+        for state, ids in self.collapsed_ids_by_state.items():
+            if range_id in ids:
+                return state
+        if self._is_spilled(range_id):
+            return EventRange.READY
+        return None
 
     @staticmethod
     def build_from_list(ranges_list: list) -> 'EventRangeQueue':
@@ -290,8 +595,109 @@ class EventRangeQueue(object):
         return ranges_queue
 
     def _get_file_from_id(self, range_id: str) -> str:
-        return os.path.basename(self.event_ranges_by_id[range_id].PFN)
+        return self[range_id].file_basename
+
+    def _move_file_ready_count(self, file_name: str, old_count: int, new_count: int) -> None:
+        if old_count:
+            files = self.files_by_ready_count[old_count]
+            del files[file_name]
+            if not files:
+                del self.files_by_ready_count[old_count]
+                del self._ready_counts[bisect_left(self._ready_counts, old_count)]
+        if new_count:
+            files = self.files_by_ready_count.get(new_count)
+            if files is None:
+                files = dict()
+                self.files_by_ready_count[new_count] = files
+                insort(self._ready_counts, new_count)
+            files[file_name] = None
+        if self.ready_count_listener is not None:
+            self.ready_count_listener()
+
+    def _add_to_bucket(self, file_name: str, range_id: str, state: str, start_event: int, last_event: int) -> None:
+        bucket = self.rangesID_by_file[file_name][state]
+        bucket[range_id] = None
+        self.range_count_by_state[state] += 1
+        if state == EventRange.READY:
+            self._nevents_ready += last_event - start_event + 1
+            if self.contiguous:
+                insort(self._ready_events_by_file.setdefault(file_name, list()), (start_event, last_event, range_id))
+            count = len(bucket) + self._spilled_by_file.get(file_name, 0)
+            self._move_file_ready_count(file_name, count - 1, count)
+
+    def _collapse(self, event_range: 'EventRange') -> None:
+        file_name = event_range.file_basename
+        state = event_range.status
+        if file_name not in self.collapsed_ids_by_file:
+            self.collapsed_ids_by_file[file_name] = {s: RangeIDSet() for s in self.collapsed_states}
+            self.collapsed_events_by_file[file_name] = {s: IntervalSet() for s in self.collapsed_states}
+        self.collapsed_ids_by_state[state].add(event_range.eventRangeID)
+        self.collapsed_ids_by_file[file_name][state].add(event_range.eventRangeID)
+        self.collapsed_events_by_file[file_name][state].add(event_range.startEvent, event_range.lastEvent)
+        if event_range.eventRangeID in self.event_ranges_by_id:
+            del self.event_ranges_by_id[event_range.eventRangeID]
+        self.range_count_by_state[state] += 1
+        self._ncollapsed += 1
+
+    def _set_state(self, event_range: 'EventRange', new_state: str) -> None:
+        file_name = event_range.file_basename
+        old_state = event_range.status
+        self._remove_from_bucket(file_name, event_range.eventRangeID, old_state,
+                                 event_range.startEvent, event_range.lastEvent)
+        event_range.status = new_state
+        if new_state in self.collapsed_states:
+            self._collapse(event_range)
+        else:
+            # write back the range so that the new state is persisted by columnar stores
+            self.event_ranges_by_id[event_range.eventRangeID] = event_range
+            self._add_to_bucket(file_name, event_range.eventRangeID, new_state,
+                                event_range.startEvent, event_range.lastEvent)
+        if self._observers:
+            timestamp = time.time()
+            for observer in self._observers:
+                observer(event_range, old_state, new_state, timestamp)
+
+    @_synchronized
+    def subscribe(self, observer: Callable[['EventRange', str, str, float], None]) -> None:
+        """
+        Register a callable notified of each state transition of the ranges in the queue
+
+        Args:
+            observer: called with (event_range, old_state, new_state, timestamp) after each transition
+
+        Returns:
+            None
+        """
+        self._observers = self._observers + (observer,)
+
+    @_synchronized
+    def unsubscribe(self, observer: Callable[['EventRange', str, str, float], None]) -> None:
+        """
+        Stop notifying an observer registered with subscribe()
+
+        Args:
+            observer: observer to remove
 
+        Returns:
+            None
+        """
+        observers = list(self._observers)
+        observers.remove(observer)
+        self._observers = tuple(observers)
+
+    def _remove_from_bucket(self, file_name: str, range_id: str, state: str, start_event: int, last_event: int) -> None:
+        bucket = self.rangesID_by_file[file_name][state]
+        del bucket[range_id]
+        self.range_count_by_state[state] -= 1
+        if state == EventRange.READY:
+            self._nevents_ready -= last_event - start_event + 1
+            if self.contiguous:
+                ready_events = self._ready_events_by_file[file_name]
+                del ready_events[bisect_left(ready_events, (start_event, last_event, range_id))]
+            count = len(bucket) + self._spilled_by_file.get(file_name, 0)
+            self._move_file_ready_count(file_name, count + 1, count)
+
+    @_synchronized
     def update_range_state(self, range_id: str, new_state: str) -> 'EventRange':
         """
         Update the status of an event range
@@ -302,23 +708,79 @@ class EventRangeQueue(object):
         Returns:
             the updated event range
         """
-        if range_id not in self.event_ranges_by_id:
+        event_range = self._get(range_id)
+        if event_range is None:
             raise Exception(
                 f"Trying to update non-existing eventrange {range_id}")
 
-        event_range = self.event_ranges_by_id[range_id]
-        file_name = self._get_file_from_id(range_id)
-
-        self.rangesID_by_file[file_name][event_range.status].remove(range_id)
-        event_range.status = new_state
-        self.rangesID_by_file[file_name][event_range.status].append(range_id)
+        self._set_state(event_range, new_state)
         return event_range
 
+    @_synchronized
+    def increment_retry(self, range_id: str) -> int:
+        """
+        Increment the number of times an event range has been retried
+
+        Args:
+            range_id: range to update
+
+        Returns:
+            the updated number of retries of the range
+        """
+        event_range = self._get(range_id)
+        if event_range is None:
+            raise Exception(
+                f"Trying to update non-existing eventrange {range_id}")
+        event_range.retry += 1
+        # write back the range so that the retry count is persisted by columnar stores
+        self.event_ranges_by_id[range_id] = event_range
+        return event_range.retry
+
+    @_synchronized
+    def update_ranges_states(self, range_ids: Sequence[str], new_states: Sequence[str],
+                             from_states: Collection[str] = None, atomic: bool = False) -> 'RangeUpdateSummary':
+        """
+        Update the status of a batch of event ranges. The whole batch is validated before any range is updated.
+        Updates are rejected if the range doesn't exist, if the new state is unknown, if the range appears more than
+        once in the batch or if its current state is not in from_states. Valid updates are applied even if some
+        updates of the batch were rejected, unless atomic is set.
+
+        Args:
+            range_ids: ranges to update
+            new_states: new state of each range in range_ids
+            from_states: states from which a range can be updated, any state if None
+            atomic: do not apply any update if at least one update is rejected
+
+        Returns:
+            summary with the number of ranges moved to each state and the list of rejected range ids
+        """
+        if len(range_ids) != len(new_states):
+            raise Exception(f"Got {len(range_ids)} range ids but {len(new_states)} states")
+        summary = RangeUpdateSummary()
+        accepted = list()
+        seen = set()
+        for range_id, new_state in zip(range_ids, new_states):
+            event_range = self._get(range_id)
+            if event_range is None or range_id in seen or new_state not in self.range_count_by_state or \
+                    (from_states is not None and event_range.status not in from_states):
+                summary.rejected.append(range_id)
+            else:
+                accepted.append((event_range, new_state))
+            seen.add(range_id)
+        if atomic and summary.rejected:
+            return summary
+
+        for event_range, new_state in accepted:
+            self._set_state(event_range, new_state)
+            summary.counts[new_state] = summary.counts.get(new_state, 0) + 1
+        return summary
+
+    @_synchronized
     def update_ranges(self, ranges_update: List[Dict]) -> None:
         """
-        Process a range update sent by the payload by updating the range status to the new status. It is only
-        possible to update event ranges which are in the assigned, or failed state, trying to update an unassigned or
-         finished range will raise an exception
+        Process a range update sent by the payload by updating the range status to the new status. It is not
+        possible to update event ranges which haven't been assigned, trying to update an unassigned or
+        unknown range will raise an exception and no range of the update will be updated.
 
         Args:
             ranges_update: update sent by the payload
@@ -326,30 +788,26 @@ class EventRangeQueue(object):
         Returns:
             None
         """
-        for r in ranges_update:
-            range_id = r['eventRangeID']
-            range_status = r['eventStatus']
-            if range_id not in self.event_ranges_by_id or \
-                    range_id in self.rangesID_by_file[self._get_file_from_id(range_id)][EventRange.READY]:
-                raise Exception(
-                )
-            self.update_range_state(range_id, range_status)
+        summary = self.update_ranges_states([r['eventRangeID'] for r in ranges_update],
+                                            [r['eventStatus'] for r in ranges_update],
+                                            EventRange.PAYLOAD_UPDATABLE_STATES,
+                                            atomic=True)
+        if summary.rejected:
+            raise Exception(f"Invalid update for event ranges {summary.rejected}")
 
     def _get_ranges_count(self, state: str) -> int:
-        count = 0
-        for ranges in self.rangesID_by_file.values():
-            count += len(ranges[state])
-        return count
+        return self.range_count_by_state[state]
 
     def nranges_remaining(self) -> int:
         """
-        Number of event ranges which are not finished or failed
+        Number of event ranges which are not finished, failed or quarantined
 
         Returns:
-            Number of event ranges which are not finished or failed
+            Number of event ranges which are not finished, failed or quarantined
         """
-        return len(self.event_ranges_by_id) - (self.nranges_done() +
-                                               self.nranges_failed())
+        return len(self) - (self.nranges_done() +
+                            self.nranges_failed() +
+                            self._get_ranges_count(EventRange.FATAL))
 
     def nranges_available(self) -> int:
         """
@@ -360,6 +818,15 @@ class EventRangeQueue(object):
         """
         return self._get_ranges_count(EventRange.READY)
 
+    def nevents_available(self) -> int:
+        """
+        Number of events in the event ranges which can still be assigned to workers
+
+        Returns:
+            Number of events in READY ranges
+        """
+        return self._nevents_ready
+
     def nranges_assigned(self) -> int:
         """
         Number of event ranges currently assigned to a worker
@@ -387,9 +854,11 @@ class EventRangeQueue(object):
         """
         return self._get_ranges_count(EventRange.DONE)
 
+    @_synchronized
     def append(self, event_range: Union[dict, 'EventRange']) -> None:
         """
-        Append a single event range to the queue
+        Append a single event range to the queue. If a range with the same id is already in the queue, it is replaced
+        if it is READY, otherwise the new range is dropped.
 
         Args:
             event_range: event range to add to the queue
@@ -399,18 +868,183 @@ class EventRangeQueue(object):
         """
         if isinstance(event_range, dict):
             event_range = EventRange.build_from_dict(event_range)
+        id_hash = EventRangeQueue._id_hash(event_range.eventRangeID)
+        if id_hash in self._id_hashes:
+            state = self.get_range_state(event_range.eventRangeID)
+            if state is not None and state != EventRange.READY:
+                self.ingest_stats.duplicates_dropped += 1
+                return
+            if state is not None:
+                old_range = self._get(event_range.eventRangeID)
+                self._remove_from_bucket(old_range.file_basename, old_range.eventRangeID, old_range.status,
+                                         old_range.startEvent, old_range.lastEvent)
+                self.ingest_stats.duplicates_replaced += 1
+        else:
+            self._id_hashes.add(id_hash)
+        file_name = event_range.file_basename
+        self._add_file(file_name)
+        if event_range.status in self.collapsed_states:
+            self._collapse(event_range)
+            return
         self.event_ranges_by_id[event_range.eventRangeID] = event_range
-        file_name = self._get_file_from_id(event_range.eventRangeID)
+        self._add_to_bucket(file_name, event_range.eventRangeID, event_range.status,
+                            event_range.startEvent, event_range.lastEvent)
+
+    @staticmethod
+    def _id_hash(range_id: str) -> int:
+        # truncated to stay a small int object, collisions only cost an exact lookup
+        return hash(range_id) & 0x3FFFFFFF
 
+    def _add_file(self, file_name: str) -> None:
         if file_name not in self.rangesID_by_file:
             files_ranges_states = dict()
             self.rangesID_by_file[file_name] = files_ranges_states
             for state in EventRange.STATES:
-                files_ranges_states[state] = list()
+                files_ranges_states[state] = dict()
+
+    @_synchronized
+    def concat_raw(self, ranges: List[dict]) -> None:
+        """
+        Concatenate a list of event ranges sent by harvester to the queue without building EventRange objects.
+        Ranges are added in the READY state, ranges with an id already in the queue are handled by append().
 
-        self.rangesID_by_file[file_name][event_range.status].append(
-            event_range.eventRangeID)
+        Args:
+            ranges: list of event ranges dict to add to the queue
 
+        Returns:
+            None
+        """
+        to_spill: Dict[str, Tuple] = dict()
+        for r in ranges:
+            range_id = r['eventRangeID']
+            if range_id in to_spill:
+                # same id twice in the reply, the last one replaces the spilled row
+                to_spill[range_id] = self._spill_row(range_id, r)
+                self.ingest_stats.duplicates_replaced += 1
+                continue
+            id_hash = EventRangeQueue._id_hash(range_id)
+            if id_hash in self._id_hashes:
+                self.append(r)
+                continue
+            self._id_hashes.add(id_hash)
+            file_tuple, file_name = self._file_entry(r.get('PFN', r.get('LFN', None)), r['GUID'], r['scope'])
+            self._add_file(file_name)
+            if self.memory_budget and (self._spilled_by_file.get(file_name) or
+                                       self.range_count_by_state[EventRange.READY] - self._nspilled >= self.memory_budget):
+                to_spill[range_id] = self._spill_row(range_id, r)
+                count = len(self.rangesID_by_file[file_name][EventRange.READY]) + self._spilled_by_file.get(file_name, 0)
+                self._spilled_by_file[file_name] = self._spilled_by_file.get(file_name, 0) + 1
+                self._nspilled += 1
+                self.range_count_by_state[EventRange.READY] += 1
+                self._nevents_ready += r['lastEvent'] - r['startEvent'] + 1
+                self._move_file_ready_count(file_name, count, count + 1)
+                continue
+            self._add_raw(range_id, r['startEvent'], r['lastEvent'], file_tuple)
+            self._add_to_bucket(file_name, range_id, EventRange.READY, r['startEvent'], r['lastEvent'])
+        if to_spill:
+            self._spill(list(to_spill.values()))
+
+    def _add_raw(self, range_id: str, start_event: int, last_event: int, file_tuple: Tuple[str, str, str]) -> None:
+        if isinstance(self.event_ranges_by_id, EventRangeStore):
+            # columnar stores are as compact as raw records, ranges are written directly to the store
+            self.event_ranges_by_id.add_raw(range_id, start_event, last_event, file_tuple)
+        else:
+            self._raw_ranges[range_id] = (start_event, last_event, file_tuple)
+
+    def _file_entry(self, pfn: str, guid: str, scope: str) -> Tuple[Tuple[str, str, str], str]:
+        file_key = (pfn, guid, scope)
+        file_entry = self._raw_files.get(file_key)
+        if file_entry is None:
+            file_name = EventRange._intern(os.path.basename(pfn)) if isinstance(pfn, str) else None
+            file_entry = (tuple(EventRange._intern(v) for v in file_key), file_name)
+            self._raw_files[file_key] = file_entry
+        return file_entry
+
+    def _spill_row(self, range_id: str, r: dict) -> Tuple:
+        pfn = r.get('PFN', r.get('LFN', None))
+        file_name = self._file_entry(pfn, r['GUID'], r['scope'])[1]
+        return range_id, file_name, r['startEvent'], r['lastEvent'], pfn, r['GUID'], r['scope']
+
+    def _is_spilled(self, range_id: str) -> bool:
+        # ranges pending in concat_raw are counted in _nspilled before the database is created
+        return self._nspilled > 0 and self._spill_conn is not None and \
+            self._spill_conn.execute("SELECT 1 FROM ranges WHERE id = ?", (range_id,)).fetchone() is not None
+
+    def _spill(self, rows: List[Tuple]) -> None:
+        """
+        Write READY ranges to the spill database. Counters and the ready count index should already include them
+
+        Args:
+            rows: (id, file basename, startEvent, lastEvent, PFN, GUID, scope) of each range to spill
+
+        Returns:
+            None
+        """
+        start = time.perf_counter()
+        if self._spill_conn is None:
+            fd, self._spill_path = tempfile.mkstemp(prefix="event_ranges_", suffix=".db", dir=self.spill_dir)
+            os.close(fd)
+            self._spill_conn = sqlite3.connect(self._spill_path, check_same_thread=False)
+            self._spill_conn.execute("PRAGMA journal_mode = OFF")
+            self._spill_conn.execute("PRAGMA synchronous = OFF")
+            self._spill_conn.execute("CREATE TABLE ranges (seq INTEGER PRIMARY KEY AUTOINCREMENT, id TEXT UNIQUE, file TEXT, "
+                                     "start INTEGER, last INTEGER, pfn TEXT, guid TEXT, scope TEXT)")
+            self._spill_conn.execute("CREATE INDEX ranges_file ON ranges (file, seq)")
+        with self._spill_conn:
+            self._spill_conn.executemany("INSERT OR REPLACE INTO ranges (id, file, start, last, pfn, guid, scope) "
+                                         "VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        self.spill_stats.spilled += len(rows)
+        self.spill_stats.spill_time += time.perf_counter() - start
+
+    def _reload(self, file_name: str = None, nranges: int = 0, range_id: str = None) -> None:
+        """
+        Move spilled ranges back in memory, either the first nranges spilled ranges of file_name or range_id.
+        Reloaded ranges are appended to the READY bucket of their file, counters are left unchanged.
+
+        Args:
+            file_name: file from which ranges should be reloaded
+            nranges: number of ranges to reload from file_name
+            range_id: single range to reload
+
+        Returns:
+            None
+        """
+        start = time.perf_counter()
+        if range_id is not None:
+            rows = self._spill_conn.execute("SELECT seq, id, file, start, last, pfn, guid, scope FROM ranges "
+                                            "WHERE id = ?", (range_id,)).fetchall()
+        else:
+            rows = self._spill_conn.execute("SELECT seq, id, file, start, last, pfn, guid, scope FROM ranges "
+                                            "WHERE file IS ? ORDER BY seq LIMIT ?", (file_name, nranges)).fetchall()
+        with self._spill_conn:
+            self._spill_conn.executemany("DELETE FROM ranges WHERE seq = ?", [(row[0],) for row in rows])
+        for _, reloaded_id, reloaded_file, start_event, last_event, pfn, guid, scope in rows:
+            file_tuple, _ = self._file_entry(pfn, guid, scope)
+            self._add_raw(reloaded_id, start_event, last_event, file_tuple)
+            self.rangesID_by_file[reloaded_file][EventRange.READY][reloaded_id] = None
+            if self.contiguous:
+                insort(self._ready_events_by_file.setdefault(reloaded_file, list()), (start_event, last_event, reloaded_id))
+            self._spilled_by_file[reloaded_file] -= 1
+            if not self._spilled_by_file[reloaded_file]:
+                del self._spilled_by_file[reloaded_file]
+        self._nspilled -= len(rows)
+        self.spill_stats.reloaded += len(rows)
+        self.spill_stats.reload_time += time.perf_counter() - start
+
+    @_synchronized
+    def close(self) -> None:
+        """
+        Remove the spill database. Spilled ranges are lost, the queue should no longer be used
+
+        Returns:
+            None
+        """
+        if self._spill_conn is not None:
+            self._spill_conn.close()
+            self._spill_conn = None
+            os.remove(self._spill_path)
+
+    @_synchronized
     def concat(self, ranges: List[Union[dict, 'EventRange']]) -> None:
         """
         Concatenate a list of event ranges to the queue
@@ -424,40 +1058,142 @@ class EventRangeQueue(object):
         for r in ranges:
             self.append(r)
 
-    def _find_file_with_enough_ranges_ready(self, nranges: int) -> Union[None, str]:
-        for file_name, ranges in self.rangesID_by_file.items():
-            if len(ranges[EventRange.READY]) >= nranges:
-                return file_name
+    def _candidate_counts(self, nranges: int, policy: str) -> Iterator[int]:
+        """
+        Ready counts of the index, in the order in which files should be selected by the given policy
+
+        Args:
+            nranges: number of ranges still needed
+            policy: file selection policy
+
+        Returns:
+            iterator over the non-empty ready counts
+        """
+        if policy == EventRangeQueue.LEAST_READY:
+            return iter(self._ready_counts)
+        if policy == EventRangeQueue.MOST_READY:
+            return reversed(self._ready_counts)
+        i = bisect_left(self._ready_counts, nranges)
+        return chain(islice(self._ready_counts, i, None), reversed(self._ready_counts[:i]))
+
+    def _select_file(self, nranges: int, policy: str, avoided_files: Collection[str] = None) -> Union[str, None]:
+        """
+        Select the file from which ranges should be assigned, using the ready count index.
+        Should only be called if at least one range is READY
+
+        Args:
+            nranges: number of ranges still needed
+            policy: file selection policy
+            avoided_files: files which should not be selected
+
+        Returns:
+            name of the file to take ranges from, None if all files with READY ranges are avoided
+        """
+        for count in self._candidate_counts(nranges, policy):
+            for file_name in self.files_by_ready_count[count]:
+                if not avoided_files or file_name not in avoided_files:
+                    return file_name
         return None
 
-    def get_next_ranges(self, nranges: int) -> List['EventRange']:
+    def _ready_ids(self, file_name: str, nranges: int) -> List[str]:
+        """
+        Select the READY ranges of a file which should be assigned next, reloading spilled ranges if needed
+
+        Args:
+            file_name: file to take ranges from
+            nranges: maximum number of ranges to select
+
+        Returns:
+            ids of the selected ranges
+        """
+        bucket = self.rangesID_by_file[file_name][EventRange.READY]
+        if len(bucket) < nranges and self._spilled_by_file.get(file_name):
+            # reload in batches using the memory budget headroom to amortize database queries
+            headroom = self.memory_budget - (self.range_count_by_state[EventRange.READY] - self._nspilled)
+            self._reload(file_name, max(nranges - len(bucket), headroom))
+        return self._contiguous_ids(file_name, nranges) if self.contiguous else list(islice(bucket, nranges))
+
+    def _range_nevents(self, range_id: str) -> int:
+        raw = self._raw_ranges.get(range_id)
+        if raw is not None:
+            return raw[1] - raw[0] + 1
+        return self.event_ranges_by_id[range_id].nevents()
+
+    def _contiguous_ids(self, file_name: str, nranges: int) -> List[str]:
+        """
+        Select READY ranges of a file from the longest runs of contiguous events, the earliest run winning ties
+
+        Args:
+            file_name: file to take ranges from
+            nranges: maximum number of ranges to select
+
+        Returns:
+            ids of the selected ranges
+        """
+        ready_events = self._ready_events_by_file.get(file_name, [])
+        # runs as (-length, first index) so that sorting gives the longest runs first
+        runs = list()
+        run_start = 0
+        for i in range(1, len(ready_events) + 1):
+            if i == len(ready_events) or ready_events[i][0] != ready_events[i - 1][1] + 1:
+                runs.append((run_start - i, run_start))
+                run_start = i
+        runs.sort()
+        ids = list()
+        for neg_length, first in runs:
+            ids.extend(r[2] for r in ready_events[first:min(first - neg_length, first + nranges - len(ids))])
+            if len(ids) == nranges:
+                break
+        return ids
+
+    @_synchronized
+    def get_next_ranges(self, nranges: int, policy: str = None, preferred_files: Sequence[str] = None,
+                        avoided_files: Collection[str] = None, nevents: int = None,
+                        at_least_one: bool = True) -> List['EventRange']:
         """
         Dequeue event ranges. Event ranges which were dequeued are updated to the 'ASSIGNED' status
         and should be assigned to workers to be processed. In case more ranges are requested
-        than there is available, assign all ranges.
+        than there is available, assign all ranges. Within a file, ranges are assigned in FIFO order.
+
+        Ranges are first taken from preferred_files, in order, then from files selected by the policy. Files in
+        avoided_files are only selected once no other file has READY ranges.
+
+        If nevents is set, ranges are assigned until the next range would bring the number of events assigned over
+        nevents, so that requests are sized in events rather than in ranges. At least one range is assigned unless
+        at_least_one is False, e.g. when topping up ranges already assigned.
 
         Args:
             nranges: number of ranges to get
+            policy: file selection policy overriding the queue policy, one of FILE_POLICIES
+            preferred_files: files from which ranges should be assigned first
+            avoided_files: files which should be selected last
+            nevents: maximum number of events to assign
+            at_least_one: assign the next range even if it has more than nevents events
 
         Returns:
             The list of event ranges assigned
         """
         res = list()
         nranges = min(nranges, self.nranges_available())
-
-        file_name = self._find_file_with_enough_ranges_ready(nranges)
-        if file_name:
-            ids = self.rangesID_by_file[file_name][EventRange.READY][:nranges]
-            for range_id in ids:
-                res.append(self.update_range_state(range_id, EventRange.ASSIGNED))
-            return res
-
-        for ranges in self.rangesID_by_file.values():
-            ids = ranges[EventRange.READY][:min(nranges, len(ranges[EventRange.READY]))]
-            for range_id in ids:
+        policy = policy or self.file_policy
+        events_left = nevents
+
+        preferred = iter(preferred_files or ())
+        while len(res) < nranges:
+            file_name = next(preferred, None)
+            if file_name is None:
+                file_name = self._select_file(nranges - len(res), policy, avoided_files)
+                if file_name is None:
+                    file_name = self._select_file(nranges - len(res), policy)
+            elif file_name not in self.rangesID_by_file:
+                continue
+            for range_id in self._ready_ids(file_name, nranges - len(res)):
+                if events_left is not None:
+                    range_events = self._range_nevents(range_id)
+                    if range_events > events_left and (res or not at_least_one):
+                        return res
+                    events_left -= range_events
                 res.append(self.update_range_state(range_id, EventRange.ASSIGNED))
-                if len(res) == nranges:
-                    return res
         return res
 
 
@@ -585,7 +1321,7 @@ class EventRangeUpdate(object):
         return iter(self.range_update)
 
     def __str__(self) -> str:
-        return json.dumps(self.range_update)
+        return jsoncodec.dumps(self.range_update)
 
     def __getitem__(self, k: str) -> List[Dict]:
         return self.range_update[k]
@@ -608,61 +1344,121 @@ class EventRangeUpdate(object):
         Returns:
             EventRangeUpdate parsed to match harvester format
         """
-        update_dict = dict()
-        update_dict[panda_id] = list()
-
         if isinstance(
                 range_update, dict
         ) and "zipFile" not in range_update and "esOutput" not in range_update \
                 and "eventRangeID" not in range_update:
-            range_update = json.loads(range_update['eventRanges'][0])
+            range_update = jsoncodec.loads(range_update['eventRanges'][0])
 
+        return EventRangeUpdate({panda_id: EventRangeUpdate._to_harvester_ranges(range_update)})
+
+    @staticmethod
+    def parse_pilot_update(panda_id: str, body: Union[str, bytes, Dict[str, List[str]]],
+                           rejected: List[str] = None) -> 'EventRangeUpdate':
+        """
+        Parses the body of an updateEventRanges call of pilot 2 to an update in harvester format. The query string and
+        the json document of event ranges it holds are each decoded once, and each range is validated so that malformed
+        updates are rejected before they reach the worker and the driver.
+
+        Args:
+            panda_id: job worker_id associated to the range update
+            body: query string of the request, or the dict returned by parse_qs
+            rejected: if set, malformed ranges are skipped and the reason they were rejected is appended to this list
+                instead of raising, so that the other ranges of the update are kept
+
+        Returns:
+            EventRangeUpdate in harvester format, holding no range if the body has no eventRanges field
+
+        Raises:
+            Exception if the event ranges are not a valid json list, or if a range is malformed and rejected is not set
+        """
+        if isinstance(body, bytes):
+            body = body.decode()
+        if isinstance(body, str):
+            body = parse_qs(body)
+        ranges = body.get('eventRanges')
+        if not ranges:
+            return EventRangeUpdate({panda_id: []})
+        try:
+            range_update = jsoncodec.loads(ranges[0])
+        except Exception as e:
+            raise Exception(f"Event ranges update of job {panda_id} is not valid json: {e}")
+        return EventRangeUpdate({panda_id: EventRangeUpdate._to_harvester_ranges(range_update, rejected)})
+
+    @staticmethod
+    def _to_harvester_ranges(range_update: list, rejected: List[str] = None) -> List[Dict]:
+        """
+        Converts the list of event ranges sent by pilot 2 to the harvester format, validating each range
+
+        Args:
+            range_update: decoded event ranges sent by pilot 2
+            rejected: if set, malformed ranges are skipped and the reason they were rejected is appended to this list
+
+        Returns:
+            list of ranges in harvester format
+
+        Raises:
+            Exception if range_update is not a list, or if a range is malformed and rejected is not set
+        """
+        if not isinstance(range_update, list):
+            raise Exception(f"Expecting a list of event ranges, got {type(range_update).__name__}")
+        ranges = list()
         for range_elt in range_update:
-            if "zipFile" in range_elt and range_elt["zipFile"]:
-                range_update_type = "zipFile"
-                file_info = range_elt.get('zipFile', None)
-            elif "esOutput" in range_elt and range_elt["esOutput"]:
-                range_update_type = "esOutput"
-                file_info = range_elt.get('esOutput', None)
-            else:
-                range_update_type = None
-                file_info = None
-            ranges_info = range_elt.get('eventRanges', None)
-            file_data = dict()
-
-            if file_info:
-                if range_update_type == "esOutput":
-                    ftype = "es_output"
+            try:
+                zip_info = range_elt.get('zipFile')
+                es_info = None if zip_info else range_elt.get('esOutput')
+                if zip_info:
+                    file_data = {'path': zip_info['lfn'], 'chksum': zip_info['adler32'],
+                                 'fsize': int(zip_info['fsize']), 'type': "zip_output"}
+                elif es_info:
+                    file_data = {'type': "es_output"}
                 else:
-                    ftype = "zip_output"
-                    file_data['path'] = file_info['lfn']
-                    file_data['chksum'] = file_info['adler32']
-                    file_data['fsize'] = file_info['fsize']
-                file_data['type'] = ftype
-
-            if ranges_info:
-                for rangeInfo in ranges_info:
-                    elt = dict()
-                    elt['eventRangeID'] = rangeInfo['eventRangeID']
-                    elt['eventStatus'] = rangeInfo['eventStatus']
-                    if range_update_type == "esOutput":
-                        elt['path'] = rangeInfo['pfn']
-                        elt['chksum'] = rangeInfo['adler32']
-                        elt['fsize'] = rangeInfo['fsize']
+                    file_data = None
+                range_infos = list(range_elt['eventRanges'] if 'eventRanges' in range_elt else (range_elt,))
+            except KeyError as e:
+                EventRangeUpdate._reject(rejected, f"Missing field {e} in event range update {range_elt}")
+                continue
+            except (AttributeError, TypeError, ValueError) as e:
+                EventRangeUpdate._reject(rejected, f"Invalid event range update {range_elt}: {e}")
+                continue
+            for range_info in range_infos:
+                try:
+                    elt = {'eventRangeID': range_info['eventRangeID'], 'eventStatus': range_info['eventStatus']}
+                    if elt['eventStatus'] not in EventRange.PAYLOAD_UPDATABLE_STATES:
+                        raise ValueError(f"unknown status '{elt['eventStatus']}'")
+                    if es_info:
+                        elt['path'] = range_info['pfn']
+                        elt['chksum'] = range_info['adler32']
+                        elt['fsize'] = int(range_info['fsize'])
+                except KeyError as e:
+                    EventRangeUpdate._reject(rejected, f"Missing field {e} in event range update {range_info}")
+                    continue
+                except (AttributeError, TypeError, ValueError) as e:
+                    EventRangeUpdate._reject(rejected, f"Invalid event range update {range_info}: {e}")
+                    continue
+                if file_data:
                     elt.update(file_data)
-                    update_dict[panda_id].append(elt)
-            else:
-                elt = dict()
-                elt['eventRangeID'] = range_elt['eventRangeID']
-                elt['eventStatus'] = range_elt['eventStatus']
-                if range_update_type == "esOutput":
-                    elt['path'] = range_elt['pfn']
-                    elt['chksum'] = range_elt['adler32']
-                    elt['fsize'] = range_elt['fsize']
-                elt.update(file_data)
-                update_dict[panda_id].append(elt)
+                ranges.append(elt)
+        return ranges
 
-        return EventRangeUpdate(update_dict)
+    @staticmethod
+    def _reject(rejected: Union[List[str], None], message: str) -> None:
+        """
+        Records a malformed range of a pilot update
+
+        Args:
+            rejected: list of rejected ranges, raise if None
+            message: reason the range was rejected
+
+        Returns:
+            None
+
+        Raises:
+            Exception if rejected is None
+        """
+        if rejected is None:
+            raise Exception(message)
+        rejected.append(message)
 
 
 class PandaJobRequest(object):
@@ -727,6 +1523,8 @@ class EventRangeRequest(object):
         },
         ...
     }
+
+    Requests sent by workers to the driver can also hold "nEvents" to size the request in events instead of ranges.
     """
 
     def __init__(self) -> None:
@@ -742,9 +1540,9 @@ class EventRangeRequest(object):
         return self.request[k]
 
     def __str__(self) -> dict:
-        return json.dumps(self.request)
+        return jsoncodec.dumps(self.request)
 
-    def add_event_request(self, panda_id, n_ranges, task_id, jobset_id) -> None:
+    def add_event_request(self, panda_id, n_ranges, task_id, jobset_id, n_events=None) -> None:
         """
         Adds a job for which event ranges should be requested to the request object
 
@@ -753,6 +1551,7 @@ class EventRangeRequest(object):
             n_ranges: number of ranges to request
             task_id: task worker_id provided in the job specification
             jobset_id: jobset worker_id provided in the job specification
+            n_events: number of events to request, only understood by the driver. n_ranges still caps the request
 
         Returns:
 
@@ -763,6 +1562,8 @@ class EventRangeRequest(object):
             'taskID': task_id,
             'jobsetID': jobset_id
         }
+        if n_events is not None:
+            self.request[panda_id]['nEvents'] = n_events
 
     @staticmethod
     def build_from_dict(request_dict: dict) -> 'EventRangeRequest':
@@ -844,11 +1645,18 @@ class PandaJob(object):
     }
     """
 
-    def __init__(self, job_def: dict) -> None:
+    def __init__(self, job_def: dict, ranges_queue_factory: Callable[[], 'EventRangeQueue'] = None) -> None:
+        """
+        Wraps the job spec
+
+        Args:
+            job_def: job specification as returned by harvester
+            ranges_queue_factory: callable used to create the job EventRangeQueue. Defaults to EventRangeQueue
+        """
         self.job = job_def
         if "PandaID" in self:
             self["PandaID"] = str(self["PandaID"])
-        self.event_ranges_queue = EventRangeQueue()
+        self.event_ranges_queue = ranges_queue_factory() if ranges_queue_factory else EventRangeQueue()
         self._no_more_ranges = False
 
     @property
@@ -865,6 +1673,15 @@ class PandaJob(object):
     def no_more_ranges(self, v: bool) -> None:
         self._no_more_ranges = v
 
+    def is_eventservice(self) -> bool:
+        """
+        Checks if the job is an event service job
+
+        Returns:
+            True if the job spec enables event service
+        """
+        return 'eventService' in self and str(self['eventService']).lower() != "false"
+
     def nranges_available(self) -> int:
         """
         See Also:
@@ -872,12 +1689,19 @@ class PandaJob(object):
         """
         return self.event_ranges_queue.nranges_available()
 
-    def get_next_ranges(self, nranges: int) -> List['EventRange']:
+    def nevents_available(self) -> int:
+        """
+        See Also:
+            EventRangeQueue.nevents_available()
+        """
+        return self.event_ranges_queue.nevents_available()
+
+    def get_next_ranges(self, nranges: int, nevents: int = None, at_least_one: bool = True) -> List['EventRange']:
         """
         See Also:
             EventRangeQueue.get_next_ranges()
         """
-        return self.event_ranges_queue.get_next_ranges(nranges)
+        return self.event_ranges_queue.get_next_ranges(nranges, nevents=nevents, at_least_one=at_least_one)
 
     def get_pandaQueue(self) -> str:
         """
@@ -898,7 +1722,7 @@ class PandaJob(object):
         return self['PandaID']
 
     def __str__(self) -> str:
-        return json.dumps(self.job)
+        return jsoncodec.dumps(self.job)
 
     def __getitem__(self, k: str) -> str:
         return self.job[k]
@@ -934,6 +1758,10 @@ class EventRange(object):
     ASSIGNED: currently assigned to a worker, waiting on an update
     DONE: the event range was processed successfully
     FAILED: the event range failed during processing
+    FATAL: the event range failed and must not be retried, e.g. quarantined after crashing several payloads
+
+    Jobs can hold millions of ranges so instances do not have a __dict__. PFN, GUID and scope, which are identical
+    for every range of an input file, are interned and the PFN basename is cached.
     """
 
     READY = "available"
@@ -942,6 +1770,11 @@ class EventRange(object):
     FAILED = "failed"
     FATAL = "fatal"
     STATES = [READY, ASSIGNED, DONE, FAILED, FATAL]
+    # the payload can only update ranges which have been assigned to a worker
+    PAYLOAD_UPDATABLE_STATES = frozenset([ASSIGNED, DONE, FAILED, FATAL])
+
+    __slots__ = ('lastEvent', 'eventRangeID', 'startEvent', '_PFN', '_file_basename', 'GUID', 'scope', 'status',
+                 'retry')
 
     def __init__(self, event_range_id: str, start_event: int, last_event: int,
                  pfn: str, guid: str, scope: str) -> None:
@@ -960,11 +1793,37 @@ class EventRange(object):
         self.eventRangeID = event_range_id
         self.startEvent = start_event
         self.PFN = pfn
-        self.GUID = guid
-        self.scope = scope
+        self.GUID = EventRange._intern(guid)
+        self.scope = EventRange._intern(scope)
         self.status = EventRange.READY
         self.retry = 0
 
+    @staticmethod
+    def _intern(value: Union[str, None]) -> Union[str, None]:
+        return sys.intern(value) if isinstance(value, str) else value
+
+    @property
+    def PFN(self) -> str:
+        """
+        Physical path to the event file
+        """
+        return self._PFN
+
+    @PFN.setter
+    def PFN(self, pfn: str) -> None:
+        self._PFN = EventRange._intern(pfn)
+        self._file_basename = EventRange._intern(os.path.basename(pfn)) if isinstance(pfn, str) else None
+
+    @property
+    def file_basename(self) -> str:
+        """
+        Basename of the event file, used to index ranges by input file
+
+        Returns:
+            basename of PFN
+        """
+        return self._file_basename
+
     def set_assigned(self) -> None:
         """
         Set current state to ASSIGNED
@@ -1008,7 +1867,7 @@ class EventRange(object):
         Returns:
             json dump of self.to_dict()
         """
-        return json.dumps(self.to_dict())
+        return jsoncodec.dumps(self.to_dict())
 
     def to_dict(self) -> dict:
         """
@@ -1043,6 +1902,401 @@ class EventRange(object):
             event_ranges_dict['GUID'], event_ranges_dict['scope'])
 
 
+class RangeUpdateSummary(object):
+    """
+    Result of a batch of event ranges state transitions, see EventRangeQueue.update_ranges_states()
+    """
+
+    def __init__(self) -> None:
+        self.counts: Dict[str, int] = dict()
+        self.rejected: List[str] = list()
+
+    def __str__(self) -> str:
+        return jsoncodec.dumps({"counts": self.counts, "rejected": self.rejected})
+
+
+class IngestStats(object):
+    """
+    Number of re-delivered event ranges detected by an EventRangeQueue at ingest
+    """
+
+    def __init__(self) -> None:
+        self.duplicates_dropped = 0
+        self.duplicates_replaced = 0
+
+    def duplicates(self) -> int:
+        return self.duplicates_dropped + self.duplicates_replaced
+
+    def __str__(self) -> str:
+        return jsoncodec.dumps(self.__dict__)
+
+
+class SpillStats(object):
+    """
+    Number of event ranges spilled to and reloaded from disk by an EventRangeQueue, and the time spent doing it
+    """
+
+    def __init__(self) -> None:
+        self.spilled = 0
+        self.reloaded = 0
+        self.spill_time = 0.0
+        self.reload_time = 0.0
+
+    def __str__(self) -> str:
+        return jsoncodec.dumps(self.__dict__)
+
+
+class IntervalSet(object):
+    """
+    Set of integers stored as sorted, disjoint and non-adjacent closed intervals. Adding consecutive integers extends
+    or merges existing intervals so that the memory usage depends on the number of gaps rather than on the number
+    of elements.
+    """
+
+    def __init__(self) -> None:
+        self._starts: List[int] = list()
+        self._ends: List[int] = list()
+        self._count = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __contains__(self, k: int) -> bool:
+        i = bisect_right(self._starts, k) - 1
+        return i >= 0 and self._ends[i] >= k
+
+    def add(self, start: int, end: int = None) -> None:
+        """
+        Add all integers in [start, end] to the set
+
+        Args:
+            start: first integer to add
+            end: last integer to add, defaults to start
+
+        Returns:
+            None
+        """
+        if end is None:
+            end = start
+        if end < start:
+            raise Exception(f"Invalid interval [{start}, {end}]")
+        # intervals overlapping or adjacent to [start, end] are in [i, j)
+        i = bisect_left(self._ends, start - 1)
+        j = bisect_right(self._starts, end + 1)
+        if i < j:
+            start = min(start, self._starts[i])
+            end = max(end, self._ends[j - 1])
+            self._count -= sum(self._ends[k] - self._starts[k] + 1 for k in range(i, j))
+        self._starts[i:j] = [start]
+        self._ends[i:j] = [end]
+        self._count += end - start + 1
+
+    def intervals(self) -> List[Tuple[int, int]]:
+        """
+        Intervals of the set
+
+        Returns:
+            list of (start, end) tuples in increasing order
+        """
+        return list(zip(self._starts, self._ends))
+
+
+class RangeIDSet(object):
+    """
+    Compact set of event range ids. Ids are split into a prefix and a trailing integer, e.g. 'Range-00007' is split
+    into ('Range-', 7), and the integers are stored in an IntervalSet per prefix. The width of zero-padded integers is
+    part of the prefix key so that 'Range-7' and 'Range-00007' remain distinct. Ids without a trailing integer are
+    kept in a plain set.
+    """
+
+    _ID_PATTERN = re.compile(r"^(.*?)(\d+)$")
+
+    def __init__(self) -> None:
+        self._intervals_by_prefix: Dict[Tuple[str, int], IntervalSet] = dict()
+        self._others = set()
+
+    def __len__(self) -> int:
+        return sum(len(s) for s in self._intervals_by_prefix.values()) + len(self._others)
+
+    def __contains__(self, range_id: str) -> bool:
+        match = RangeIDSet._ID_PATTERN.match(range_id)
+        if match is None:
+            return range_id in self._others
+        prefix, number = RangeIDSet._split(match)
+        intervals = self._intervals_by_prefix.get(prefix)
+        return intervals is not None and number in intervals
+
+    @staticmethod
+    def _split(match) -> Tuple[Tuple[str, int], int]:
+        digits = match.group(2)
+        width = len(digits) if len(digits) > 1 and digits[0] == '0' else 0
+        return (match.group(1), width), int(digits)
+
+    def add(self, range_id: str) -> None:
+        """
+        Add a range id to the set
+
+        Args:
+            range_id: id to add
+
+        Returns:
+            None
+        """
+        match = RangeIDSet._ID_PATTERN.match(range_id)
+        if match is None:
+            self._others.add(range_id)
+            return
+        prefix, number = RangeIDSet._split(match)
+        intervals = self._intervals_by_prefix.get(prefix)
+        if intervals is None:
+            intervals = IntervalSet()
+            self._intervals_by_prefix[prefix] = intervals
+        intervals.add(number)
+
+
+class EventRangeStore(object):
+    """
+    Column-oriented storage for the event ranges of a job, used as a drop-in replacement for the
+    eventRangeID -> EventRange dict of EventRangeQueue.
+
+    Start and last events, status codes and retry counts are stored in packed arrays, one row per range. PFN, GUID and
+    scope are shared by every range of an input file and are stored once in a file table, each row only holding the
+    index of its file. EventRange objects are built on access and are views: changes made to them are only persisted
+    when the range is assigned back to the store.
+    """
+
+    def __init__(self) -> None:
+        """
+        Init the store
+        """
+        self._row_by_id: Dict[str, int] = dict()
+        self._free_rows: List[int] = list()
+        self._start_event = array('q')
+        self._last_event = array('q')
+        self._status = array('b')
+        self._retry = array('i')
+        self._file_index = array('l')
+        self._files: List[Tuple[str, str, str]] = list()
+        self._file_index_by_key: Dict[Tuple[str, str, str], int] = dict()
+
+    def __len__(self) -> int:
+        return len(self._row_by_id)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._row_by_id)
+
+    def __contains__(self, k: str) -> bool:
+        return k in self._row_by_id
+
+    def __getitem__(self, k: str) -> 'EventRange':
+        row = self._row_by_id[k]
+        pfn, guid, scope = self._files[self._file_index[row]]
+        event_range = EventRange(k, self._start_event[row], self._last_event[row], pfn, guid, scope)
+        event_range.status = EventRange.STATES[self._status[row]]
+        event_range.retry = self._retry[row]
+        return event_range
+
+    def __setitem__(self, k: str, v: 'EventRange') -> None:
+        self._write_row(k, v.startEvent, v.lastEvent, (v.PFN, v.GUID, v.scope), EventRange.STATES.index(v.status),
+                        v.retry)
+
+    def add_raw(self, k: str, start_event: int, last_event: int, file_key: Tuple[str, str, str]) -> None:
+        """
+        Store a READY range from its fields, without building an EventRange
+
+        Args:
+            k: event range id
+            start_event: first event of the range
+            last_event: last event of the range
+            file_key: (PFN, GUID, scope) of the input file
+
+        Returns:
+            None
+        """
+        self._write_row(k, start_event, last_event, file_key, EventRange.STATES.index(EventRange.READY), 0)
+
+    def _write_row(self, k: str, start_event: int, last_event: int, file_key: Tuple[str, str, str], status: int,
+                   retry: int) -> None:
+        file_index = self._file_index_by_key.get(file_key)
+        if file_index is None:
+            file_index = len(self._files)
+            self._files.append(file_key)
+            self._file_index_by_key[file_key] = file_index
+
+        row = self._row_by_id.get(k)
+        if row is None:
+            if self._free_rows:
+                row = self._free_rows.pop()
+            else:
+                row = len(self._start_event)
+                self._start_event.append(0)
+                self._last_event.append(0)
+                self._status.append(0)
+                self._retry.append(0)
+                self._file_index.append(0)
+            self._row_by_id[k] = row
+        self._start_event[row] = start_event
+        self._last_event[row] = last_event
+        self._status[row] = status
+        self._retry[row] = retry
+        self._file_index[row] = file_index
+
+    def __delitem__(self, k: str) -> None:
+        self._free_rows.append(self._row_by_id.pop(k))
+
+    def get(self, k: str, default: 'EventRange' = None) -> Union['EventRange', None]:
+        if k not in self._row_by_id:
+            return default
+        return self[k]
+
+    def pop(self, k: str) -> 'EventRange':
+        event_range = self[k]
+        del self[k]
+        return event_range
+
+    def keys(self) -> Iterator[str]:
+        return iter(self._row_by_id)
+
+    def values(self) -> Iterator['EventRange']:
+        for k in self._row_by_id:
+            yield self[k]
+
+    def items(self) -> Iterator[Tuple[str, 'EventRange']]:
+        for k in self._row_by_id:
+            yield k, self[k]
+
+
+class EventRangeBatch(object):
+    """
+    Compact batch of event ranges sent by the driver to an actor, used in place of a list of EventRange.
+
+    The batch is pickled as a single buffer: a header with the number of ranges and files, packed start and last
+    events, file indexes, retry counts and status codes, then a table of strings holding the range ids followed by the
+    PFN, GUID and scope of each input file, stored once per file. Strings are stored as the byte length of each string,
+    -1 standing for None, followed by the concatenated utf-8 strings so that they may hold any character. Integers,
+    header included, are packed in the native byte order and sizes, the driver and the actors being expected to run on
+    the same architecture.
+
+    An unpickled batch keeps the buffer and only decodes it when accessed, EventRange objects are built the first time
+    each range is accessed.
+    """
+
+    # native byte order and sizes, like the arrays
+    _HEADER = struct.Struct("II")
+
+    def __init__(self, event_ranges: Sequence['EventRange'] = ()) -> None:
+        """
+        Init the batch
+
+        Args:
+            event_ranges: ranges held by the batch
+        """
+        self._ranges: List[Union['EventRange', None]] = list(event_ranges)
+        self._buffer: Union[bytes, None] = None
+        self._columns: Union[Tuple[array, array, array, array, array, List[str], List[Tuple[str, str, str]]], None] = None
+
+    def __len__(self) -> int:
+        if self._buffer is not None and self._columns is None:
+            return EventRangeBatch._HEADER.unpack_from(self._buffer)[0]
+        return len(self._ranges)
+
+    def __getitem__(self, i: int) -> 'EventRange':
+        self._decode()
+        event_range = self._ranges[i]
+        if event_range is None:
+            start_events, last_events, file_indexes, retries, statuses, ids, files = self._columns
+            pfn, guid, scope = files[file_indexes[i]]
+            event_range = EventRange(ids[i], start_events[i], last_events[i], pfn, guid, scope)
+            event_range.retry = retries[i]
+            event_range.status = EventRange.STATES[statuses[i]]
+            self._ranges[i] = event_range
+        return event_range
+
+    def __iter__(self) -> Iterator['EventRange']:
+        for i in range(len(self)):
+            yield self[i]
+
+    def __reduce__(self) -> Tuple[Callable[[bytes], 'EventRangeBatch'], Tuple[bytes]]:
+        return EventRangeBatch.from_buffer, (self.to_buffer(),)
+
+    def to_buffer(self) -> bytes:
+        """
+        Serialize the batch to a single buffer
+
+        Returns:
+            the serialized batch
+        """
+        if self._buffer is not None:
+            return self._buffer
+        start_events, last_events, file_indexes, retries, statuses = (array('q'), array('q'), array('I'), array('i'),
+                                                                      array('b'))
+        ids = list()
+        strings = list()
+        file_index_by_key: Dict[Tuple[str, str, str], int] = dict()
+        for event_range in self._ranges:
+            file_key = (event_range.PFN, event_range.GUID, event_range.scope)
+            file_index = file_index_by_key.get(file_key)
+            if file_index is None:
+                file_index = len(file_index_by_key)
+                file_index_by_key[file_key] = file_index
+                strings.extend(file_key)
+            start_events.append(event_range.startEvent)
+            last_events.append(event_range.lastEvent)
+            file_indexes.append(file_index)
+            retries.append(event_range.retry)
+            statuses.append(EventRange.STATES.index(event_range.status))
+            ids.append(event_range.eventRangeID)
+        ids.extend(strings)
+        encoded = [None if v is None else v.encode() for v in ids]
+        lengths = array('i', (-1 if v is None else len(v) for v in encoded))
+        return b"".join((EventRangeBatch._HEADER.pack(len(self._ranges), len(file_index_by_key)),
+                         start_events.tobytes(), last_events.tobytes(), file_indexes.tobytes(), retries.tobytes(),
+                         statuses.tobytes(), lengths.tobytes(), b"".join(v for v in encoded if v is not None)))
+
+    @staticmethod
+    def from_buffer(buffer: bytes) -> 'EventRangeBatch':
+        """
+        Build a batch from a buffer returned by to_buffer(). The buffer is only decoded when the batch is accessed
+
+        Args:
+            buffer: the serialized batch
+
+        Returns:
+            the batch
+        """
+        batch = EventRangeBatch()
+        batch._buffer = buffer
+        return batch
+
+    def _decode(self) -> None:
+        if self._buffer is None or self._columns is not None:
+            return
+        nranges, nfiles = EventRangeBatch._HEADER.unpack_from(self._buffer)
+        offset = EventRangeBatch._HEADER.size
+        columns = list()
+        for typecode in ('q', 'q', 'I', 'i', 'b'):
+            column = array(typecode)
+            end = offset + nranges * column.itemsize
+            column.frombytes(self._buffer[offset:end])
+            columns.append(column)
+            offset = end
+        lengths = array('i')
+        end = offset + (nranges + 3 * nfiles) * lengths.itemsize
+        lengths.frombytes(self._buffer[offset:end])
+        offset = end
+        strings = list()
+        for length in lengths:
+            if length < 0:
+                strings.append(None)
+            else:
+                strings.append(self._buffer[offset:offset + length].decode())
+                offset += length
+        ids = strings[:nranges]
+        files = [tuple(strings[i:i + 3]) for i in range(nranges, nranges + 3 * nfiles, 3)]
+        self._columns = (*columns, ids, files)
+        self._ranges = [None] * nranges
+
+
 class JobReport(object):
     """
     Wrapper for a job report.
@@ -0,0 +1,171 @@
+import json
+from typing import Any, Callable, Dict, IO, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+DefaultHook = Callable[[Any], Any]
+
+
+class JSONCodec(object):
+    """
+    Encode and decode JSON documents with the fastest backend installed: orjson, then msgspec, falling back to the
+    json module of the standard library. Types not supported natively by the backend are converted by the default hook,
+    which should raise a TypeError for unknown types like the default argument of json.dumps.
+
+    Backends do not produce byte-identical documents, e.g. orjson and msgspec do not add spaces after separators, but
+    documents are equivalent once decoded.
+    """
+
+    ORJSON = "orjson"
+    MSGSPEC = "msgspec"
+    STDLIB = "json"
+    BACKENDS = [ORJSON, MSGSPEC, STDLIB]
+
+    def __init__(self, backend: str = None) -> None:
+        """
+        Init the codec
+
+        Args:
+            backend: backend to use, one of BACKENDS. Defaults to the first backend available
+
+        Raises:
+            Exception if the backend is unknown or not installed
+        """
+        available = JSONCodec.available_backends()
+        if backend is None:
+            backend = available[0]
+        elif backend not in available:
+            raise Exception(f"JSON backend '{backend}' is not available, available backends: {available}")
+        self.backend = backend
+        self._decoder = msgspec.json.Decoder() if backend == JSONCodec.MSGSPEC else None
+        # msgspec encoders are bound to their hook, one encoder is cached for each hook
+        self._encoders: Dict[Union[DefaultHook, None], Any] = dict()
+
+    @staticmethod
+    def available_backends() -> list:
+        """
+        List the backends which are installed, fastest first
+
+        Returns:
+            List of backend names
+        """
+        installed = {JSONCodec.ORJSON: orjson is not None, JSONCodec.MSGSPEC: msgspec is not None, JSONCodec.STDLIB: True}
+        return [backend for backend in JSONCodec.BACKENDS if installed[backend]]
+
+    def dumpb(self, obj: Any, default: DefaultHook = None) -> bytes:
+        """
+        Encode an object to a UTF-8 JSON document
+
+        Args:
+            obj: object to encode
+            default: called with objects which can not be encoded natively, should return an encodable object
+
+        Returns:
+            the encoded document
+        """
+        if self.backend == JSONCodec.ORJSON:
+            return orjson.dumps(obj, default=default, option=orjson.OPT_NON_STR_KEYS)
+        if self.backend == JSONCodec.MSGSPEC:
+            encoder = self._encoders.get(default)
+            if encoder is None:
+                encoder = msgspec.json.Encoder(enc_hook=default)
+                self._encoders[default] = encoder
+            return encoder.encode(obj)
+        return json.dumps(obj, default=default).encode()
+
+    def dumps(self, obj: Any, default: DefaultHook = None) -> str:
+        """
+        Encode an object to a JSON string
+
+        Args:
+            obj: object to encode
+            default: called with objects which can not be encoded natively, should return an encodable object
+
+        Returns:
+            the encoded document
+        """
+        if self.backend == JSONCodec.STDLIB:
+            return json.dumps(obj, default=default)
+        return self.dumpb(obj, default).decode()
+
+    def loads(self, s: Union[str, bytes]) -> Any:
+        """
+        Decode a JSON document
+
+        Args:
+            s: document to decode
+
+        Returns:
+            the decoded object
+        """
+        if self.backend == JSONCodec.ORJSON:
+            return orjson.loads(s)
+        if self.backend == JSONCodec.MSGSPEC:
+            return self._decoder.decode(s)
+        return json.loads(s)
+
+    def dump(self, obj: Any, f: IO, default: DefaultHook = None) -> None:
+        """
+        Encode an object to a JSON document written to a text file
+
+        Args:
+            obj: object to encode
+            f: file opened in text mode
+            default: called with objects which can not be encoded natively, should return an encodable object
+
+        Returns:
+            None
+        """
+        f.write(self.dumps(obj, default))
+
+    def load(self, f: IO) -> Any:
+        """
+        Decode the JSON document read from a file
+
+        Args:
+            f: file opened in text or binary mode
+
+        Returns:
+            the decoded object
+        """
+        return self.loads(f.read())
+
+
+# codec shared by the application
+codec = JSONCodec()
+
+
+def dumps(obj: Any, default: DefaultHook = None) -> str:
+    """
+    Encode an object to a JSON string with the shared codec, see JSONCodec.dumps()
+    """
+    return codec.dumps(obj, default)
+
+
+def loads(s: Union[str, bytes]) -> Any:
+    """
+    Decode a JSON document with the shared codec, see JSONCodec.loads()
+    """
+    return codec.loads(s)
+
+
+def dump(obj: Any, f: IO, default: DefaultHook = None) -> None:
+    """
+    Encode an object to a JSON document written to a text file with the shared codec, see JSONCodec.dump()
+    """
+    codec.dump(obj, f, default)
+
+
+def load(f: IO) -> Any:
+    """
+    Decode the JSON document read from a file with the shared codec, see JSONCodec.load()
+    """
+    return codec.load(f)
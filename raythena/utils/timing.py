@@ -1,10 +1,10 @@
 import psutil
 import time
-import json
 
 from threading import Event
 from typing import Any, Dict, List, Union
 
+from raythena.utils import jsoncodec
 from raythena.utils.exception import ExThread
 
 
@@ -54,7 +54,7 @@ class CPUMonitor:
             None
         """
         with open(self.log_file, 'w') as f:
-            json.dump(data, f)
+            jsoncodec.dump(data, f)
 
     def monitor_cpu(self) -> None:
         """
@@ -111,6 +111,94 @@ class CPUMonitor:
         self._log_to_file(cpu_infos)
 
 
+class ThroughputEstimator:
+    """
+    Estimates the number of event ranges and events finished per second using an exponentially weighted moving
+    average of the rate measured between two samples. The weight of a sample decreases by half every halflife
+    seconds, which keeps the estimate correct when samples are not taken at regular intervals.
+    """
+
+    def __init__(self, halflife: float, start_time: float = None) -> None:
+        """
+        Init the estimator
+
+        Args:
+            halflife: number of seconds after which the weight of a measured rate is halved
+            start_time: start of the first sampling interval, defaults to now
+        """
+        self.halflife = halflife
+        self.last_sample = time.time() if start_time is None else start_time
+        self.nranges = 0
+        self.nevents = 0
+        self.ranges_rate: Union[float, None] = None
+        self.events_rate: Union[float, None] = None
+
+    def add(self, nranges: int, nevents: int) -> None:
+        """
+        Record finished event ranges, counted in the current sampling interval
+
+        Args:
+            nranges: number of finished event ranges
+            nevents: number of events in the finished ranges
+
+        Returns:
+            None
+        """
+        self.nranges += nranges
+        self.nevents += nevents
+
+    def sample(self, now: float = None) -> None:
+        """
+        Ends the current sampling interval and updates the rates with the rate measured during this interval
+
+        Args:
+            now: end of the interval, defaults to now
+
+        Returns:
+            None
+        """
+        now = time.time() if now is None else now
+        delta_time = now - self.last_sample
+        if delta_time <= 0:
+            return
+        ranges_rate = self.nranges / delta_time
+        events_rate = self.nevents / delta_time
+        if self.ranges_rate is None:
+            self.ranges_rate, self.events_rate = ranges_rate, events_rate
+        else:
+            alpha = 1 - 2 ** (-delta_time / self.halflife) if self.halflife > 0 else 1
+            self.ranges_rate += alpha * (ranges_rate - self.ranges_rate)
+            self.events_rate += alpha * (events_rate - self.events_rate)
+        self.last_sample = now
+        self.nranges = 0
+        self.nevents = 0
+
+    def time_to_complete(self, nevents: int) -> Union[float, None]:
+        """
+        Projects the number of seconds needed to process events at the estimated rate
+
+        Args:
+            nevents: number of events to process
+
+        Returns:
+            number of seconds, None if no event has been processed yet
+        """
+        if not nevents:
+            return 0.
+        if not self.events_rate:
+            return None
+        return nevents / self.events_rate
+
+    def to_dict(self) -> Dict[str, Union[float, None]]:
+        """
+        Current estimates, as written to the status file
+
+        Returns:
+            dict with the ranges and events rates
+        """
+        return {"ranges_per_sec": self.ranges_rate, "events_per_sec": self.events_rate}
+
+
 class Timing:
 
     def __init__(self):
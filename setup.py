@@ -25,5 +25,8 @@ setup(
         'tox',
         'click',
         'setproctitle'
-    ]
+    ],
+    extras_require={
+        'fastjson': ['orjson']
+    }
 )
@@ -2,6 +2,7 @@ import pytest
 
 from raythena.actors.loggingActor import LoggingActor
 from raythena.drivers.esdriver import BookKeeper
+from raythena.utils.eventservice import EventRange
 
 
 @pytest.mark.usefixtures("requires_ray")
@@ -99,6 +100,32 @@ class TestBookKeeper:
             assert ranges
         assert not bookKeeper.fetch_event_ranges(wid[0], 1)
 
+    def test_fetch_event_ranges_file_affinity(self, is_eventservice, config, sample_multijobs, sample_ranges,
+                                              monkeypatch):
+        if not is_eventservice:
+            pytest.skip()
+
+        monkeypatch.setitem(config.ray, 'fileaffinity', True)
+        logging_actor = LoggingActor.remote(config)
+        bookKeeper = BookKeeper(logging_actor, config)
+        bookKeeper.add_jobs(sample_multijobs)
+        # a single job with ranges so that every actor is assigned the same job
+        panda_id = next(iter(sample_multijobs))
+        bookKeeper.add_event_ranges({panda_id: sample_ranges[panda_id]})
+        actors = ["a1", "a2", "a3"]
+        for actor_id in actors:
+            bookKeeper.assign_job_to_actor(actor_id)
+        for _ in range(5):
+            for actor_id in actors:
+                assert bookKeeper.fetch_event_ranges(actor_id, 2)
+        for actor_id in actors:
+            assert len(bookKeeper.files_by_actor[actor_id]) == 1
+        assert len(bookKeeper.actors_by_file) == len(actors)
+
+        bookKeeper.process_actor_end(actors[0])
+        assert actors[0] not in bookKeeper.files_by_actor
+        assert len(bookKeeper.actors_by_file) == len(actors) - 1
+
     def test_process_event_ranges_update(self, is_eventservice, config,
                                          sample_multijobs, njobs, nevents,
                                          sample_ranges, sample_rangeupdate,
@@ -113,13 +140,21 @@ class TestBookKeeper:
         bookKeeper.add_jobs(sample_multijobs)
         bookKeeper.add_event_ranges(sample_ranges)
 
+        assert not bookKeeper.have_finished_events()
         for i in range(njobs):
             job = bookKeeper.assign_job_to_actor(actor_id)
-            _ = bookKeeper.fetch_event_ranges(actor_id, nevents)
+            ranges = bookKeeper.fetch_event_ranges(actor_id, nevents)
+            assert bookKeeper.nranges_by_state[EventRange.ASSIGNED] == nevents
             bookKeeper.process_event_ranges_update(actor_id, sample_rangeupdate)
             assert job.event_ranges_queue.nranges_done() == nevents
+            # finished ranges are kept unless collapsefinished is set
+            assert all(job.event_ranges_queue[r.eventRangeID].status == EventRange.DONE for r in ranges)
             assert not bookKeeper.is_flagged_no_more_events(job['PandaID'])
+            assert bookKeeper.nranges_by_state[EventRange.ASSIGNED] == 0
+            assert bookKeeper.nranges_done() == (i + 1) * nevents
+            assert bookKeeper.nevents_done() == (i + 1) * sum(r.nevents() for r in ranges)
 
+        assert bookKeeper.have_finished_events()
         assert not bookKeeper.assign_job_to_actor(actor_id)
 
     def test_process_actor_end(self, is_eventservice, config, njobs,
@@ -152,7 +187,160 @@ class TestBookKeeper:
         ranges_2 = bookKeeper.fetch_event_ranges(actor_id_2, nevents)
         assert len(ranges_2) == bookKeeper.n_ready(pandaID) == 0
         assert bookKeeper.assign_job_to_actor(actor_id_2)['PandaID'] != pandaID
+        assert all(bookKeeper.get_actor_of_range(r.eventRangeID) == actor_id_1 for r in ranges_1)
 
         bookKeeper.process_actor_end(actor_id_1)
         assert bookKeeper.n_ready(pandaID) == nevents
+        assert all(bookKeeper.get_actor_of_range(r.eventRangeID) is None for r in ranges_1)
         assert bookKeeper.assign_job_to_actor(actor_id_1)['PandaID'] == pandaID
+
+    def test_retry_policy(self, is_eventservice, config, sample_multijobs, sample_ranges, monkeypatch):
+        if not is_eventservice:
+            pytest.skip("No eventservice jobs")
+
+        monkeypatch.setitem(config.ray, 'maxretries', 1)
+        monkeypatch.setitem(config.ray, 'retrybackoff', 0)
+        monkeypatch.setitem(config.ray, 'maxcrashes', 2)
+        logging_actor = LoggingActor.remote(config)
+        bookKeeper = BookKeeper(logging_actor, config)
+        bookKeeper.add_jobs(sample_multijobs)
+        panda_id = next(iter(sample_multijobs))
+        bookKeeper.add_event_ranges({panda_id: sample_ranges[panda_id]})
+        job_ranges = bookKeeper.jobs.get_event_ranges(panda_id)
+        nranges = len(sample_ranges[panda_id])
+        actor_id_1 = "a1"
+        actor_id_2 = "a2"
+        bookKeeper.assign_job_to_actor(actor_id_1)
+        bookKeeper.assign_job_to_actor(actor_id_2)
+
+        # failed ranges are requeued once and not given back to the actor which failed them
+        failed = [r.eventRangeID for r in bookKeeper.fetch_event_ranges(actor_id_1, 1)]
+        failed_update = [{'eventRanges': [{'eventRangeID': failed[0], 'eventStatus': EventRange.FAILED}]}]
+        bookKeeper.process_event_ranges_update(actor_id_1, failed_update)
+        assert job_ranges.get_range_state(failed[0]) == EventRange.ASSIGNED
+        assert job_ranges[failed[0]].retry == 1
+        assert bookKeeper.get_actor_of_range(failed[0]) is None
+        assert failed[0] not in [r.eventRangeID for r in bookKeeper.fetch_event_ranges(actor_id_1, 1)]
+        assert [r.eventRangeID for r in bookKeeper.fetch_event_ranges(actor_id_2, 1)] == failed
+        assert bookKeeper.get_actor_of_range(failed[0]) == actor_id_2
+        bookKeeper.process_event_ranges_update(actor_id_2, failed_update)
+        assert job_ranges.get_range_state(failed[0]) == EventRange.FAILED
+
+        # ranges left behind by maxcrashes crashed actors are quarantined, actors ending normally do not count
+        crashed = [r.eventRangeID for r in bookKeeper.fetch_event_ranges(actor_id_2, 1)]
+        assert bookKeeper.process_actor_end(actor_id_2) is None
+        assert job_ranges.get_range_state(crashed[0]) == EventRange.READY
+        bookKeeper.assign_job_to_actor(actor_id_2)
+        crashed = [r.eventRangeID for r in bookKeeper.fetch_event_ranges(actor_id_2, 1)]
+        assert bookKeeper.process_actor_end(actor_id_2, crashed=True) is None
+        assert job_ranges.get_range_state(crashed[0]) == EventRange.ASSIGNED
+        assert [r.eventRangeID for r in bookKeeper.fetch_event_ranges(actor_id_1, 1)] == crashed
+        fatal_update = bookKeeper.process_actor_end(actor_id_1, crashed=True)
+        assert job_ranges.get_range_state(crashed[0]) == EventRange.FATAL
+        assert fatal_update[panda_id] == [{'eventRangeID': crashed[0], 'eventStatus': EventRange.FATAL}]
+        assert job_ranges.nranges_remaining() == nranges - 2
+
+    def test_retry_after_last_actor_crash(self, is_eventservice, config, sample_multijobs, sample_ranges, monkeypatch):
+        if not is_eventservice:
+            pytest.skip("No eventservice jobs")
+
+        monkeypatch.setitem(config.ray, 'maxretries', 1)
+        logging_actor = LoggingActor.remote(config)
+        bookKeeper = BookKeeper(logging_actor, config)
+        panda_id = next(iter(sample_multijobs))
+        bookKeeper.add_jobs({panda_id: sample_multijobs[panda_id]})
+        bookKeeper.add_event_ranges({panda_id: sample_ranges[panda_id]})
+        nranges = len(sample_ranges[panda_id])
+        actor_id_1 = "a1"
+        actor_id_2 = "a2"
+        assert bookKeeper.assign_job_to_actor(actor_id_1)['PandaID'] == panda_id
+        crashed = [r.eventRangeID for r in bookKeeper.fetch_event_ranges(actor_id_1, nranges)]
+        assert len(crashed) == nranges
+        assert not bookKeeper.has_jobs_ready()
+
+        # the only actor of the job crashed, its ranges are given to the next actor asking for a job
+        bookKeeper.process_actor_end(actor_id_1, crashed=True)
+        assert bookKeeper.has_jobs_ready()
+        assert bookKeeper.assign_job_to_actor(actor_id_2)['PandaID'] == panda_id
+        assert [r.eventRangeID for r in bookKeeper.fetch_event_ranges(actor_id_2, nranges)] == crashed
+        assert not bookKeeper.has_jobs_ready()
+
+    def test_throughput(self, is_eventservice, config, sample_multijobs, sample_ranges, sample_rangeupdate, nevents,
+                        monkeypatch):
+        if not is_eventservice:
+            pytest.skip("No eventservice jobs")
+
+        monkeypatch.setitem(config.ray, 'monitortime', 0)
+        monkeypatch.setitem(config.ray, 'walltime', 3600)
+        logging_actor = LoggingActor.remote(config)
+        bookKeeper = BookKeeper(logging_actor, config)
+        bookKeeper.add_jobs(sample_multijobs)
+        bookKeeper.add_event_ranges(sample_ranges)
+        actor_id = "a1"
+        panda_id = bookKeeper.assign_job_to_actor(actor_id)['PandaID']
+        assert bookKeeper.get_job_throughput(panda_id) is None
+        ranges = bookKeeper.fetch_event_ranges(actor_id, nevents // 2)
+        bookKeeper.process_event_ranges_update(actor_id, sample_rangeupdate)
+        assert bookKeeper.add_finished_event_ranges()
+
+        assert bookKeeper.get_job_throughput(panda_id).ranges_rate > 0
+        status = bookKeeper.get_throughput_status()
+        assert status["cluster"]["ranges_done"] == len(ranges)
+        assert status["cluster"]["events_ready"] == bookKeeper.n_ready_events(panda_id) > 0
+        assert status["cluster"]["time_to_complete"] > 0
+        assert status["jobs"][panda_id]["ranges_ready"] == nevents - len(ranges)
+        assert status["actors"][actor_id]["job"] == panda_id
+        assert status["actors"][actor_id]["events_per_sec"] > 0 and status["cluster"]["events_per_sec"] > 0
+        assert status["drains_before_walltime"] == (status["cluster"]["time_to_complete"] <= status["walltime_left"])
+
+    def test_create_ranges_to_tar(self, is_eventservice, config, sample_multijobs, sample_ranges, monkeypatch):
+        if not is_eventservice:
+            pytest.skip("No eventservice jobs")
+
+        monkeypatch.setitem(config.ray, 'tarmaxfilesize', 100)
+        monkeypatch.setitem(config.ray, 'tarminfillratio', 0.5)
+        logging_actor = LoggingActor.remote(config)
+        bookKeeper = BookKeeper(logging_actor, config)
+        bookKeeper.add_jobs(sample_multijobs)
+        bookKeeper.add_event_ranges(sample_ranges)
+        panda_id = next(iter(sample_multijobs))
+
+        def outputs(*sizes):
+            return [{'eventRangeID': f"Range-{size}", 'fsize': size, 'PanDAID': panda_id} for size in sizes]
+
+        bookKeeper.ranges_to_tar_by_input_file = {"EVNT.1": outputs(60, 50, 40, 30, 150, 10), "EVNT.2": outputs(20)}
+        assert bookKeeper.create_ranges_to_tar()
+        tars = [[r['fsize'] for r in file_list] for file_list in bookKeeper.get_ranges_to_tar()]
+        assert tars == [[150], [60, 40], [50, 30, 10]]
+        # under-filled tar files are held back until the job drains
+        assert bookKeeper.ranges_to_tar_by_input_file == {"EVNT.1": [], "EVNT.2": outputs(20)}
+        assert not bookKeeper.create_ranges_to_tar()
+        bookKeeper.assign_job_to_actor("a1")
+        bookKeeper.fetch_event_ranges("a1", len(sample_ranges[panda_id]))
+        bookKeeper.jobs[panda_id].no_more_ranges = True
+        assert bookKeeper.create_ranges_to_tar()
+        assert bookKeeper.get_ranges_to_tar() == [outputs(20)]
+        assert bookKeeper.ranges_to_tar_by_input_file["EVNT.2"] == []
+
+    def test_recover_finished_ranges(self, is_eventservice, config, sample_multijobs, sample_ranges, tmp_path):
+        if not is_eventservice:
+            pytest.skip("No eventservice jobs")
+
+        logging_actor = LoggingActor.remote(config)
+        bookKeeper = BookKeeper(logging_actor, config)
+        bookKeeper.add_jobs(sample_multijobs)
+        panda_id = next(iter(sample_multijobs))
+        bookKeeper.add_event_ranges({panda_id: sample_ranges[panda_id]})
+        job_ranges = bookKeeper.jobs.get_event_ranges(panda_id)
+        range_ids = [r['eventRangeID'] for r in sample_ranges[panda_id]]
+        es_file = tmp_path / f"HITS.pool.root.{range_ids[0]}"
+        es_file.write_bytes(b"0" * 10)
+        outputs = {range_ids[0]: str(es_file), range_ids[1]: str(tmp_path / "panda.HITS.zip"), "unknown": "HITS"}
+
+        recovered = bookKeeper.recover_finished_ranges(outputs)
+        assert recovered == {panda_id: {range_ids[0]: str(es_file), range_ids[1]: str(tmp_path / "panda.HITS.zip")}}
+        assert outputs == {"unknown": "HITS"}
+        assert job_ranges.get_range_state(range_ids[0]) == job_ranges.get_range_state(range_ids[1]) == EventRange.DONE
+        to_tar = [r for ranges in bookKeeper.ranges_to_tar_by_input_file.values() for r in ranges]
+        assert [(r['eventRangeID'], r['fsize'], r['PanDAID']) for r in to_tar] == [(range_ids[0], 10, panda_id)]
+        assert sum(len(ids) for ids in bookKeeper.finished_range_by_input_file.values()) == 2
@@ -1,3 +1,33 @@
+from queue import Queue
+
+import pytest
+import ray
+from ray.exceptions import RayActorError
+
+from raythena.actors.loggingActor import LoggingActor
+from raythena.drivers.esdriver import BookKeeper, ESDriver
+from raythena.utils.eventservice import EventRange
+
+
+def make_driver(config, monkeypatch) -> ESDriver:
+    """
+    Driver with a bookkeeper but without communicator and actors
+    """
+    driver = ESDriver.__new__(ESDriver)
+    driver.id = "Driver"
+    driver.config = config
+    driver.logging_actor = LoggingActor.remote(config)
+    driver.bookKeeper = BookKeeper(driver.logging_actor, config)
+    driver.requests_queue = Queue()
+    driver.running = True
+    driver.timeoutinterval = config.ray['timeoutinterval']
+    driver.actors = dict()
+    driver.actors_message_queue = list()
+    driver.actor_by_message = dict()
+    monkeypatch.setattr(driver, "on_tick", lambda: None)
+    return driver
+
+
 class TestDriver:
 
     def test_one(self, tmpdir):
@@ -5,3 +35,85 @@ class TestDriver:
 
     def test_two(self):
         assert not False
+
+    def test_output_range_id(self):
+        range_id = "32186215-5011406537-22637217690-1-1"
+        assert ESDriver.output_range_id(f"/path/to/esOutput/HITS.pool.root.{range_id}") == range_id
+        assert ESDriver.output_range_id(f"HITS.12345._000001.pool.root.{range_id}") == range_id
+        assert ESDriver.output_range_id("/path/to/HITS.pool.root.1") is None
+        assert ESDriver.output_range_id("panda.HITS.zip") is None
+
+    @pytest.mark.usefixtures("requires_ray")
+    def test_actor_death(self, is_eventservice, config, sample_multijobs, sample_ranges, monkeypatch):
+        if not is_eventservice:
+            pytest.skip("No eventservice jobs")
+
+        monkeypatch.setitem(config.ray, 'maxcrashes', 1)
+        driver = make_driver(config, monkeypatch)
+        driver.bookKeeper.add_jobs(sample_multijobs)
+        driver.bookKeeper.add_event_ranges(sample_ranges)
+        actor_id = "Actor_0"
+        panda_id = driver.bookKeeper.assign_job_to_actor(actor_id)['PandaID']
+        crashed = driver.bookKeeper.fetch_event_ranges(actor_id, 1)[0].eventRangeID
+
+        # the reply of a dead actor raises an exception which doesn't identify the actor
+        def get(object_ref):
+            raise RayActorError()
+
+        driver.queue_actor_message(actor_id, object())
+        monkeypatch.setattr(ray, "wait", lambda object_refs, **kwargs: (list(object_refs), list()))
+        monkeypatch.setattr(ray, "get", get)
+        driver.handle_actors()
+
+        assert not driver.actor_by_message
+        assert driver.bookKeeper.actors[actor_id] is None
+        assert driver.bookKeeper.get_actor_of_range(crashed) is None
+        assert driver.requests_queue.get_nowait()[panda_id] == [{'eventRangeID': crashed,
+                                                                 'eventStatus': EventRange.FATAL}]
+
+    @pytest.mark.usefixtures("requires_ray")
+    def test_request_event_ranges_nevents(self, is_eventservice, config, sample_multijobs, monkeypatch):
+        if not is_eventservice:
+            pytest.skip("No eventservice jobs")
+
+        def ranges_of(sizes, first_id):
+            ranges = list()
+            for i, size in enumerate(sizes):
+                ranges.append({'eventRangeID': f"Range-{first_id + i:05}", 'startEvent': 1, 'lastEvent': size,
+                               'scope': '13Mev', 'LFN': "/path/to/file_0", 'GUID': '0'})
+            return ranges
+
+        class Actor:
+            def __init__(self):
+                self.sent = list()
+                self.receive_event_ranges = self
+
+            def remote(self, message, ranges):
+                self.sent.append(list(ranges))
+                return object()
+
+        driver = make_driver(config, monkeypatch)
+        panda_id = next(iter(sample_multijobs))
+        actor_id = "Actor_0"
+        actor = driver.actors[actor_id] = Actor()
+        driver.bookKeeper.add_jobs({panda_id: sample_multijobs[panda_id]})
+        driver.bookKeeper.add_event_ranges({panda_id: ranges_of([3, 3, 5], 0)})
+        driver.bookKeeper.assign_job_to_actor(actor_id)
+        replies = [ranges_of([6], 3)]
+
+        def request_event_ranges(block=False):
+            driver.bookKeeper.add_event_ranges({panda_id: replies.pop()})
+
+        monkeypatch.setattr(driver, "request_event_ranges", request_event_ranges)
+        request = {panda_id: {'nRanges': 10, 'nEvents': 8}}
+
+        # the next range doesn't fit, don't wait on harvester
+        driver.handle_request_event_ranges(actor_id, request, 0)
+        assert [r.nevents() for r in actor.sent[-1]] == [3, 3]
+        assert replies
+
+        # ranges received from harvester only top up the request if they fit
+        driver.handle_request_event_ranges(actor_id, request, 0)
+        assert not replies
+        assert [r.nevents() for r in actor.sent[-1]] == [5]
+        assert sum(r.nevents() for r in actor.sent[-1]) <= request[panda_id]['nEvents']
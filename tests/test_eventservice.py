@@ -1,6 +1,14 @@
+import json
+import os
+import pickle
+import threading
+import tracemalloc
+from urllib.parse import parse_qs, urlencode
+
 import pytest
 
-from raythena.utils.eventservice import EventRange, EventRangeQueue, EventRangeRequest, EventRangeUpdate
+from raythena.utils.eventservice import EventRange, EventRangeQueue, EventRangeRequest, EventRangeUpdate, EventRangeStore
+from raythena.utils.eventservice import ESEncoder, EventRangeBatch, IntervalSet, RangeIDSet
 from raythena.utils.eventservice import PandaJob, PandaJobQueue, PandaJobRequest, PandaJobUpdate
 
 
@@ -35,6 +43,14 @@ class TestEventRangeRequest:
             assert ranges_request[id1]['pandaID'] == ranges_request_init[id2][
                 'pandaID'] == request_dict[id3]['pandaID']
 
+    def test_nevents(self):
+        ranges_request = EventRangeRequest()
+        ranges_request.add_event_request("1", 4, "1", "1")
+        ranges_request.add_event_request("2", 4, "1", "1", n_events=40)
+        assert 'nEvents' not in ranges_request["1"]
+        assert ranges_request["2"]['nEvents'] == 40
+        assert EventRangeRequest.build_from_dict(ranges_request.request)["2"]['nEvents'] == 40
+
 
 class TestEventRangeUpdate:
 
@@ -68,6 +84,48 @@ class TestEventRangeUpdate:
         ranges_update[pandaID] = []
         assert not ranges_update[pandaID]
 
+    def test_parse_pilot_update(self, nevents, sample_rangeupdate, sample_failed_rangeupdate):
+        pandaID = "0"
+        body = urlencode({'eventRanges': json.dumps(sample_rangeupdate), 'version': 1})
+        ranges_update = EventRangeUpdate.parse_pilot_update(pandaID, body)
+        assert ranges_update.range_update == EventRangeUpdate.build_from_dict(pandaID, sample_rangeupdate).range_update
+        assert EventRangeUpdate.parse_pilot_update(pandaID, body.encode()).range_update == ranges_update.range_update
+        assert EventRangeUpdate.parse_pilot_update(pandaID, parse_qs(body)).range_update == ranges_update.range_update
+        for r in ranges_update[pandaID]:
+            assert r['type'] == "zip_output" and isinstance(r['fsize'], int)
+
+        es_output = [{"esOutput": {"numEvents": 1}, "eventRanges": [
+            {"eventRangeID": "Range-0", "eventStatus": "finished", "pfn": "/tmp/HITS.Range-0", "adler32": "0", "fsize": "12"}
+        ]}]
+        ranges_update = EventRangeUpdate.parse_pilot_update(pandaID, urlencode({'eventRanges': json.dumps(es_output)}))
+        assert ranges_update[pandaID] == [{'eventRangeID': "Range-0", 'eventStatus': "finished", 'path': "/tmp/HITS.Range-0",
+                                           'chksum': "0", 'fsize': 12, 'type': "es_output"}]
+        body = urlencode({'eventRanges': json.dumps(sample_failed_rangeupdate)})
+        assert len(EventRangeUpdate.parse_pilot_update(pandaID, body)[pandaID]) == nevents
+        assert EventRangeUpdate.parse_pilot_update(pandaID, "pilotErrorCode=0")[pandaID] == []
+
+        for malformed in ("not json", json.dumps({"eventRangeID": "Range-0"}), json.dumps([{"eventRangeID": "Range-0"}]),
+                          json.dumps([{"eventRangeID": "Range-0", "eventStatus": "unknown"}]),
+                          json.dumps([{"esOutput": {"numEvents": 1}, "eventRanges": [
+                              {"eventRangeID": "Range-0", "eventStatus": "finished"}]}])):
+            with pytest.raises(Exception):
+                EventRangeUpdate.parse_pilot_update(pandaID, urlencode({'eventRanges': malformed}))
+
+        # malformed ranges are skipped when they are collected, the valid ranges of the update are kept
+        mixed = [{"eventRangeID": "Range-0", "eventStatus": "unknown"},
+                 {"eventRangeID": "Range-1", "eventStatus": "failed"},
+                 {"esOutput": {"numEvents": 1}, "eventRanges": [
+                     {"eventRangeID": "Range-2", "eventStatus": "finished"},
+                     {"eventRangeID": "Range-3", "eventStatus": "finished", "pfn": "/tmp/HITS.Range-3", "adler32": "0",
+                      "fsize": "12"}]},
+                 {"zipFile": {"lfn": "EventService_premerge_Range-00004.tar"}, "eventRanges": [
+                     {"eventRangeID": "Range-4", "eventStatus": "finished"}]}]
+        rejected = list()
+        ranges_update = EventRangeUpdate.parse_pilot_update(pandaID, urlencode({'eventRanges': json.dumps(mixed)}),
+                                                            rejected)
+        assert [r['eventRangeID'] for r in ranges_update[pandaID]] == ["Range-1", "Range-3"]
+        assert len(rejected) == 3
+
 
 class TestEventRangeQueue:
 
@@ -135,6 +193,35 @@ class TestEventRangeQueue:
         with pytest.raises(Exception):
             ranges_queue.update_range_state("unknown", EventRange.ASSIGNED)
 
+    def test_update_ranges_states(self, sample_job, sample_ranges, nevents):
+        ranges = list(sample_ranges.values())[0]
+        ranges_queue = EventRangeQueue.build_from_list(ranges)
+        assigned = [r.eventRangeID for r in ranges_queue.get_next_ranges(4)]
+        ready_id = next(iter(r for r in ranges_queue if r not in assigned))
+
+        range_ids = assigned + [ready_id, "unknown", assigned[0]]
+        new_states = [EventRange.DONE, EventRange.DONE, EventRange.FAILED, "unknown_state", EventRange.DONE,
+                      EventRange.DONE, EventRange.FAILED]
+        summary = ranges_queue.update_ranges_states(range_ids, new_states, EventRange.PAYLOAD_UPDATABLE_STATES,
+                                                    atomic=True)
+        assert summary.rejected == [assigned[3], ready_id, "unknown", assigned[0]]
+        assert not summary.counts
+        assert ranges_queue.nranges_assigned() == 4
+
+        summary = ranges_queue.update_ranges_states(range_ids, new_states, EventRange.PAYLOAD_UPDATABLE_STATES)
+        assert summary.counts == {EventRange.DONE: 2, EventRange.FAILED: 1}
+        assert summary.rejected == [assigned[3], ready_id, "unknown", assigned[0]]
+        assert ranges_queue.nranges_done() == 2 and ranges_queue.nranges_failed() == 1
+        assert ranges_queue.nranges_assigned() == 1
+        assert ranges_queue.nranges_available() == nevents - 4
+
+        summary = ranges_queue.update_ranges_states(assigned, [EventRange.READY] * len(assigned))
+        assert summary.counts == {EventRange.READY: 4} and not summary.rejected
+        assert ranges_queue.nranges_available() == nevents
+
+        with pytest.raises(Exception):
+            ranges_queue.update_ranges_states(assigned, [EventRange.READY])
+
     def test_get_next(self, sample_job, sample_ranges):
         ranges_queue = EventRangeQueue()
         assert not ranges_queue.get_next_ranges(10)
@@ -158,6 +245,412 @@ class TestEventRangeQueue:
         ) == ranges_queue.nranges_remaining() == nranges
         assert len(ranges_queue.get_next_ranges(1)) == 0
 
+    def test_state_counters(self, sample_job, sample_ranges, nevents):
+        ranges = list(sample_ranges.values())[0]
+        ranges_queue = EventRangeQueue.build_from_list(ranges)
+
+        def check_counters():
+            for state in EventRange.STATES:
+                expected = sum(len(file_ranges[state]) for file_ranges in ranges_queue.rangesID_by_file.values())
+                assert ranges_queue.range_count_by_state[state] == expected
+
+        check_counters()
+        assigned = ranges_queue.get_next_ranges(nevents // 2)
+        check_counters()
+        ranges_queue.update_range_state(assigned[0].eventRangeID, EventRange.DONE)
+        ranges_queue.update_range_state(assigned[1].eventRangeID, EventRange.FAILED)
+        check_counters()
+        assert ranges_queue.nranges_done() == ranges_queue.nranges_failed() == 1
+        assert ranges_queue.nranges_assigned() == nevents // 2 - 2
+
+        replaced = EventRange.build_from_dict(ranges[-1])
+        ranges_queue[replaced.eventRangeID] = replaced
+        check_counters()
+        assert len(ranges_queue) == nevents
+
+    def test_get_next_fifo_order(self, sample_job, sample_ranges):
+        ranges = list(sample_ranges.values())[0]
+        ranges_queue = EventRangeQueue.build_from_list(ranges)
+
+        first = ranges_queue.get_next_ranges(2)
+        file_name = first[0].file_basename
+        file_ranges = [r['eventRangeID'] for r in ranges if r['LFN'].endswith(file_name)]
+        assert [r.eventRangeID for r in first] == file_ranges[:2]
+        ranges_queue.update_range_state(first[0].eventRangeID, EventRange.READY)
+        ranges_queue.update_range_state(first[1].eventRangeID, EventRange.READY)
+        ready = list(ranges_queue.rangesID_by_file[file_name][EventRange.READY])
+        assert ready == file_ranges[2:] + file_ranges[:2]
+
+    def test_file_policies(self):
+        # files with respectively 5, 3 and 8 ranges ready
+        ranges = list()
+        for file_name, nranges in (("file_a", 5), ("file_b", 3), ("file_c", 8)):
+            for i in range(nranges):
+                ranges.append({
+                    'eventRangeID': f"{file_name}-{i}",
+                    'startEvent': i,
+                    'lastEvent': i,
+                    'LFN': f"/path/to/{file_name}",
+                    'GUID': '0',
+                    'scope': '13TeV'
+                })
+
+        def files_of(assigned):
+            return {r.file_basename for r in assigned}
+
+        ranges_queue = EventRangeQueue()
+        ranges_queue.concat(ranges)
+        assert ranges_queue.files_by_ready_count == {5: {"file_a": None}, 3: {"file_b": None}, 8: {"file_c": None}}
+        assert files_of(ranges_queue.get_next_ranges(4)) == {"file_a"}
+        assert files_of(ranges_queue.get_next_ranges(3)) == {"file_b"}
+        assert files_of(ranges_queue.get_next_ranges(10)) == {"file_a", "file_c"}
+        assert ranges_queue.files_by_ready_count == {}
+        assert ranges_queue.nranges_available() == 0
+
+        ranges_queue = EventRangeQueue(file_policy=EventRangeQueue.MOST_READY)
+        ranges_queue.concat(ranges)
+        assert files_of(ranges_queue.get_next_ranges(2)) == {"file_c"}
+        assert files_of(ranges_queue.get_next_ranges(2, EventRangeQueue.LEAST_READY)) == {"file_b"}
+        assert ranges_queue.files_by_ready_count == {5: {"file_a": None}, 1: {"file_b": None}, 6: {"file_c": None}}
+
+        ranges_queue = EventRangeQueue(file_policy=EventRangeQueue.LEAST_READY)
+        ranges_queue.concat(ranges)
+        assert files_of(ranges_queue.get_next_ranges(4)) == {"file_b", "file_a"}
+        assert ranges_queue.files_by_ready_count == {4: {"file_a": None}, 8: {"file_c": None}}
+
+        with pytest.raises(Exception):
+            EventRangeQueue(file_policy="unknown")
+
+    def test_contiguous(self):
+        # events 0-4 and 10-17 of a single file, delivered out of order
+        starts = [12, 0, 16, 3, 10, 1, 14, 4, 11, 2, 13, 15, 17]
+        ranges = [{'eventRangeID': f"Range-{i}", 'startEvent': start, 'lastEvent': start, 'LFN': "/path/to/file_0",
+                   'GUID': '0', 'scope': '13Mev'} for i, start in enumerate(starts)]
+        ranges_queue = EventRangeQueue(contiguous=True)
+        ranges_queue.concat_raw(ranges)
+        assert [r.startEvent for r in ranges_queue.get_next_ranges(3)] == [10, 11, 12]
+        assert [r.startEvent for r in ranges_queue.get_next_ranges(6)] == [0, 1, 2, 3, 4, 13]
+        ranges_queue.update_ranges_states(["Range-1", "Range-5"], [EventRange.READY] * 2)
+        assert [r.startEvent for r in ranges_queue.get_next_ranges(10)] == [14, 15, 16, 17, 0, 1]
+        assert ranges_queue.nranges_available() == 0 and not ranges_queue._ready_events_by_file["file_0"]
+
+    def test_get_next_nevents(self):
+        sizes = [1, 5, 2, 8, 1, 3, 4, 10, 1]
+        ranges, first = list(), 0
+        for i, size in enumerate(sizes):
+            ranges.append({'eventRangeID': f"Range-{i}", 'startEvent': first, 'lastEvent': first + size - 1,
+                           'LFN': "/path/to/file_0", 'GUID': '0', 'scope': '13Mev'})
+            first += size
+        ranges_queue = EventRangeQueue()
+        ranges_queue.concat_raw(ranges)
+        assert ranges_queue.nevents_available() == sum(sizes)
+        assert [r.nevents() for r in ranges_queue.get_next_ranges(len(sizes), nevents=10)] == [1, 5, 2]
+        assert not ranges_queue.get_next_ranges(len(sizes), nevents=5, at_least_one=False)
+        assert [r.nevents() for r in ranges_queue.get_next_ranges(len(sizes), nevents=5)] == [8]
+        assert [r.nevents() for r in ranges_queue.get_next_ranges(2, nevents=100)] == [1, 3]
+        assert ranges_queue.nevents_available() == 15
+        ranges_queue.update_ranges_states(["Range-0"], [EventRange.READY])
+        assert ranges_queue.nevents_available() == 16
+
+    def test_file_affinity(self, sample_ranges, nevents):
+        ranges = list(sample_ranges.values())[0]
+        ranges_queue = EventRangeQueue()
+        ranges_queue.concat(ranges)
+        assigned = ranges_queue.get_next_ranges(5, preferred_files=["unknown", "file_1"])
+        assert {r.file_basename for r in assigned} == {"file_1"}
+        assigned = ranges_queue.get_next_ranges(5, avoided_files={"file_0", "file_1"})
+        assert {r.file_basename for r in assigned} == {"file_2"}
+        assigned = ranges_queue.get_next_ranges(nevents, preferred_files=["file_2"], avoided_files={"file_0", "file_1", "file_2"})
+        assert len(assigned) == nevents - 10
+        assert all(r.file_basename == "file_2" for r in assigned[:nevents // 3 - 5])
+
+    def test_columnar(self, sample_job, sample_ranges, nevents):
+        ranges = list(sample_ranges.values())[0]
+        ranges_queue = EventRangeQueue(columnar=True)
+        ranges_queue.concat(ranges)
+        assert isinstance(ranges_queue.event_ranges_by_id, EventRangeStore)
+        assert len(ranges_queue) == ranges_queue.nranges_available() == nevents
+
+        assigned = ranges_queue.get_next_ranges(nevents // 2)
+        assert len(assigned) == ranges_queue.nranges_assigned() == nevents // 2
+        for r in assigned:
+            assert r.status == ranges_queue[r.eventRangeID].status == EventRange.ASSIGNED
+
+        ranges_update = [{'eventRangeID': r.eventRangeID, 'eventStatus': EventRange.DONE} for r in assigned]
+        ranges_queue.update_ranges(ranges_update)
+        assert ranges_queue.nranges_done() == nevents // 2
+        assert ranges_queue.nranges_remaining() == ranges_queue.nranges_available() == nevents - nevents // 2
+
+    def test_concat_raw(self, sample_ranges, nevents):
+        ranges = list(sample_ranges.values())[0]
+        ranges_queue = EventRangeQueue()
+        ranges_queue.concat_raw(ranges)
+        assert len(ranges_queue) == ranges_queue.nranges_available() == nevents
+        assert not ranges_queue.event_ranges_by_id
+        assert list(ranges_queue) == [r['eventRangeID'] for r in ranges]
+        encoded = json.loads(json.dumps(ranges_queue, cls=ESEncoder))
+        assert len(encoded) == nevents and not ranges_queue.event_ranges_by_id
+
+        assigned = ranges_queue.get_next_ranges(nevents // 2)
+        assert len(ranges_queue.event_ranges_by_id) == nevents // 2
+        ranges_by_id = {r['eventRangeID']: r for r in ranges}
+        for r in assigned:
+            assert r.status == EventRange.ASSIGNED
+            expected = EventRange.build_from_dict(ranges_by_id[r.eventRangeID])
+            expected.status = EventRange.ASSIGNED
+            assert r.to_dict() == expected.to_dict()
+
+        ready = next(range_id for range_id in ranges_queue if ranges_queue.get_range_state(range_id) == EventRange.READY)
+        replacement = dict(ranges_by_id[ready], startEvent=-1)
+        ranges_queue.concat_raw([replacement])
+        assert len(ranges_queue) == nevents
+        assert ranges_queue.nranges_available() == nevents - nevents // 2
+        assert ranges_queue[ready].startEvent == -1
+
+    def test_concat_raw_columnar(self, sample_ranges, nevents, tmp_path):
+        ranges = list(sample_ranges.values())[0]
+        ranges_queue = EventRangeQueue(columnar=True, spill_dir=str(tmp_path), memory_budget=10)
+        ranges_queue.concat_raw(ranges)
+        # raw records are written to the columnar store, including ranges reloaded from the spill database
+        assert not ranges_queue._raw_ranges and len(ranges_queue.event_ranges_by_id) == 10
+        assert len(ranges_queue) == ranges_queue.nranges_available() == nevents
+        ranges_by_id = {r['eventRangeID']: r for r in ranges}
+        assigned = ranges_queue.get_next_ranges(nevents)
+        assert len(assigned) == nevents and not ranges_queue._raw_ranges
+        for r in assigned:
+            expected = EventRange.build_from_dict(ranges_by_id[r.eventRangeID])
+            expected.status = EventRange.ASSIGNED
+            assert r.to_dict() == expected.to_dict()
+            assert ranges_queue.get_range_state(r.eventRangeID) == EventRange.ASSIGNED
+
+    def test_spill(self, sample_ranges, nevents, tmp_path):
+        ranges = list(sample_ranges.values())[0]
+        budget = 10
+        ranges_queue = EventRangeQueue(spill_dir=str(tmp_path), memory_budget=budget)
+        ranges_queue.concat_raw(ranges)
+        assert len(ranges_queue) == ranges_queue.nranges_available() == nevents
+        assert len(ranges_queue._raw_ranges) == budget
+        assert ranges_queue.spill_stats.spilled == nevents - budget
+        assert len(list(tmp_path.iterdir())) == 1
+        assert sorted(ranges_queue) == sorted(r['eventRangeID'] for r in ranges)
+
+        spilled_id = ranges[-1]['eventRangeID']
+        assert spilled_id in ranges_queue and ranges_queue.get_range_state(spilled_id) == EventRange.READY
+        assert ranges_queue[spilled_id].to_dict() == EventRange.build_from_dict(ranges[-1]).to_dict()
+        assert ranges_queue.spill_stats.reloaded == 1
+        # ranges held in memory are found without querying the spill database
+        queries = list()
+        ranges_queue._spill_conn.set_trace_callback(queries.append)
+        assert spilled_id in ranges_queue and ranges_queue.get_range_state(spilled_id) == EventRange.READY
+        assert ranges_queue[spilled_id].eventRangeID == spilled_id
+        assert not queries
+        ranges_queue._spill_conn.set_trace_callback(None)
+
+        assigned = ranges_queue.get_next_ranges(nevents)
+        assert len(assigned) == nevents and ranges_queue.nranges_available() == 0
+        assert ranges_queue.spill_stats.reloaded == nevents - budget
+        order_by_file = dict()
+        for r in ranges:
+            order_by_file.setdefault(os.path.basename(r['LFN']), list()).append(r['eventRangeID'])
+        for file_name, ids in order_by_file.items():
+            assigned_ids = [r.eventRangeID for r in assigned if r.file_basename == file_name and r.eventRangeID != spilled_id]
+            assert assigned_ids == [range_id for range_id in ids if range_id != spilled_id]
+
+        ranges_queue.close()
+        assert not list(tmp_path.iterdir())
+
+    @pytest.mark.parametrize("memory_budget", [0, 10])
+    def test_duplicate_ranges(self, sample_ranges, nevents, tmp_path, memory_budget):
+        ranges = list(sample_ranges.values())[0]
+        ranges_queue = EventRangeQueue(collapsed_states=[EventRange.DONE], spill_dir=str(tmp_path),
+                                       memory_budget=memory_budget)
+        ranges_queue.concat_raw(ranges)
+        assigned = [r.eventRangeID for r in ranges_queue.get_next_ranges(nevents // 2)]
+        ranges_queue.update_ranges_states(assigned[:5], [EventRange.DONE] * 5)
+        counts = dict(ranges_queue.range_count_by_state)
+
+        ranges_queue.concat_raw(ranges)
+        assert ranges_queue.range_count_by_state == counts
+        assert len(ranges_queue) == nevents
+        assert ranges_queue.ingest_stats.duplicates_dropped == nevents // 2
+        assert ranges_queue.ingest_stats.duplicates_replaced == nevents - nevents // 2
+        for range_id in assigned[5:]:
+            assert ranges_queue[range_id].status == EventRange.ASSIGNED
+
+        ranges_queue.append(next(r for r in ranges if r['eventRangeID'] == assigned[-1]))
+        assert ranges_queue.ingest_stats.duplicates_dropped == nevents // 2 + 1
+        assert len(ranges_queue.get_next_ranges(nevents)) == nevents - nevents // 2
+        ranges_queue.close()
+
+    def test_concurrent_ingest(self, sample_job):
+        panda_id = "es"
+        pandajob_queue = PandaJobQueue()
+        pandajob_queue[panda_id] = PandaJob(dict(list(sample_job.values())[0], PandaID=panda_id, eventService="true"))
+        ranges_queue = pandajob_queue.get_event_ranges(panda_id)
+        nbatches, batch_size = 50, 200
+
+        def ingest():
+            for i in range(nbatches):
+                pandajob_queue.concat_event_ranges({panda_id: [{
+                    'eventRangeID': f"Range-{i * batch_size + j}", 'startEvent': j, 'lastEvent': j,
+                    'LFN': f"/path/to/file_{i % 3}", 'GUID': '0', 'scope': '13Mev'
+                } for j in range(batch_size)]})
+
+        ingest_thread = threading.Thread(target=ingest)
+        ingest_thread.start()
+        assigned = list()
+        while ingest_thread.is_alive() or ranges_queue.nranges_available():
+            job_id, _ = pandajob_queue.next_job_id_to_process()
+            if job_id is not None:
+                assigned.extend(ranges_queue.get_next_ranges(64))
+        ingest_thread.join()
+        assert len(assigned) == len({r.eventRangeID for r in assigned}) == nbatches * batch_size
+        assert ranges_queue.nranges_assigned() == nbatches * batch_size
+        assert pandajob_queue.next_job_id_to_process() == (None, 0)
+        # jobs are only flagged by process_event_ranges_reply, from the thread using the job queue
+        pandajob_queue.concat_event_ranges({panda_id: []})
+        assert not pandajob_queue[panda_id].no_more_ranges
+        pandajob_queue.process_event_ranges_reply({panda_id: []})
+        assert pandajob_queue[panda_id].no_more_ranges
+
+    @pytest.mark.parametrize("columnar", [False, True])
+    def test_collapsed_states(self, sample_ranges, nevents, nfiles, columnar):
+        ranges = list(sample_ranges.values())[0]
+        ranges_queue = EventRangeQueue(columnar=columnar, collapsed_states=[EventRange.DONE])
+        ranges_queue.concat(ranges)
+        assigned = [r.eventRangeID for r in ranges_queue.get_next_ranges(nevents)]
+        done, failed = assigned[:-1], assigned[-1]
+        summary = ranges_queue.update_ranges_states(done + [failed], [EventRange.DONE] * len(done) + [EventRange.FAILED])
+        assert not summary.rejected
+
+        assert len(ranges_queue.event_ranges_by_id) == 1
+        assert len(ranges_queue) == nevents
+        assert ranges_queue.nranges_done() == nevents - 1 and ranges_queue.nranges_failed() == 1
+        assert ranges_queue.nranges_remaining() == 0
+        for range_id in done:
+            assert range_id in ranges_queue
+            assert ranges_queue.get_range_state(range_id) == EventRange.DONE
+        assert ranges_queue.get_range_state(failed) == EventRange.FAILED
+        assert "unknown" not in ranges_queue and ranges_queue.get_range_state("unknown") is None
+
+        assert len(ranges_queue.collapsed_ids_by_state[EventRange.DONE]) == nevents - 1
+        assert len(ranges_queue.collapsed_ids_by_file) == nfiles
+        assert sum(len(events) for events_by_state in ranges_queue.collapsed_events_by_file.values()
+                   for events in events_by_state.values()) == nevents - 1
+
+        summary = ranges_queue.update_ranges_states(done[:1], [EventRange.READY])
+        assert summary.rejected == done[:1]
+
+    @pytest.mark.parametrize("columnar", [False, True])
+    def test_subscribe(self, sample_ranges, nevents, columnar):
+        ranges = list(sample_ranges.values())[0]
+        ranges_queue = EventRangeQueue(columnar=columnar, collapsed_states=[EventRange.DONE])
+        ranges_queue.concat_raw(ranges)
+        transitions = list()
+
+        def observer(event_range, old_state, new_state, timestamp):
+            transitions.append((event_range.eventRangeID, old_state, new_state))
+
+        ranges_queue.subscribe(observer)
+        assigned = [r.eventRangeID for r in ranges_queue.get_next_ranges(2)]
+        ranges_queue.update_ranges_states(assigned, [EventRange.DONE, EventRange.FAILED])
+        assert transitions == [(assigned[0], EventRange.READY, EventRange.ASSIGNED),
+                               (assigned[1], EventRange.READY, EventRange.ASSIGNED),
+                               (assigned[0], EventRange.ASSIGNED, EventRange.DONE),
+                               (assigned[1], EventRange.ASSIGNED, EventRange.FAILED)]
+        ranges_queue.unsubscribe(observer)
+        ranges_queue.get_next_ranges(nevents)
+        assert len(transitions) == 4
+
+
+class TestIntervalSet:
+
+    def test_add(self):
+        intervals = IntervalSet()
+        for i in [5, 3, 4, 10, 12]:
+            intervals.add(i)
+        assert intervals.intervals() == [(3, 5), (10, 10), (12, 12)]
+        intervals.add(11)
+        assert intervals.intervals() == [(3, 5), (10, 12)]
+        intervals.add(0, 20)
+        assert intervals.intervals() == [(0, 20)]
+        intervals.add(4, 6)
+        assert len(intervals) == 21
+        assert 0 in intervals and 20 in intervals and 21 not in intervals and -1 not in intervals
+        with pytest.raises(Exception):
+            intervals.add(3, 2)
+
+
+class TestRangeIDSet:
+
+    def test_ids(self):
+        ids = RangeIDSet()
+        range_ids = [f"Range-{i:05}" for i in range(1000)] + [f"4681414538-3617-1-{i}" for i in range(1, 20)] + ["range"]
+        for range_id in range_ids:
+            ids.add(range_id)
+        assert len(ids) == len(range_ids)
+        for range_id in range_ids:
+            assert range_id in ids
+        assert "Range-1" not in ids and "Range-001000" not in ids and "4681414538-3617-1-0" not in ids
+        assert "other" not in ids
+
+
+class TestEventRangeStore:
+
+    def test_store(self, sample_ranges):
+        ranges = list(sample_ranges.values())[0]
+        store = EventRangeStore()
+        for r in ranges:
+            event_range = EventRange.build_from_dict(r)
+            store[event_range.eventRangeID] = event_range
+        assert len(store) == len(ranges)
+        assert list(store) == [r['eventRangeID'] for r in ranges]
+        for r in ranges:
+            assert store[r['eventRangeID']].to_dict() == EventRange.build_from_dict(r).to_dict()
+
+        range_id = ranges[0]['eventRangeID']
+        view = store[range_id]
+        view.status = EventRange.DONE
+        view.retry = 2
+        assert store[range_id].status == EventRange.READY
+        store[range_id] = view
+        assert store[range_id].status == EventRange.DONE and store[range_id].retry == 2
+
+        removed = store.pop(range_id)
+        assert removed.eventRangeID == range_id
+        assert range_id not in store and store.get(range_id) is None
+        assert len(store) == len(ranges) - 1
+        store[range_id] = removed
+        assert store[range_id].status == EventRange.DONE
+
+
+class TestEventRangeBatch:
+
+    def test_pickle(self, sample_ranges):
+        ranges = [EventRange.build_from_dict(r) for r in list(sample_ranges.values())[0]]
+        ranges[0].retry = 2
+        ranges[1].status = EventRange.ASSIGNED
+        ranges[2].scope = None
+        batch = pickle.loads(pickle.dumps(EventRangeBatch(ranges)))
+        assert len(batch) == len(ranges)
+        assert batch._columns is None
+        decoded = list(batch)
+        assert [r.to_dict() for r in decoded] == [r.to_dict() for r in ranges]
+        assert [(r.retry, r.status) for r in decoded] == [(r.retry, r.status) for r in ranges]
+        assert batch[0] is decoded[0]
+        assert len(pickle.dumps(batch)) < len(pickle.dumps(ranges))
+
+        empty = pickle.loads(pickle.dumps(EventRangeBatch([])))
+        assert len(empty) == 0 and not list(empty)
+
+    def test_separators(self):
+        # strings may hold the characters which could be used as separators or to stand for None
+        ranges = [EventRange("Range-\n0", 1, 10, "/path/to/\nfile_0", "\x00", "13\x00Tev\n"),
+                  EventRange("Range-\x001", 11, 20, "/path/to/file_\u00e91", None, ""),
+                  EventRange("", 21, 30, "/path/to/\nfile_0", "\x00", "13\x00Tev\n")]
+        batch = pickle.loads(pickle.dumps(EventRangeBatch(ranges)))
+        assert [r.to_dict() for r in batch] == [r.to_dict() for r in ranges]
+
 
 class TestEventRanges:
 
@@ -193,6 +686,49 @@ class TestEventRanges:
             and range_from_dict.lastEvent == last and range_from_dict.GUID == guid and range_from_dict.scope == scope
         assert range_from_dict.status == EventRange.READY
 
+    def test_build_from_dict_memory(self):
+        class DictEventRange(object):
+            """
+            EventRange layout without __slots__ nor interning, used as a reference
+            """
+
+            def __init__(self, r_dict):
+                self.lastEvent = r_dict['lastEvent']
+                self.eventRangeID = r_dict['eventRangeID']
+                self.startEvent = r_dict['startEvent']
+                self.PFN = r_dict['LFN']
+                self.GUID = r_dict['GUID']
+                self.scope = r_dict['scope']
+                self.status = EventRange.READY
+                self.retry = 0
+
+        nranges = 10000
+        nfiles = 10
+        # ranges loaded from json hold a distinct string object for each field, as in a harvester reply
+        ranges_json = json.dumps([{
+            "eventRangeID": f"Range-{i:08}",
+            "LFN": f"/path/to/EVNT.{i % nfiles:05}.pool.root.1",
+            "lastEvent": i,
+            "startEvent": i,
+            "GUID": f"{i % nfiles:032}",
+            "scope": "mc16_13TeV"
+        } for i in range(nranges)])
+
+        def bytes_per_range(build):
+            tracemalloc.start()
+            r_dicts = json.loads(ranges_json)
+            ranges = [build(r) for r in r_dicts]
+            # release the parsed dicts so that only memory referenced by the ranges is counted
+            del r_dicts
+            used = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            assert len(ranges) == nranges
+            return used / nranges
+
+        reference = bytes_per_range(DictEventRange)
+        compact = bytes_per_range(EventRange.build_from_dict)
+        assert compact < reference
+
 
 class TestPandaJobQueue:
 
@@ -281,6 +817,63 @@ class TestPandaJobQueue:
         job_2 = pandajob_queue.next_job_to_process()
         assert job['PandaID'] != job_2['PandaID']
 
+    def test_next_job_priority(self, sample_job):
+        job_def = list(sample_job.values())[0]
+        pandajob_queue = PandaJobQueue()
+        for pandaID in ("es_1", "es_2", "es_3"):
+            pandajob_queue[pandaID] = PandaJob(dict(job_def, PandaID=pandaID, eventService="true"))
+        pandajob_queue["standard"] = PandaJob(dict(job_def, PandaID="standard", eventService="false"))
+
+        def ranges(pandaID, n):
+            return [{
+                'eventRangeID': f"{pandaID}-{i}",
+                'startEvent': i,
+                'lastEvent': i,
+                'LFN': "/path/to/file",
+                'GUID': '0',
+                'scope': '13TeV'
+            } for i in range(n)]
+
+        assert pandajob_queue.next_job_id_to_process() == ("standard", 0)
+        assert pandajob_queue.next_job_id_to_process() == (None, 0)
+
+        pandajob_queue.process_event_ranges_reply({"es_1": ranges("es_1", 5), "es_2": ranges("es_2", 10),
+                                                   "es_3": ranges("es_3", 10)})
+        assert pandajob_queue.next_job_id_to_process() == ("es_2", 10)
+        pandajob_queue["es_2"].get_next_ranges(6)
+        assert pandajob_queue.next_job_id_to_process() == ("es_3", 10)
+        pandajob_queue["es_3"].get_next_ranges(10)
+        assert pandajob_queue.next_job_id_to_process() == ("es_1", 5)
+        pandajob_queue["es_1"].get_next_ranges(5)
+        assert pandajob_queue.next_job_id_to_process() == ("es_2", 4)
+        pandajob_queue["es_2"].get_next_ranges(4)
+        assert pandajob_queue.next_job_id_to_process() == (None, 0)
+
+        pandajob_queue.get_event_ranges("es_3").update_range_state("es_3-0", EventRange.READY)
+        assert pandajob_queue.next_job_id_to_process() == ("es_3", 1)
+
+    def test_subscribe(self, sample_job):
+        job_def = list(sample_job.values())[0]
+        pandajob_queue = PandaJobQueue()
+        pandajob_queue["es_1"] = PandaJob(dict(job_def, PandaID="es_1", eventService="true"))
+        transitions = list()
+
+        def observer(event_range, old_state, new_state, timestamp):
+            transitions.append((event_range.eventRangeID, new_state))
+
+        pandajob_queue.subscribe(observer)
+        pandajob_queue["es_2"] = PandaJob(dict(job_def, PandaID="es_2", eventService="true"))
+        pandajob_queue.process_event_ranges_reply({
+            pandaID: [{'eventRangeID': f"{pandaID}-0", 'startEvent': 0, 'lastEvent': 0, 'LFN': "/path/to/file",
+                       'GUID': '0', 'scope': '13TeV'}] for pandaID in ("es_1", "es_2")
+        })
+        pandajob_queue["es_1"].get_next_ranges(1)
+        pandajob_queue["es_2"].get_next_ranges(1)
+        assert transitions == [("es_1-0", EventRange.ASSIGNED), ("es_2-0", EventRange.ASSIGNED)]
+        pandajob_queue.unsubscribe(observer)
+        pandajob_queue.get_event_ranges("es_1").update_range_state("es_1-0", EventRange.DONE)
+        assert len(transitions) == 2
+
 
 class TestPandaJob:
 
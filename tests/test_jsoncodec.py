@@ -0,0 +1,35 @@
+import io
+
+import pytest
+
+from raythena.utils.eventservice import EventRange, EventRangeUpdate, es_json_default
+from raythena.utils.jsoncodec import JSONCodec
+
+
+@pytest.mark.parametrize("backend", JSONCodec.available_backends())
+class TestJSONCodec:
+
+    def test_roundtrip(self, backend, sample_ranges):
+        codec = JSONCodec(backend)
+        assert codec.backend == backend
+        assert codec.loads(codec.dumps(sample_ranges)) == sample_ranges
+        assert codec.loads(codec.dumpb(sample_ranges)) == sample_ranges
+        f = io.StringIO()
+        codec.dump(sample_ranges, f)
+        f.seek(0)
+        assert codec.load(f) == sample_ranges
+
+    def test_default(self, backend, sample_ranges):
+        codec = JSONCodec(backend)
+        ranges = {panda_id: [EventRange.build_from_dict(r) for r in ranges] for panda_id, ranges in sample_ranges.items()}
+        decoded = codec.loads(codec.dumps(ranges, default=es_json_default))
+        assert decoded == {panda_id: [r.to_dict() for r in ranges] for panda_id, ranges in ranges.items()}
+        update = EventRangeUpdate({"1": [{"eventRangeID": "Range-0", "eventStatus": "finished"}]})
+        assert codec.loads(codec.dumps(update, default=es_json_default)) == update.range_update
+        with pytest.raises(TypeError):
+            codec.dumps(object(), default=es_json_default)
+
+
+def test_unknown_backend():
+    with pytest.raises(Exception):
+        JSONCodec("unknown")
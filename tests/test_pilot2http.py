@@ -1,3 +1,4 @@
+import json
 import os
 import time
 
@@ -130,6 +131,16 @@ class TestPilot2Http:
             data=data).json()
         assert res['StatusCode'] == 0
 
+        # malformed ranges don't drop the valid ranges of the same update
+        data = {"eventRanges": json.dumps([{"eventRangeID": "Range-0", "eventStatus": "unknown"},
+                                           {"eventRangeID": "Range-1", "eventStatus": "failed"}])}
+        res = requests.post(
+            'http://127.0.0.1:8080/server/panda/updateEventRanges',
+            data=data).json()
+        assert res['StatusCode'] == 0
+        ranges_update = payload.fetch_ranges_update()
+        assert [r['eventRangeID'] for r in ranges_update[payload.current_job.get_id()]] == ["Range-1"]
+
     def test_getranges(self, payload, config, is_eventservice, sample_job,
                        sample_ranges, nevents):
         if not is_eventservice:
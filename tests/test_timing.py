@@ -0,0 +1,24 @@
+import pytest
+
+from raythena.utils.timing import ThroughputEstimator
+
+
+class TestThroughputEstimator:
+
+    def test_sample(self):
+        estimator = ThroughputEstimator(halflife=10, start_time=0)
+        assert estimator.ranges_rate is None and estimator.time_to_complete(100) is None
+        estimator.add(10, 100)
+        estimator.sample(10)
+        assert estimator.ranges_rate == pytest.approx(1)
+        assert estimator.events_rate == pytest.approx(10)
+        assert estimator.time_to_complete(100) == pytest.approx(10)
+        assert estimator.time_to_complete(0) == 0
+        # one halflife later, the previous rate and the new rate have the same weight
+        estimator.add(30, 300)
+        estimator.sample(20)
+        assert estimator.ranges_rate == pytest.approx(2)
+        assert estimator.events_rate == pytest.approx(20)
+        assert estimator.to_dict() == {"ranges_per_sec": estimator.ranges_rate, "events_per_sec": estimator.events_rate}
+        estimator.sample(20)
+        assert estimator.ranges_rate == pytest.approx(2)